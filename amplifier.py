@@ -1,4 +1,7 @@
-from generators import Generator
+import numpy as np
+
+from generators import Generator, output_method, find_active
+from stream import fit
 
 class Amplifier(Generator):
 	"""A class to represent an amplifier"""
@@ -11,23 +14,73 @@ class Amplifier(Generator):
 	def set_input(self, input):
 		"""Adds an input to the amplifier"""
 		self.input = input
+		self.touch()
 
 	def set_mod(self, mod):
 		"""Adds a modulator to the amplifier"""
 		self.mod = mod
+		self.touch()
 
-	def output(self, t, ignore_mod=False, **kwargs):
-		"""Returns the value of the output signal in time t"""
+	def get_inputs(self, ignore_mod=False):
+		"""Returns a list of modules whose outputs are read"""
+
+		if ignore_mod or self.mod is None:
+			return [self.input]
+		else:
+			return [self.input, self.mod]
+
+	def get_active(self, t, ignore_mod=False, **kwargs):
+		"""
+		Returns a boolean array telling where in time t the output may be 
+		non-zero ('None' if it is not known)
+		"""
 
+		active = find_active(self.input, t, ignore_mod=ignore_mod, **kwargs)
 		if ignore_mod or self.mod is None:
-			mod_out = 1.0
+			return active
+
+		mod_active = find_active(self.mod, t, **kwargs)
+		if active is None:
+			return mod_active
+		elif mod_active is None:
+			return active
 		else:
-			mod_out = self.mod.output(t, **kwargs)
+			return np.logical_and(active, mod_active, out=self.get_buffer(
+				t, 'active', bool, kwargs.get('stream')
+			))
+
+	@output_method
+	def output(self, t, ignore_mod=False, out=None, **kwargs):
+		"""Returns the value of the output signal in time t"""
+
+		if ignore_mod or self.mod is None:
+			output = self.input.output(
+				t, ignore_mod=ignore_mod, out=out, **kwargs
+			)
+			return np.multiply(self.level, output, out=fit(out, output))
+
+		stream = kwargs.get('stream')
+		buffer = self.get_buffer(t, 'mod', stream=stream)
+		mod_out = self.mod.output(t, out=buffer, **kwargs)
 
-		return mod_out*self.level*self.input.output(
-			t, ignore_mod=ignore_mod, **kwargs
+		#the input is needed only where the modulator isn't 0
+		active = None
+		if type(t) == np.ndarray:
+			if np.ndim(mod_out) > np.ndim(t):
+				active = np.any(np.not_equal(mod_out, 0.0), axis=0)
+			else:
+				active = np.not_equal(mod_out, 0.0, out=self.get_buffer(
+					t, 'nonzero', bool, stream
+				))
+
+		output = self.input.output_active(
+			t, active, ignore_mod=ignore_mod, out=out, **kwargs
 		)
 
+		#the modulator is multiplied by the level first, then by the input
+		mod_out = np.multiply(mod_out, self.level, out=fit(buffer, mod_out))
+		return np.multiply(mod_out, output, out=fit(out, mod_out, output))
+
 	def draw(self, ax, time=1.0, **kwargs):
 		"""
 		Draws the shape of the output signal along with its 
@@ -0,0 +1,584 @@
+import os
+import time as clock
+import timeit
+
+import numpy as np
+
+import constants as const
+
+MIDI = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'midi')
+
+def measure(function, repeat=5, number=10):
+	"""Returns the shortest time (in seconds) of one call of 'function'"""
+	return min(timeit.repeat(function, repeat=repeat, number=number)) / number
+
+def danger_zone(fm_type='DX', table=None, feedback=0.0):
+	"""
+	Returns the mixer and the keyboard of the patch from 
+	'example_danger_zone.py' ('feedback' is the feedback of the operator on 
+	top of the second stack, as in 'danger_zone_dx6')
+	"""
+
+	from fm import FMOperator
+	from mixer import Mixer
+	from keyboard import MonoKeyboard
+
+	freq = 220
+
+	op1 = FMOperator(20.0063*freq, .2, fm_type=fm_type, table=table)
+	op2 = FMOperator(1.0003*freq, 1.8, fm_type=fm_type, table=table)
+	op3 = FMOperator(1.0003*freq, .59, fm_type=fm_type, table=table)
+
+	op4 = FMOperator(6.9978*freq, .2, fm_type=fm_type, table=table)
+	op5 = FMOperator(0.9997*freq, 1.4, fm_type=fm_type, table=table)
+	op6 = FMOperator(0.9997*freq, .57, fm_type=fm_type, table=table)
+
+	op3.add_modulator(op2)
+	op2.add_modulator(op1)
+
+	op6.add_modulator(op5)
+	op5.add_modulator(op4)
+
+	mixer = Mixer()
+	mixer.add_input(op3, 0.125)
+	mixer.add_input(op6, 0.125)
+
+	op1.set_eg_params(0.0, 0.11, 0.0, 0.05)
+	op2.set_eg_params(0.0, 0.5, 0.3, 0.2)
+	op3.set_eg_params(0.0, 0.5, 0.3, 0.4)
+
+	op4.set_eg_params(0.0, 0.11, 0.0, 0.05)
+	op5.set_eg_params(0.0, 0.7, 0.2, 0.2)
+	op6.set_eg_params(0.0, 0.7, 0.2, 0.4)
+
+	op4.set_feedback(feedback)
+
+	kbd = MonoKeyboard()
+	for op in [op1, op2, op3, op4, op5, op6]:
+		op.set_keyboard(kbd)
+
+	kbd.read_midi(os.path.join(MIDI, 'dangerzonebass.mid'))
+
+	return mixer, kbd
+
+def danger_zone_dx6(feedback=0.0):
+	"""
+	Returns the patch from 'example_danger_zone.py' as a 'DX6Voice' (its 2 
+	stacks of 3 operators are the algorithm 3) and its keyboard
+	"""
+
+	from dx import DX6Voice
+	from keyboard import MonoKeyboard
+
+	voice = DX6Voice(
+		3, 220.0, [1.0003, 1.0003, 20.0063, 0.9997, 0.9997, 6.9978], 
+		[0.59, 1.8, 0.2, 0.57, 1.4, 0.2], feedback, volume=0.125
+	)
+
+	voice.set_eg_params(1, 0.0, 0.5, 0.3, 0.4)
+	voice.set_eg_params(2, 0.0, 0.5, 0.3, 0.2)
+	voice.set_eg_params(3, 0.0, 0.11, 0.0, 0.05)
+
+	voice.set_eg_params(4, 0.0, 0.7, 0.2, 0.4)
+	voice.set_eg_params(5, 0.0, 0.7, 0.2, 0.2)
+	voice.set_eg_params(6, 0.0, 0.11, 0.0, 0.05)
+
+	kbd = MonoKeyboard()
+	voice.set_keyboard(kbd)
+	kbd.read_midi(os.path.join(MIDI, 'dangerzonebass.mid'))
+
+	return voice, kbd
+
+def render_speed(generator, time=13.0, block_size=4096):
+	"""
+	Renders 'generator' block by block and returns the render speed as a 
+	multiple of real time
+	"""
+
+	start = clock.perf_counter()
+	for block in generator.blocks(time, block_size):
+		pass
+
+	return time / (clock.perf_counter() - start)
+
+def benchmark_wavetable(block_size=4096, blocks=64):
+	"""
+	Compares the wavetable lookup with 'np.sin' for tables of different 
+	accuracy
+	"""
+
+	from wavetable import sine_table
+
+	phases = np.random.uniform(0.0, 1000.0, block_size*blocks)
+	exact = np.sin(2*np.pi*phases)
+
+	def render_sine():
+		for i in range(blocks):
+			np.sin(2*np.pi*phases[i*block_size:(i + 1)*block_size])
+
+	time = measure(render_sine)
+	print('np.sin: %.2f ms' % (1000*time))
+
+	for error in [1e-4, 1e-6, 1e-8]:
+		table = sine_table(error=error)
+
+		def render_table():
+			for i in range(blocks):
+				table.lookup(phases[i*block_size:(i + 1)*block_size])
+
+		table_time = measure(render_table)
+		print(
+			'table of %d samples: %.2f ms (%.2fx), max error %.1e' % (
+				table.size, 1000*table_time, time / table_time, 
+				np.max(np.abs(table.lookup(phases) - exact))
+			)
+		)
+
+	mixer, kbd = danger_zone()
+	print('6 operators, np.sin: %.1fx real time' % render_speed(mixer))
+
+	mixer, kbd = danger_zone(table=sine_table(error=1e-8))
+	print('6 operators, table: %.1fx real time' % render_speed(mixer))
+
+def fm_voice(keyboard, fm_type='DX'):
+	"""Returns a 2 operator patch played by 'keyboard'"""
+
+	from fm import FMOperator
+
+	op1 = FMOperator(220.0, 0.5, fm_type=fm_type)
+	op2 = FMOperator(440.0, 1.0, fm_type=fm_type)
+	op1.add_modulator(op2)
+
+	op1.set_eg_params(0.01, 0.2, 0.5, 0.3)
+	op2.set_eg_params(0.0, 0.3, 0.2, 0.2)
+
+	op1.set_keyboard(keyboard)
+	op2.set_keyboard(keyboard)
+
+	return op1
+
+def benchmark_polyphony(polyphony=8, time=9.5):
+	"""
+	Compares a polyphonic patch rendering all voices at once with one 
+	monophonic patch per voice
+	"""
+
+	from keyboard import MonoKeyboard, PolyKeyboard
+	from mixer import Mixer, VoiceMixer
+
+	for name in ['chords', 'overlap']:
+		kbd = PolyKeyboard(polyphony)
+		kbd.read_midi(os.path.join(MIDI, 'wlazkoteknaplotek_%s.mid' % name))
+
+		poly = VoiceMixer(kbd, fm_voice(kbd))
+
+		#the same voices played by separate patches
+		mono = Mixer()
+		for i in range(polyphony):
+			voice = MonoKeyboard()
+			voice.key = kbd.key.keys[i]
+			voice.gate = kbd.gate.gates[i]
+			mono.add_input(fm_voice(voice))
+
+		difference = np.max(np.abs(
+			np.concatenate(list(poly.blocks(time, 4096))) - 
+			np.concatenate(list(mono.blocks(time, 4096)))
+		))
+
+		print(
+			'%s, %d voices: %.1fx real time (%.1fx with a patch per voice), '
+			'max difference %.1e' % (
+				name, polyphony, render_speed(poly, time), 
+				render_speed(mono, time), difference
+			)
+		)
+
+def benchmark_silence(time=9.0):
+	"""
+	Compares the render speed of the patch from 'example_danger_zone.py' 
+	playing the whole bassline and playing 3 short notes (the operators are 
+	not evaluated where their envelopes are silent)
+	"""
+
+	for fm_type in ['DX', 'LinearFM']:
+		mixer, kbd = danger_zone(fm_type)
+		dense = render_speed(mixer, time)
+
+		kbd.gate.set_triggers([1.0, 1.1, 4.0, 4.1, 7.0, 7.2])
+		kbd.key.set_attributes([1.0, 4.0, 7.0], [0, 5, 7])
+		sparse = render_speed(mixer, time)
+
+		print(
+			'%s, bassline: %.1fx real time, 3 notes: %.1fx real time' % (
+				fm_type, dense, sparse
+			)
+		)
+
+def benchmark_compiler(block_sizes=[1024, 4096]):
+	"""
+	Compares the patch from 'example_danger_zone.py' with its compiled plan
+	"""
+
+	from compiler import compile
+
+	for fm_type in ['DX', 'LinearFM']:
+		mixer, kbd = danger_zone(fm_type)
+		plan = compile(mixer)
+
+		for block_size in block_sizes:
+			interpreted = render_speed(mixer, block_size=block_size)
+			compiled = render_speed(plan, block_size=block_size)
+
+			print(
+				'%s, blocks of %d: %.1fx real time (%.1fx compiled)' % (
+					fm_type, block_size, interpreted, compiled
+				)
+			)
+
+def benchmark_dx6(block_sizes=[1024, 4096]):
+	"""
+	Compares the patch from 'example_danger_zone.py' wired from 'FMOperator's 
+	with the same patch as a 'DX6Voice'
+	"""
+
+	mixer, kbd = danger_zone()
+	voice, kbd = danger_zone_dx6()
+
+	difference = np.max(np.abs(
+		np.concatenate(list(mixer.blocks(13.0, 4096))) - 
+		np.concatenate(list(voice.blocks(13.0, 4096)))
+	))
+	print('max difference %.1e' % difference)
+
+	for block_size in block_sizes:
+		print(
+			'blocks of %d: %.1fx real time (%.1fx as a DX6Voice)' % (
+				block_size, render_speed(mixer, block_size=block_size), 
+				render_speed(voice, block_size=block_size)
+			)
+		)
+
+def benchmark_feedback(block_size=4096):
+	"""
+	Compares the render speed of the patch from 'example_danger_zone.py' 
+	without and with feedback of an operator (evaluated sample by sample)
+	"""
+
+	from fm import feedback_loop
+
+	phases = np.random.uniform(0.0, 1000.0, (1, block_size))
+	mods = np.full(block_size, 2*np.pi)
+	amps = np.ones((1, block_size))
+
+	time = measure(lambda: feedback_loop(phases, mods, amps, 0.5), number=5)
+	print('feedback loop: %.0f ns per sample' % (1e9*time / block_size))
+
+	mixer, kbd = danger_zone()
+	voice, kbd = danger_zone_dx6()
+	print(
+		'no feedback: %.1fx real time (%.1fx as a DX6Voice)' % (
+			render_speed(mixer, block_size=block_size), 
+			render_speed(voice, block_size=block_size)
+		)
+	)
+
+	mixer, kbd = danger_zone(feedback=0.2)
+	voice, kbd = danger_zone_dx6(feedback=0.2)
+	print(
+		'feedback: %.1fx real time (%.1fx as a DX6Voice)' % (
+			render_speed(mixer, block_size=block_size), 
+			render_speed(voice, block_size=block_size)
+		)
+	)
+
+def benchmark_periodic(partials=16, time=5.0, block_sizes=[1024, 4096]):
+	"""
+	Compares the render speed of an additive stack of unmodulated oscillators 
+	computed sample by sample and tiled from their cached cycles
+	"""
+
+	import oscillators
+	from stream import sample_times
+	from mixer import Mixer
+
+	stack = Mixer()
+	for i in range(partials):
+		wave = [
+			oscillators.SineOscillator, oscillators.SquareOscillator, 
+			oscillators.SawOscillator, oscillators.TriangleOscillator
+		][i % 4]
+		stack.add_input(wave(110.0*(i + 1), phase=0.1*i), 1.0 / partials)
+
+	t = sample_times(0, int(time*const.fs))
+	for block_size in block_sizes:
+		speeds, outputs = [], []
+		for max_period in [0, const.fs]:
+			oscillators.MAX_PERIOD = max_period
+			for input in stack.inputs:
+				input.cycles = None
+
+			speeds.append(render_speed(stack, time, block_size))
+			outputs.append(stack.output(t))
+
+		print(
+			'%d partials, %d samples per block: %.1fx real time (%.1fx tiled), '
+			'max difference %.1e' % (
+				partials, block_size, speeds[0], speeds[1], 
+				np.max(np.abs(outputs[1] - outputs[0]))
+			)
+		)
+
+def benchmark_incremental(time=13.0):
+	"""
+	Compares the time of rendering the patch from 'example_danger_zone.py' 
+	from scratch with rendering it again after a parameter edit, with the 
+	outputs of unchanged modules kept by a 'RenderCache'
+	"""
+
+	from cache import RenderCache
+	from stream import Stream, sample_count, sample_times
+
+	mixer, kbd = danger_zone()
+	op3, op6 = mixer.inputs
+	t = sample_times(0, sample_count(time))
+
+	cache = RenderCache()
+	cache.render(mixer, time)
+
+	op5 = op6.mixer.inputs[0]
+	edits = [
+		('envelope of a carrier', lambda: op3.set_eg_params(0, 0.4, 0.2, 0.3)), 
+		('mixer level', lambda: mixer.set_level(1, 0.2)), 
+		('envelope of a modulator', lambda: op5.set_eg_params(0, 0.2, 0, 0.05))
+	]
+
+	scratch = measure(lambda: Stream().output(mixer, t), number=1)
+	for name, edit in edits:
+		edit()
+		start = clock.perf_counter()
+		cache.render(mixer, time)
+		incremental = clock.perf_counter() - start
+
+		print('%s edited: %.3f s (%.3f s from scratch)' % (
+			name, incremental, scratch
+		))
+
+def benchmark_disk_cache(time=13.0):
+	"""
+	Compares the time of rendering the patch from 'example_danger_zone.py' 
+	with taking the stored signal from a 'DiskCache'
+	"""
+
+	import tempfile
+	from cache import DiskCache
+
+	mixer, kbd = danger_zone()
+
+	with tempfile.TemporaryDirectory() as directory:
+		cache = DiskCache(directory)
+
+		start = clock.perf_counter()
+		cache.render(mixer, time)
+		miss = clock.perf_counter() - start
+
+		hit = measure(lambda: cache.render(mixer, time), number=1)
+		key = measure(lambda: cache.get_key(mixer, time), number=1)
+
+		print(
+			'disk cache: %.3f s rendered, %.4f s stored (%.4f s hashing), %r' % (
+				miss, hit, key, cache.get_stats()
+			)
+		)
+
+def benchmark_parallel(width=8, time=13.0):
+	"""
+	Compares the render time of a mixer of 'width' copies of the patch from 
+	'example_danger_zone.py' rendered serially and by pools of processes (the 
+	scaling is limited by the number of cores)
+	"""
+
+	from mixer import Mixer
+	from parallel import ParallelRenderer
+	from stream import Stream
+
+	wide = Mixer()
+	for i in range(width):
+		mixer, kbd = danger_zone()
+		wide.add_input(mixer, 1.0 / width)
+
+	serial = measure(
+		lambda: list(Stream(4096).render(wide, time)), repeat=1, number=1
+	)
+	print('%d branches, %d cores: %.2f s serially' % (
+		width, os.cpu_count(), serial
+	))
+
+	for processes in [1, 2, 4, 8]:
+		with ParallelRenderer(processes) as renderer:
+			parallel = measure(
+				lambda: renderer.render(wide, time), repeat=1, number=1
+			)
+		print('%d processes: %.2f s (%.1fx)' % (
+			processes, parallel, serial / parallel
+		))
+
+def benchmark_chunks(time=13.0):
+	"""
+	Compares the render time of the patch from 'example_danger_zone.py' 
+	rendered serially and split in time into chunks rendered by pools of 
+	processes (the scaling is limited by the number of cores)
+	"""
+
+	from parallel import ParallelRenderer
+	from stream import Stream
+
+	for fm_type in ['DX', 'LinearFM']:
+		mixer, kbd = danger_zone(fm_type)
+
+		serial = measure(
+			lambda: list(Stream(4096).render(mixer, time)), repeat=1, number=1
+		)
+		print('%s, %d cores: %.2f s serially' % (
+			fm_type, os.cpu_count(), serial
+		))
+
+		for processes in [2, 4, 8]:
+			with ParallelRenderer(processes) as renderer:
+				parallel = measure(
+					lambda: renderer.render_chunks(mixer, time),
+					repeat=1, number=1
+				)
+			print('%d chunks: %.2f s (%.1fx)' % (
+				processes, parallel, serial / parallel
+			))
+
+def benchmark_midi(repeat=64):
+	"""
+	Compares the time of parsing a MIDI file 'repeat' times longer than 
+	'wlazkoteknaplotek_all.mid' and of reading its cached index
+	"""
+
+	import tempfile
+	import mido
+	from midifile import parse, read_index
+	from keyboard import MonoKeyboard
+
+	mid = mido.MidiFile(os.path.join(MIDI, 'wlazkoteknaplotek_all.mid'))
+	for track in mid.tracks:
+		messages = [msg for msg in track if not msg.is_meta]
+		track.extend(messages*(repeat - 1))
+
+	filename = os.path.join(tempfile.mkdtemp(), 'long.mid')
+	mid.save(filename)
+	read_index(filename)
+
+	parsing = measure(lambda: parse(filename), repeat=3, number=1)
+	cached = measure(lambda: read_index(filename), repeat=3, number=10)
+	keyboard = measure(
+		lambda: MonoKeyboard().read_midi(filename), repeat=3, number=10
+	)
+	print('%d notes: parsed in %.1f ms, cached index read in %.2f ms' % (
+		len(read_index(filename)), 1e3*parsing, 1e3*cached
+	))
+	print('a keyboard set up from the cached index in %.2f ms' % (
+		1e3*keyboard
+	))
+
+def benchmark_controls(time=13.0, rate=100.0):
+	"""
+	Compares a patch with one played with the velocity and the pitch bend of 
+	its keyboard, the bend is set 'rate' times per second
+	"""
+
+	from keyboard import MonoKeyboard
+	from mixer import Mixer
+	from amplifier import Amplifier
+	from oscillators import SineOscillator
+	from triggerables import ADSR
+
+	def patch(controls):
+		kbd = MonoKeyboard()
+		kbd.read_midi(os.path.join(MIDI, 'dangerzonebass.mid'))
+
+		key = kbd.key
+		if controls:
+			#a vibrato of a semitone (and glides between the values)
+			steps = np.arange(0.0, time, 1.0 / rate)
+			kbd.pitch_bend.set_attributes(steps, np.sin(2*np.pi*5.0*steps))
+			kbd.pitch_bend.set_ramp(0.5 / rate)
+
+			key = Mixer()
+			key.add_input(kbd.key)
+			key.add_input(kbd.pitch_bend)
+
+		eg = ADSR(0.01, 0.2, 0.5, 0.3, input=kbd.gate)
+		mixer = Mixer()
+		mixer.add_input(
+			Amplifier(input=SineOscillator(220.0, key_in=key), mod=eg), 
+			kbd.velocity if controls else 1.0
+		)
+
+		return mixer
+
+	print('without controls: %.1fx real time' % render_speed(patch(False)))
+	print('velocity and pitch bend: %.1fx real time' % render_speed(
+		patch(True)
+	))
+
+def benchmark_live(block_sizes=[128, 256, 512, 1024], time=2.0):
+	"""
+	Measures the latencies of a live playback of a polyphonic patch, fed with 
+	notes by a scripted port, for the messages quantized to blocks and to 
+	samples
+	"""
+
+	import mido
+	from keyboard import PolyKeyboard
+	from mixer import VoiceMixer
+	from live import LivePlayer, ScriptedPort
+	from playback import NullSink
+
+	random = np.random.default_rng(0)
+	script = []
+	for press in np.sort(random.uniform(0.0, time - 0.2, 64)):
+		note = int(random.integers(36, 84))
+		script.append((press, mido.Message('note_on', note=note)))
+		script.append((press + 0.1, mido.Message('note_off', note=note)))
+
+	for block_size in block_sizes:
+		for quantize in ['block', 'sample']:
+			kbd = PolyKeyboard(8)
+			player = LivePlayer(
+				VoiceMixer(kbd, fm_voice(kbd)), kbd, ScriptedPort(script), 
+				time, block_size, 
+				quantize=quantize, sink=NullSink()
+			)
+			player.play()
+
+			latencies = 1000.0*player.get_latencies()
+			print(
+				'blocks of %d, quantized to %ss: latency p50 %.2f ms, '
+				'p99 %.2f ms, jitter %.2f ms, %d underruns' % (
+					block_size, quantize, np.percentile(latencies, 50), 
+					np.percentile(latencies, 99), np.ptp(latencies), 
+					player.underruns
+				)
+			)
+
+
+if __name__ == '__main__':
+
+	benchmark_wavetable()
+	benchmark_polyphony()
+	benchmark_silence()
+	benchmark_compiler()
+	benchmark_dx6()
+	benchmark_feedback()
+	benchmark_periodic()
+	benchmark_incremental()
+	benchmark_disk_cache()
+	benchmark_parallel()
+	benchmark_chunks()
+	benchmark_midi()
+	benchmark_controls()
+	benchmark_live()
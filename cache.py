@@ -0,0 +1,448 @@
+import hashlib
+import os
+
+import numpy as np
+
+import constants as const
+from generators import get_stamp
+from stream import Stream, sample_count, sample_times
+
+"""
+version of the signals stored by a 'DiskCache', a part of every key, it has 
+to be increased whenever a change of the code changes the output of a patch 
+(or the format of the files), so that the signals stored before are not used
+"""
+CACHE_VERSION = 1
+
+def fingerprint(value, digest, seen=None):
+	"""
+	Feeds 'digest' (a 'hashlib' hash) with the structure and the parameters 
+	of 'value', a module or any of its attributes ('seen' numbers the 
+	objects found so far, an object found again is given by its number)
+
+	Attributes listed in the 'transient' attribute of an object (such as 
+	caches) are skipped.
+	"""
+
+	if seen is None:
+		seen = {}
+
+	if isinstance(value, np.generic):
+		value = value.item()
+
+	if value is None or isinstance(value, (bool, int, float, complex, str)):
+		digest.update(('%s:%r;' % (type(value).__name__, value)).encode())
+
+	elif isinstance(value, np.ndarray):
+		header = 'array:%s:%r;' % (value.dtype.str, value.shape)
+		digest.update(header.encode())
+		digest.update(np.ascontiguousarray(value).tobytes())
+
+	elif isinstance(value, (list, tuple)):
+		digest.update(('%s:%d;' % (type(value).__name__, len(value))).encode())
+		for item in value:
+			fingerprint(item, digest, seen)
+
+	elif isinstance(value, dict):
+		digest.update(('dict:%d;' % len(value)).encode())
+		for key in sorted(value, key=repr):
+			fingerprint(key, digest, seen)
+			fingerprint(value[key], digest, seen)
+
+	elif id(value) in seen:
+		digest.update(('ref:%d;' % seen[id(value)]).encode())
+
+	elif hasattr(value, '__dict__') and not callable(value):
+		seen[id(value)] = len(seen)
+
+		cls = type(value)
+		digest.update(('%s.%s{' % (cls.__module__, cls.__qualname__)).encode())
+		transient = getattr(value, 'transient', ())
+		for name, attribute in sorted(vars(value).items()):
+			if name not in transient:
+				digest.update(('%s=' % name).encode())
+				fingerprint(attribute, digest, seen)
+		digest.update(b'}')
+
+	else:
+		#functions and classes are given by their names, which have to tell 
+		#them apart (names of lambdas and nested functions don't)
+		name = getattr(
+			value, '__qualname__', 
+			getattr(value, '__name__', type(value).__qualname__)
+		)
+		if '<' in name:
+			raise ValueError(
+				"%r has no unique name, so it can't be a part of a key" % (
+					value,
+				)
+			)
+
+		digest.update(('%s.%s;' % (
+			getattr(value, '__module__', None), name
+		)).encode())
+
+class RenderCache():
+	"""
+	A class to represent the outputs of modules rendered as a whole signal 
+	(from time 0), kept between renders
+
+	An output is used again as long as neither its module nor any module it 
+	depends on was changed (see 'Generator.touch'), so after a parameter edit 
+	only the changed module and the modules reading it are evaluated again
+	"""
+
+	def __init__(self):
+
+		"""
+		'outputs[key]' is a tuple (stamp, voices, length, value), where 
+		'stamp' is the stamp of the module (see 'get_stamp') when 'value' was 
+		rendered for 'length' samples and the voices 'voices'
+		"""
+		self.outputs = {}
+
+		self.stamps = {}	#stamps of the modules in the current render
+
+	def render(self, generator, time=1.0, **kwargs):
+		"""Returns the output of 'generator' for 'time' seconds"""
+
+		self.stamps = {}
+
+		stream = Stream()
+		stream.store = self
+		return stream.output(
+			generator, sample_times(0, sample_count(time)), **kwargs
+		)
+
+	def get_voices(self, stream):
+		"""Returns the voices sounding in the block of 'stream' as a tuple"""
+
+		if stream.voices is None:
+			return None
+		else:
+			return tuple(stream.voices)
+
+	def load(self, key, stream, out=None):
+		"""
+		Returns the output of the module for the block of 'stream' ('key' is 
+		a tuple (module, ignore_mod)), written to 'out' if given, 'None' if 
+		it has to be evaluated again
+		"""
+
+		try:
+			stamp, voices, length, value = self.outputs[key]
+		except KeyError:
+			return None
+
+		if (
+			stamp != get_stamp(key[0], self.stamps) or 
+			voices != self.get_voices(stream) or length != len(stream.t)
+		):
+			return None
+
+		#modules may overwrite the outputs they are given
+		if out is None or np.shape(value) != out.shape:
+			return np.copy(value)
+
+		np.copyto(out, value)
+		return out
+
+	def save(self, key, stream, value):
+		"""Keeps the output of the module for the block of 'stream'"""
+
+		self.outputs[key] = (
+			get_stamp(key[0], self.stamps), self.get_voices(stream),
+			len(stream.t), np.array(value)
+		)
+
+	def clear(self):
+		"""Forgets all outputs"""
+		self.outputs = {}
+class DiskCache():
+	"""
+	A class to represent rendered signals stored in a directory (as '.npy' 
+	files), under keys hashing the patch, with its keyboards and MIDI data, 
+	the sampling rate and the length of the signal (see 'get_key')
+
+	A stored signal is memory-mapped, not read. When the files exceed 
+	'budget' bytes, the least recently used ones are removed.
+	"""
+
+	def __init__(self, directory, budget=2**30):
+		self.directory = directory		#directory of the files
+		self.budget = budget			#largest size of the files (in bytes)
+
+		#statistics
+		self.hits = 0			#number of signals found
+		self.misses = 0			#number of signals rendered
+		self.evictions = 0		#number of removed files
+
+		os.makedirs(directory, exist_ok=True)
+
+	def get_key(self, generator, time=1.0):
+		"""
+		Returns the key of the signal of 'generator' for 'time' seconds (a 
+		hexadecimal string)
+		"""
+
+		digest = hashlib.sha256()
+		digest.update(('%d;%r;%d;' % (
+			CACHE_VERSION, const.fs, sample_count(time)
+		)).encode())
+		fingerprint(generator, digest)
+
+		return digest.hexdigest()
+
+	def get_path(self, key):
+		"""Returns the path of the file of the signal with key 'key'"""
+		return os.path.join(self.directory, key + '.npy')
+
+	def get_files(self):
+		"""Returns the paths of all stored signals"""
+
+		return [
+			os.path.join(self.directory, name)
+			for name in os.listdir(self.directory)
+			if name.endswith('.npy') and not name.endswith('.part.npy')
+		]
+
+	def load(self, key):
+		"""
+		Returns the signal with key 'key' (memory-mapped), 'None' if it is 
+		not stored
+		"""
+
+		path = self.get_path(key)
+		try:
+			signal = np.load(path, mmap_mode='r')
+		except (OSError, ValueError):
+			return None
+
+		#the file is the most recently used now
+		os.utime(path)
+		return signal
+
+	def blocks(self, generator, time=1.0, block_size=4096):
+		"""
+		Yields the signal of 'generator' for 'time' seconds in blocks of 
+		'block_size' samples, the blocks of a signal that is not stored are 
+		rendered and stored as they are yielded
+		"""
+
+		key = self.get_key(generator, time)
+		signal = self.load(key)
+
+		if signal is not None:
+			self.hits += 1
+			for start in range(0, signal.shape[-1], block_size):
+				yield signal[..., start:start + block_size]
+			return
+
+		self.misses += 1
+
+		#the signal is written to a partial file until it is complete
+		path = self.get_path(key)
+		part = os.path.join(
+			self.directory, '%s.%d.part.npy' % (key, os.getpid())
+		)
+		length = sample_count(time)
+		stored = None
+		start = 0
+
+		try:
+			for block in Stream(block_size).render(generator, time):
+				if stored is None:
+					stored = np.lib.format.open_memmap(
+						part, 'w+', np.float64, np.shape(block)[:-1] + (length,)
+					)
+
+				stored[..., start:start + block.shape[-1]] = block
+				start += block.shape[-1]
+				yield block
+
+			if stored is None:
+				np.save(part, np.zeros(length))
+			else:
+				stored.flush()
+				stored = None
+
+			os.replace(part, path)
+			self.evict(path)
+
+		finally:
+			stored = None
+			if os.path.exists(part):
+				os.remove(part)
+
+	def render(self, generator, time=1.0, block_size=4096):
+		"""
+		Returns the signal of 'generator' for 'time' seconds (memory-mapped), 
+		rendered and stored first if it is not stored
+		"""
+
+		for block in self.blocks(generator, time, block_size):
+			pass
+
+		path = self.get_path(self.get_key(generator, time))
+		return np.load(path, mmap_mode='r')
+
+	def evict(self, keep=None):
+		"""
+		Removes the least recently used files until all files take at most 
+		'budget' bytes, the file 'keep' is not removed
+		"""
+
+		files = sorted(
+			(os.path.getmtime(path), os.path.getsize(path), path)
+			for path in self.get_files()
+		)
+		size = sum(size for time, size, path in files)
+
+		for time, file_size, path in files:
+			if size <= self.budget:
+				break
+			if path == keep:
+				continue
+
+			os.remove(path)
+			size -= file_size
+			self.evictions += 1
+
+	def get_stats(self):
+		"""
+		Returns the statistics of the cache: numbers of hits, misses, 
+		evictions and stored signals and the size of the files (in bytes)
+		"""
+
+		files = self.get_files()
+		return {
+			'hits': self.hits,
+			'misses': self.misses,
+			'evictions': self.evictions,
+			'signals': len(files),
+			'size': sum(os.path.getsize(path) for path in files)
+		}
+
+	def clear(self):
+		"""Removes all stored signals"""
+
+		for path in self.get_files():
+			os.remove(path)
+
+
+if __name__ == '__main__':
+
+	#tests
+	import sys
+
+	from benchmark import danger_zone
+
+	mixer, kbd = danger_zone()
+	op3, op6 = mixer.inputs
+	op5 = op6.mixer.inputs[0]
+
+	cache = RenderCache()
+	time = 13.0
+
+	def edit_eg():
+		op3.set_eg_params(0.0, 0.4, 0.2, 0.3)
+
+	def edit_level():
+		mixer.set_level(1, 0.2)
+
+	def edit_modulator():
+		op5.set_eg_params(0.0, 0.2, 0.0, 0.05)
+
+	def edit_key():
+		kbd.key.set_attributes([1.0, 2.0], [3, 5])
+
+	#every render equals a render from scratch
+	for edit in [None, edit_eg, edit_level, edit_modulator, edit_key]:
+		if edit is not None:
+			edit()
+
+		output = cache.render(mixer, time)
+		whole = Stream().output(mixer, sample_times(0, sample_count(time)))
+
+		name = 'first' if edit is None else edit.__name__
+		print(name, np.array_equal(output, whole))
+		if not np.array_equal(output, whole):
+			sys.exit(1)
+
+	#a signal is taken from the disk after the first render
+	import tempfile
+
+	from oscillators import SineOscillator
+	from playback import Player, NullSink
+
+	with tempfile.TemporaryDirectory() as directory:
+		disk = DiskCache(directory)
+
+		#the key doesn't depend on renders or on the objects of the patch
+		key = disk.get_key(mixer, time)
+		copy, copy_kbd = danger_zone()
+		copy.inputs[0].set_eg_params(0.0, 0.4, 0.2, 0.3)
+		copy.set_level(1, 0.2)
+		copy.inputs[1].mixer.inputs[0].set_eg_params(0.0, 0.2, 0.0, 0.05)
+		copy_kbd.key.set_attributes([1.0, 2.0], [3, 5])
+		print('key', key == disk.get_key(copy, time))
+		if key != disk.get_key(copy, time):
+			sys.exit(1)
+
+		copy.set_level(1, 0.25)
+		print('edited key', key != disk.get_key(copy, time))
+		if key == disk.get_key(copy, time):
+			sys.exit(1)
+
+		#signals stored by another version of the code are not used
+		CACHE_VERSION += 1
+		print('version key', key != disk.get_key(mixer, time))
+		if key == disk.get_key(mixer, time):
+			sys.exit(1)
+		CACHE_VERSION -= 1
+
+		#functions are told apart by their names, a lambda has none
+		osc = SineOscillator(440.0)
+		osc.shape = np.sin
+		sine = disk.get_key(osc)
+		osc.shape = np.cos
+		named = sine != disk.get_key(osc)
+
+		osc.shape = lambda phase: phase
+		try:
+			disk.get_key(osc)
+			unnamed = False
+		except ValueError:
+			unnamed = True
+
+		print('functions', named, unnamed)
+		if not (named and unnamed):
+			sys.exit(1)
+
+		whole = Stream().output(mixer, sample_times(0, sample_count(time)))
+		first = disk.render(mixer, time)
+		second = disk.render(mixer, time)
+		print('disk', np.array_equal(first, whole), np.array_equal(second, whole))
+		if not (np.array_equal(first, whole) and np.array_equal(second, whole)):
+			sys.exit(1)
+
+		#a stored signal is played block by block
+		player = Player(mixer, time, 4096, sink=NullSink(None), cache=disk)
+		player.start()
+		player.wait()
+
+		#the least recently used signals are removed
+		disk.budget = 3*sample_count(1.0)*8 + 1024
+		oscillators = [SineOscillator(110.0*i) for i in range(1, 6)]
+		for osc in oscillators:
+			disk.render(osc, 1.0)
+		disk.render(oscillators[0], 1.0)
+		disk.render(oscillators[-1], 1.0)
+
+		stats = disk.get_stats()
+		print('stats', stats)
+		if (
+			(stats['hits'], stats['misses'], stats['signals']) != (3, 7, 3) or 
+			stats['size'] > disk.budget
+		):
+			sys.exit(1)
@@ -0,0 +1,564 @@
+import numpy as np
+
+from generators import Generator, Const, output_method, evaluate_active
+from generators import is_sparse, get_stamp
+from mixer import Mixer
+from amplifier import Amplifier
+from fm import FMOperator, DXGenerator, LinearFMGenerator
+from stream import get_subgraph
+
+def value(input):
+	"""Returns the value of a step's input in the current block"""
+
+	if isinstance(input, Step):
+		return input.value
+	else:
+		return input
+
+class Step():
+	"""
+	A mother class of steps of an execution plan
+
+	A step computes one value per block from the values of its 'inputs'
+	(steps computed earlier or constants)
+	"""
+
+	#'True' if the value is written to a preallocated buffer
+	buffered = False
+
+	def __init__(self, inputs=[]):
+		self.inputs = inputs	#steps (or constants) whose values are read
+		self.buffer = None		#index of the preallocated buffer
+		self.value = None		#value in the current block
+
+		#'True' if the step is computed by the step reading it
+		self.deferred = False
+
+	def get_modules(self):
+		"""Returns a list of modules whose outputs are read by the step"""
+		return []
+
+	def get_shape(self, t):
+		"""Returns the shape of the value for time buffer t"""
+		return np.broadcast_shapes(
+			t.shape, *(np.shape(value(input)) for input in self.inputs)
+		)
+
+	def run(self, t, stream, out=None):
+		"""
+		Returns the value for time buffer t, 'out' is the buffer it is written
+		to (if the step is buffered)
+		"""
+		return out
+
+	def run_active(self, t, stream, active):
+		"""
+		Returns the value for time buffer t, given that it is needed only
+		where 'active' is 'True' (see 'Generator.output_active')
+		"""
+		return self.run(t, stream)
+
+class ModuleStep(Step):
+	"""A step evaluating a module that isn't compiled (with its inputs)"""
+
+	def __init__(self, module):
+		Step.__init__(self)
+		self.module = module
+
+	def get_modules(self):
+		"""Returns a list of modules whose outputs are read by the step"""
+		return [self.module]
+
+	def run(self, t, stream, out=None):
+		"""Returns the value for time buffer t"""
+		return self.module.output(t, stream=stream)
+
+	def run_active(self, t, stream, active):
+		"""
+		Returns the value for time buffer t, given that it is needed only
+		where 'active' is 'True'
+		"""
+		return self.module.output_active(t, active, stream=stream)
+
+class SumStep(Step):
+	"""A step adding values multiplied by levels (a mixer)"""
+
+	buffered = True
+
+	def __init__(self, terms):
+		Step.__init__(self, [input for level, input in terms])
+		self.levels = [level for level, input in terms]
+
+	def run(self, t, stream, out=None):
+		"""Returns the value for time buffer t written to 'out'"""
+
+		#the terms are added in the same order as by the mixer
+		if self.levels[0] == 1.0:
+			np.copyto(out, value(self.inputs[0]))
+		else:
+			np.multiply(self.levels[0], value(self.inputs[0]), out=out)
+
+		for level, input in zip(self.levels[1:], self.inputs[1:]):
+			if level == 1.0:
+				np.add(out, value(input), out=out)
+			else:
+				np.add(out, level*value(input), out=out)
+
+		return out
+
+class ProductStep(Step):
+	"""A step multiplying a value by a modulator and a level (an amplifier)"""
+
+	buffered = True
+
+	def __init__(self, level, input, mod=None):
+		Step.__init__(self, [input] if mod is None else [mod, input])
+		self.level = level
+		self.input = input
+		self.mod = mod
+
+		#'True' if the input is computed by this step
+		self.gated = False
+
+	def defer_input(self):
+		"""
+		Makes the step compute its input only where the modulator isn't 0 (the
+		input has to be a step read only by this one)
+		"""
+
+		if isinstance(self.mod, Step) and type(self.input) in (
+			ModuleStep, CarrierStep, LinearFMStep
+		):
+			self.input.deferred = True
+			self.gated = True
+
+	def run(self, t, stream, out=None):
+		"""Returns the value for time buffer t written to 'out'"""
+
+		if self.mod is None:
+			return np.multiply(self.level, value(self.input), out=out)
+
+		mod = value(self.mod)
+
+		if self.gated:
+			#the input is needed only where the modulator isn't 0
+			active = np.not_equal(mod, 0.0)
+			if np.ndim(active) > np.ndim(t):
+				active = np.any(active, axis=0)
+
+			self.input.value = self.input.run_active(t, stream, active)
+
+		#the factors are multiplied in the same order as by the amplifier
+		np.multiply(mod, self.level, out=out)
+		return np.multiply(out, value(self.input), out=out)
+
+class CarrierStep(Step):
+	"""
+	A step evaluating the carrier of an FM generator, shifted by the value
+	of the modulator
+	"""
+
+	def __init__(self, generator, mod=None):
+		Step.__init__(self, [] if mod is None else [mod])
+		self.generator = generator
+		self.mod = mod		#value of the modulator ('None' means no modulator)
+
+	def get_modules(self):
+		"""Returns a list of modules whose outputs are read by the step"""
+		return [self.generator.carrier]
+
+	def get_shift(self, t, stream):
+		"""Returns the time by which the carrier is shifted"""
+
+		if self.mod is None:
+			return 0.0
+		else:
+			return value(self.mod) / self.generator.freq
+
+	def run(self, t, stream, out=None):
+		"""Returns the value for time buffer t"""
+		return self.generator.carrier.output(
+			t, shift=self.get_shift(t, stream), stream=stream
+		)
+
+	def run_active(self, t, stream, active):
+		"""
+		Returns the value for time buffer t, given that it is needed only
+		where 'active' is 'True' (the modulator is evaluated for all samples)
+		"""
+
+		carrier = self.generator.carrier
+		shift = self.get_shift(t, stream)
+
+		if not is_sparse(active) or not stream.is_pointwise(carrier):
+			return carrier.output(t, shift=shift, stream=stream)
+
+		return evaluate_active(
+			carrier.output, t, active, {'shift': shift}, stream=stream
+		)
+
+class LinearFMStep(CarrierStep):
+	"""
+	A step evaluating the carrier of a Linear FM generator, shifted by the
+	integral of the modulator
+	"""
+
+	def get_shift(self, t, stream):
+		"""Returns the time by which the carrier is shifted"""
+
+		if self.mod is None:
+			return 0.0
+
+		values = value(self.mod)
+		if type(values) != np.ndarray:
+			values = np.full(t.shape, values)
+
+		return self.generator.integrate_mod(values, stream)
+
+class Compiler():
+	"""
+	A class to represent a translation of a patch (the graph of modules
+	rooted at a generator) to a list of steps
+
+	Every module is compiled after the modules whose outputs it reads, so the
+	steps are topologically sorted. Mixers, amplifiers and FM operators are
+	replaced by steps computing their values directly, constant values
+	('Const', a mixer or an amplifier of constants) are computed once and
+	levels of 1.0 and mixers of a single input are dropped. Other modules are
+	evaluated by 'ModuleStep's. Inputs read only by an amplifier are computed
+	by its step, only where its modulator isn't 0 (as by 'Amplifier').
+	"""
+
+	def __init__(self):
+		self.steps = []		#compiled steps
+		self.values = {}	#values (steps or constants) of compiled modules
+
+	def add_step(self, step):
+		"""Adds a step and returns it"""
+		self.steps.append(step)
+		return step
+
+	def compile(self, module):
+		"""Returns the value (a step or a constant) of a module's output"""
+
+		#a module read by many modules is compiled once
+		try:
+			return self.values[module]
+		except KeyError:
+			pass
+
+		self.values[module] = self.fold(module)
+		return self.values[module]
+
+	def fold(self, module):
+		"""Compiles a module and returns its value"""
+
+		if type(module) == Const:
+			return module.value
+
+		elif type(module) == Mixer:
+			return self.fold_mixer(module)
+
+		elif type(module) == Amplifier:
+			return self.fold_amplifier(module)
+
+		#feedback is computed sample by sample by the module itself
+		elif type(module) == FMOperator and module.feedback == 0.0:
+			return self.compile(module.amp)
+
+		elif (
+			type(module) == DXGenerator and module.mod is not None and 
+			module.feedback == 0.0
+		):
+			return self.add_step(CarrierStep(module, self.compile(module.mod)))
+
+		elif type(module) == LinearFMGenerator:
+			mod = None if module.mod is None else self.compile(module.mod)
+			return self.add_step(LinearFMStep(module, mod))
+
+		else:
+			return self.add_step(ModuleStep(module))
+
+	def fold_mixer(self, mixer):
+		"""Compiles a mixer and returns its value"""
+
+		#levels set by generators are evaluated by the mixer itself
+		if any(isinstance(level, Generator) for level in mixer.levels):
+			return self.add_step(ModuleStep(mixer))
+
+		terms = [
+			(level, self.compile(input))
+			for level, input in zip(mixer.levels, mixer.inputs)
+		]
+
+		if terms == []:
+			return np.float64(0.0)
+
+		if all(not isinstance(input, Step) for level, input in terms):
+			output = terms[0][0]*terms[0][1]
+			for level, input in terms[1:]:
+				output = output + level*input
+
+			return np.float64(output)
+
+		if len(terms) == 1 and terms[0][0] == 1.0:
+			return terms[0][1]
+
+		return self.add_step(SumStep(terms))
+
+	def fold_amplifier(self, amp):
+		"""Compiles an amplifier and returns its value"""
+
+		input = self.compile(amp.input)
+		mod = None if amp.mod is None else self.compile(amp.mod)
+
+		if mod is None:
+			if amp.level == 1.0:
+				return input
+			elif not isinstance(input, Step):
+				return np.float64(amp.level*input)
+
+		elif not isinstance(input, Step) and not isinstance(mod, Step):
+			return np.float64(mod*amp.level*input)
+
+		return self.add_step(ProductStep(amp.level, input, mod))
+
+	def defer(self, root):
+		"""
+		Makes amplifiers compute their inputs that aren't read by other steps
+		(only where the amplifiers' modulators aren't 0)
+		"""
+
+		readers = {root: 1}		#number of steps reading every step
+		for step in self.steps:
+			for input in step.inputs:
+				if isinstance(input, Step):
+					readers[input] = readers.get(input, 0) + 1
+
+		for step in self.steps:
+			if type(step) == ProductStep and readers.get(step.input) == 1:
+				step.defer_input()
+
+	def allocate(self, root):
+		"""
+		Assigns buffers to buffered steps, a buffer is reused once the last
+		step reading its value is computed (the value of 'root' is written to
+		a new array every block, as it is returned)
+		"""
+
+		"""
+		the values read by every step, a deferred step reads its inputs when 
+		the amplifier reading it is computed
+		"""
+		reads = [list(step.inputs) for step in self.steps]
+		index = {}
+		for i, step in enumerate(self.steps):
+			index[step] = i
+			if type(step) == ProductStep and step.gated:
+				reads[i] += reads[index[step.input]]
+				reads[index[step.input]] = []
+
+		#index of the last step reading the value of every step
+		last = {}
+		for i in range(len(self.steps)):
+			for input in reads[i]:
+				last[input] = i
+
+		free = []		#buffers not used by any step
+		count = 0		#number of buffers
+
+		for i, step in enumerate(self.steps):
+			if step.buffered and step is not root:
+				if free == []:
+					free.append(count)
+					count += 1
+				step.buffer = free.pop()
+
+			#free buffers of the values read for the last time
+			for input in set(reads[i]):
+				if (
+					isinstance(input, Step) and input.buffer is not None and
+					last[input] == i
+				):
+					free.append(input.buffer)
+
+		return count
+
+class Plan(Generator):
+	"""
+	A class to represent a compiled patch - a static list of steps computed
+	one after another every block, with preallocated buffers
+
+	The plan is a snapshot of the patch (levels and constants are copied to
+	its steps), it is compiled again when any module of the patch has changed
+	since (see 'Generator.touch'). Modules keep their states in the stream,
+	as when the patch is rendered. Outputs for single moments or ignoring
+	modulation are given by the patch itself.
+	"""
+
+	#the plan computes the output of the patch
+	transient = Generator.transient + (
+		'root', 'steps', 'count', 'buffers', 'stamp'
+	)
+
+	def __init__(self, patch):
+		self.patch = patch				#compiled generator
+		self.build()
+
+	def build(self):
+		"""Compiles the patch"""
+
+		#the stamp of the patch when it is compiled (see 'get_stamp')
+		self.stamp = get_stamp(self.patch)
+
+		compiler = Compiler()
+		self.root = compiler.compile(self.patch)	#value of the output
+		self.steps = compiler.steps					#steps in order of computing
+
+		compiler.defer(self.root)
+		self.count = compiler.allocate(self.root)	#number of buffers
+
+		#buffers of every shape (voices of a keyboard may vary in number)
+		self.buffers = {}
+
+	def update(self):
+		"""Compiles the patch again if any of its modules has changed"""
+
+		if get_stamp(self.patch) != self.stamp:
+			self.build()
+
+	def get_inputs(self, ignore_mod=False):
+		"""Returns a list of modules whose outputs are read"""
+
+		if ignore_mod:
+			return [self.patch]
+
+		return [module for step in self.steps for module in step.get_modules()]
+
+	def get_sources(self):
+		"""
+		Returns a list of all modules the output depends on (the patch, as
+		the values of some of its modules are copied to the steps)
+		"""
+		return [self.patch]
+
+	def seek(self, start, stream):
+		"""
+		Sets the state of the module in 'stream' as if the samples before 
+		'start' were rendered (see 'Generator.seek')
+		"""
+
+		#the steps keep the states of the modules of the patch (eg. the
+		#integrals of Linear FM generators, which are not read as modules)
+		return all(
+			module.seek(start, stream) for module in get_subgraph(self.patch)
+		)
+
+	def get_buffer(self, step, shape):
+		"""Returns the buffer of a step for values of given shape"""
+
+		if step.buffer is None:
+			return np.empty(shape)
+
+		try:
+			return self.buffers[step.buffer, shape]
+		except KeyError:
+			self.buffers[step.buffer, shape] = np.empty(shape)
+			return self.buffers[step.buffer, shape]
+
+	@output_method
+	def output(self, t, **kwargs):
+		"""Returns the value of the patch's signal in time t"""
+
+		if (
+			type(t) != np.ndarray or kwargs.get('ignore_mod', False) or 
+			any(arg not in ('stream', 'ignore_mod') for arg in kwargs)
+		):
+			return self.patch.output(t, **kwargs)
+
+		stream = kwargs['stream']
+		self.update()
+
+		for step in self.steps:
+			if step.deferred:
+				continue
+
+			out = None
+			if step.buffered:
+				out = self.get_buffer(step, step.get_shape(t))
+
+			step.value = step.run(t, stream, out)
+
+		output = value(self.root)
+		for step in self.steps:
+			step.value = None
+
+		if type(output) != np.ndarray:
+			return np.full(t.shape, output)
+		else:
+			return output
+
+def compile(patch):
+	"""
+	Returns an execution plan of the patch (see 'Plan'), which gives the same
+	output as 'patch'
+	"""
+	return Plan(patch)
+
+
+if __name__ == '__main__':
+
+	#tests
+	import sys
+
+	from benchmark import danger_zone, render_speed
+	from stream import Stream
+
+	time = 13.0
+
+	for fm_type in ['DX', 'LinearFM']:
+		mixer, kbd = danger_zone(fm_type)
+		plan = compile(mixer)
+
+		for block_size in [256, 1000, 4096]:
+			interpreted = np.concatenate(list(mixer.blocks(time, block_size)))
+			compiled = np.concatenate(list(plan.blocks(time, block_size)))
+
+			print(
+				fm_type, block_size, len(plan.steps), plan.count,
+				np.array_equal(interpreted, compiled)
+			)
+			if not np.array_equal(interpreted, compiled):
+				sys.exit(1)
+
+	#a level and a constant changed after compiling are read by the plan
+	mixer, kbd = danger_zone()
+	level = Const(0.5)
+	amp = Amplifier(input=mixer, mod=level)
+	plan = compile(amp)
+
+	mixer.set_level(1, 0.3)
+	level.value = np.float64(2.0)
+	level.touch()
+
+	interpreted = np.concatenate(list(amp.blocks(time, 1000)))
+	compiled = np.concatenate(list(plan.blocks(time, 1000)))
+	print('changed', np.array_equal(interpreted, compiled))
+	if not np.array_equal(interpreted, compiled):
+		sys.exit(1)
+
+	#a change in the middle of a render is heard from the next block on
+	outputs = []
+	for patch in [amp, plan]:
+		mixer.set_level(1, 0.3)
+		stream = Stream(1000)
+		blocks = []
+		for i, block in enumerate(stream.render(patch, time)):
+			blocks.append(np.copy(block))
+			if i == 100:
+				mixer.set_level(1, 0.7)
+		outputs.append(np.concatenate(blocks))
+
+	print('changed while rendered', np.array_equal(*outputs))
+	if not np.array_equal(*outputs):
+		sys.exit(1)
@@ -0,0 +1,400 @@
+import numpy as np
+
+from oscillators import Oscillator
+from triggerables import ADSR
+from generators import Gate, output_method, find_active
+from keyboard import PolyKey, PolyGate
+from fm import run_feedback
+from stream import sample_times
+
+"""
+the algorithms of the Yamaha DX7, numbered as in its manual, every algorithm 
+is a list of connections '(modulator, carrier)' and the feedback connection 
+'(modulator, carrier)' (operators are numbered from 1 to 6 as on the DX7, 
+an operator with no carrier is heard)
+"""
+ALGORITHMS = {
+	1: ([(2, 1), (4, 3), (5, 4), (6, 5)], (6, 6)),
+	2: ([(2, 1), (4, 3), (5, 4), (6, 5)], (2, 2)),
+	3: ([(2, 1), (3, 2), (5, 4), (6, 5)], (6, 6)),
+	4: ([(2, 1), (3, 2), (5, 4), (6, 5)], (4, 6)),
+	5: ([(2, 1), (4, 3), (6, 5)], (6, 6)),
+	6: ([(2, 1), (4, 3), (6, 5)], (5, 6)),
+	7: ([(2, 1), (4, 3), (5, 3), (6, 5)], (6, 6)),
+	8: ([(2, 1), (4, 3), (5, 3), (6, 5)], (4, 4)),
+	9: ([(2, 1), (4, 3), (5, 3), (6, 5)], (2, 2)),
+	10: ([(2, 1), (3, 2), (5, 4), (6, 4)], (3, 3)),
+	11: ([(2, 1), (3, 2), (5, 4), (6, 4)], (6, 6)),
+	12: ([(2, 1), (4, 3), (5, 3), (6, 3)], (2, 2)),
+	13: ([(2, 1), (4, 3), (5, 3), (6, 3)], (6, 6)),
+	14: ([(2, 1), (4, 3), (5, 4), (6, 4)], (6, 6)),
+	15: ([(2, 1), (4, 3), (5, 4), (6, 4)], (2, 2)),
+	16: ([(2, 1), (3, 1), (4, 3), (5, 1), (6, 5)], (6, 6)),
+	17: ([(2, 1), (3, 1), (4, 3), (5, 1), (6, 5)], (2, 2)),
+	18: ([(2, 1), (3, 1), (4, 1), (5, 4), (6, 5)], (3, 3)),
+	19: ([(2, 1), (3, 2), (6, 4), (6, 5)], (6, 6)),
+	20: ([(3, 1), (3, 2), (5, 4), (6, 4)], (3, 3)),
+	21: ([(3, 1), (3, 2), (6, 4), (6, 5)], (3, 3)),
+	22: ([(2, 1), (6, 3), (6, 4), (6, 5)], (6, 6)),
+	23: ([(3, 2), (6, 4), (6, 5)], (6, 6)),
+	24: ([(6, 3), (6, 4), (6, 5)], (6, 6)),
+	25: ([(6, 4), (6, 5)], (6, 6)),
+	26: ([(3, 2), (5, 4), (6, 4)], (6, 6)),
+	27: ([(3, 2), (5, 4), (6, 4)], (3, 3)),
+	28: ([(2, 1), (4, 3), (5, 4)], (5, 5)),
+	29: ([(4, 3), (6, 5)], (6, 6)),
+	30: ([(4, 3), (5, 4)], (5, 5)),
+	31: ([(6, 5)], (6, 6)),
+	32: ([], (6, 6)),
+}
+
+def schedule(matrix, loop=[]):
+	"""
+	Returns the operators grouped in steps evaluated one after another, as 
+	pairs '(operators, looped)', the modulators of the operators of a step 
+	('matrix[i, j]' is not 0 if the j-th operator modulates the i-th one) 
+	are evaluated in the previous steps
+
+	The operators of a feedback 'loop' are one step ('looped' is 'True'), 
+	they are evaluated sample by sample
+	"""
+
+	steps = []
+	done = set()
+	while len(done) < len(matrix):
+
+		#operators whose modulators are evaluated (or are in the same loop)
+		ready = [
+			i for i in range(len(matrix)) if i not in done and all(
+				j in done or (i in loop and j in loop) 
+				for j in np.flatnonzero(matrix[i])
+			)
+		]
+
+		layer = [i for i in ready if i not in loop]
+		if layer != []:
+			steps.append((np.array(layer), False))
+
+		if loop != [] and all(i in ready for i in loop):
+			steps.append((np.array(loop), True))
+			ready += loop
+
+		done.update(ready)
+
+	return steps
+
+class DX6Voice(Oscillator):
+	"""
+	A class to represent a voice of 6 FM operators connected according to 
+	one of the 32 algorithms of the Yamaha DX7
+
+	The operators are the same as 'FMOperator's of 'DX' type with sine 
+	carriers, wired as in the algorithm, with the carriers summed up, but 
+	they are evaluated together, as rows of 2D arrays (a layer of operators 
+	whose modulators are known at a time)
+	"""
+
+	def __init__(
+		self, algorithm=1, freq=440.0, ratios=[1.0]*6, levels=[1.0]*6,
+		feedback=0.0, volume=1.0, gate=Gate([0.0]), key_in=None
+	):
+		Oscillator.__init__(self, key_in)
+
+		self.freq = freq					#basic frequency
+		self.ratios = np.array(ratios, dtype=np.float64)	#frequency ratios
+		self.levels = np.array(levels, dtype=np.float64)	#amplitudes
+
+		#amount of the modulation of an operator by its own output
+		self.feedback = feedback
+		self.volume = volume				#level of the carriers' sum
+
+		#envelope generators of the operators
+		self.egs = [ADSR(input=gate) for i in range(6)]
+
+		self.set_algorithm(algorithm)
+
+	def set_algorithm(self, algorithm):
+		"""Sets the algorithm (a number from 1 to 32)"""
+
+		if algorithm not in ALGORITHMS:
+			raise ValueError(
+				"'algorithm' should be a number from 1 to 32, not %r" % (
+					algorithm,
+				)
+			)
+
+		self.algorithm = algorithm
+		connections, (source, target) = ALGORITHMS[algorithm]
+
+		#'matrix[i, j]' is 1 if the j-th operator modulates the i-th one
+		self.matrix = np.zeros((6, 6))
+		for mod, carrier in connections:
+			self.matrix[carrier - 1, mod - 1] = 1.0
+
+		#the carriers are the operators that modulate no other operator
+		self.carriers = np.flatnonzero(~self.matrix.any(axis=0))
+
+		#operators from the one modulated by feedback to the one fed back
+		self.loop = [target - 1]
+		while self.loop[-1] != source - 1:
+			self.loop.append(np.flatnonzero(self.matrix[:, self.loop[-1]])[0])
+
+		#steps of evaluation without and with feedback
+		self.steps = schedule(self.matrix)
+		self.feedback_steps = schedule(self.matrix, self.loop)
+
+		self.touch()
+
+	def set_ratio(self, op, ratio):
+		"""Sets the frequency ratio of the 'op'-th operator (from 1 to 6)"""
+		self.ratios[op - 1] = ratio
+		self.touch()
+
+	def set_level(self, op, level):
+		"""Sets the amplitude of the 'op'-th operator (from 1 to 6)"""
+		self.levels[op - 1] = level
+		self.touch()
+
+	def set_feedback(self, feedback):
+		"""Sets the amount of feedback"""
+		self.feedback = feedback
+		self.touch()
+
+	def set_eg_params(self, op, *args, **kwargs):
+		"""Sets parameters of the envelope of the 'op'-th operator"""
+		self.egs[op - 1].set_params(*args, **kwargs)
+		self.touch()
+
+	def set_gate(self, gate):
+		"""Sets the gate input"""
+		for eg in self.egs:
+			eg.set_input(gate)
+
+		self.touch()
+
+	def set_keyboard(self, keyboard):
+		"""sets key and gate input from a keybord"""
+		self.set_key_in(keyboard.key)
+		self.set_gate(keyboard.gate)
+		self.touch()
+
+	def get_inputs(self, ignore_mod=False):
+		"""Returns a list of modules whose outputs are read"""
+
+		if ignore_mod:
+			return []
+
+		return Oscillator.get_inputs(self) + self.egs
+
+	def is_pointwise(self, stream=None):
+		"""Returns 'True' if the output can be evaluated for any samples"""
+
+		#feedback is computed sample by sample
+		if self.feedback != 0.0:
+			return False
+
+		return Oscillator.is_pointwise(self, stream)
+
+	def seek(self, start, stream):
+		"""
+		Sets the state of the module in 'stream' as if the samples before 
+		'start' were rendered (see 'Generator.seek')
+		"""
+
+		if self.feedback == 0.0 or start == 0:
+			return Oscillator.seek(self, start, stream)
+
+		"""
+		the values fed back are the last 2 outputs of the feedback loop, they 
+		are 0 if the envelopes of its operators are, otherwise they depend on 
+		all the previous samples
+		"""
+		t = sample_times(max(start - 2, 0), start)
+		for ops, looped in self.feedback_steps:
+			if not looped:
+				continue
+
+			for i in ops:
+				if not self.egs[i].is_pointwise():
+					return False
+
+				env = self.egs[i].output(t)
+				if np.ndim(env) == 2 or (self.levels[i]*env).any():
+					return False
+
+		stream.set_state(self, (0.0, 0.0))
+		return Oscillator.seek(self, start, stream)
+
+	def get_active(self, t, ignore_mod=False, **kwargs):
+		"""
+		Returns a boolean array telling where in time t the output may be 
+		non-zero ('None' if it is not known)
+		"""
+
+		if type(t) != np.ndarray or ignore_mod:
+			return None
+
+		#only the carriers are heard
+		active = self.get_buffer(t, 'active', bool, kwargs.get('stream'))
+		active.fill(False)
+		for i in self.carriers:
+			eg_active = find_active(self.egs[i], t, **kwargs)
+			if eg_active is None:
+				return None
+
+			active |= eg_active
+
+		return active
+
+	def get_shape(self, t, stream=None):
+		"""
+		Returns the shape of the operators' outputs in time t (voices of a 
+		polyphonic keyboard are the first axis)
+		"""
+
+		if type(self.key_in) == PolyKey:
+			return (len(self.key_in.get_keys(stream)),) + t.shape
+		elif type(self.egs[0].input) == PolyGate:
+			return (len(self.egs[0].input.get_gates(stream)),) + t.shape
+		else:
+			return t.shape
+
+	@output_method
+	def output(self, t, ignore_mod=False, stream=None, **kwargs):
+		"""Returns the value of the voice's signal in time t"""
+
+		if type(t) != np.ndarray:
+			return self.output(
+				np.array([t], dtype=np.float64), ignore_mod=ignore_mod,
+				**kwargs
+			)[..., 0]
+
+		shape = self.get_shape(t, stream)
+
+		#the phases (in cycles) of unmodulated operators
+		phases = self.get_buffer(t, 'phases', stream=stream, shape=(6,) + shape)
+		freqs = (self.freq*self.ratios).reshape((6,) + (1,)*len(shape))
+		if ignore_mod or self.key_in is None:
+			key_mod = 1.0
+			np.multiply(freqs, t, out=phases)
+		else:
+			key_mod = self.get_key_mod(t, out=self.get_buffer(
+				t, 'key', stream=stream
+			), stream=stream, **kwargs)
+			np.multiply(freqs, self.key_in.key_mod_integral(
+				t, out=self.get_buffer(t, 'integral', stream=stream),
+				stream=stream, **kwargs
+			), out=phases)
+
+		#envelopes of the operators
+		envs = self.get_buffer(t, 'envs', stream=stream, shape=(6,) + shape)
+		for i, eg in enumerate(self.egs):
+			if ignore_mod:
+				envs[i] = 1.0
+				continue
+
+			env = eg.output(t, out=envs[i], stream=stream, **kwargs)
+			if env is not envs[i]:
+				envs[i] = env
+
+		#operators that are silent in the whole block aren't evaluated
+		audible = envs.reshape(6, -1).any(axis=1)
+
+		#outputs of the operators, 'flat' has one row per operator
+		outputs = self.get_buffer(
+			t, 'outputs', stream=stream, shape=(6,) + shape
+		)
+		outputs.fill(0.0)
+		flat = outputs.reshape(6, -1)
+
+		if self.feedback == 0.0:
+			steps = self.steps
+		else:
+			steps = self.feedback_steps
+
+		for ops, looped in steps:
+			#a silent feedback loop is skipped by 'run_feedback'
+			if not looped:
+				ops = ops[audible[ops]]
+
+			if len(ops) == 0:
+				continue
+
+			#the phase shift is 'key_mod' times the sum of the modulators
+			phase = phases[ops]
+			if self.matrix[ops].any():
+				mod = np.matmul(self.matrix[ops], flat).reshape(phase.shape)
+				phase += np.multiply(key_mod, mod, out=mod)
+
+			if looped:
+				outputs[ops] = run_feedback(
+					self, phase, key_mod, envs[ops], self.levels[ops], 
+					self.feedback, stream
+				)
+				continue
+
+			value = np.sin(np.multiply(2*np.pi, phase, out=phase), out=phase)
+			value *= self.levels[ops].reshape((-1,) + (1,)*len(shape))
+			outputs[ops] = np.multiply(value, envs[ops], out=value)
+
+		#the sum of the carriers
+		weights = np.zeros(6)
+		weights[self.carriers] = self.volume
+		return np.matmul(weights, flat).reshape(shape)
+
+
+if __name__ == '__main__':
+
+	#tests
+	import sys
+
+	from fm import FMOperator
+	from mixer import Mixer
+	from keyboard import MonoKeyboard
+
+	random = np.random.default_rng(0)
+	time = 1.5
+
+	#every algorithm gives the same output as the operators wired by hand
+	for algorithm in ALGORITHMS:
+		ratios = random.choice([0.5, 1.0, 1.0003, 2.0, 3.0, 6.9978], 6)
+		levels = random.uniform(0.2, 1.5, 6)
+		params = random.uniform(0.0, [0.05, 0.3, 1.0, 0.2], (6, 4))
+
+		kbd = MonoKeyboard(
+			gate=Gate([0.05, 0.3, 0.4, 0.7, 0.75, 1.1]), pitches=[0, 7, -5]
+		)
+
+		voice = DX6Voice(algorithm, 220.0, ratios, levels, volume=0.25)
+		voice.set_keyboard(kbd)
+
+		ops = [FMOperator(220.0*ratios[i], levels[i]) for i in range(6)]
+		for mod, carrier in ALGORITHMS[algorithm][0]:
+			ops[carrier - 1].add_modulator(ops[mod - 1])
+
+		mixer = Mixer()
+		for i in voice.carriers:
+			mixer.add_input(ops[i], 0.25)
+
+		for i, op in enumerate(ops):
+			voice.set_eg_params(i + 1, *params[i])
+			op.set_eg_params(*params[i])
+			op.set_keyboard(kbd)
+
+		#an operator modulating itself has feedback as an 'FMOperator' too
+		source, target = ALGORITHMS[algorithm][1]
+		for feedback in [0.0, 0.2] if source == target else [0.0]:
+			voice.set_feedback(feedback)
+			ops[source - 1].set_feedback(feedback)
+
+			difference = np.max(np.abs(
+				np.concatenate(list(voice.blocks(time, 1000))) - 
+				np.concatenate(list(mixer.blocks(time, 1000)))
+			))
+
+			print(
+				algorithm, voice.carriers + 1, feedback, difference, 
+				difference < 1e-9
+			)
+			if not difference < 1e-9:
+				sys.exit(1)
@@ -1,21 +1,140 @@
+import math
+
 import numpy as np
-import sounddevice as sd
 
 import constants as const
 import math_func as mf
 
 from oscillators import Oscillator, SineOscillator, SquareOscillator
+from oscillators import WavetableOscillator
 from mixer import Mixer
 from triggerables import ADSR
 from amplifier import Amplifier
-from generators import Gate
+from generators import Gate, output_method, evaluate_active, find_active
+from generators import output_audible, is_sparse, get_stamp, DENSITY
+from stream import Stream, sample_times, fit
+
+def feedback_loop(phases, mods, amps, feedback, state=(0.0, 0.0)):
+	"""
+	Returns the values of a chain of sine waves ('amps*sin(phases)', phases 
+	in radians, a row for each wave), every wave shifting the phase of the 
+	next one by 'mods' times its value and the last one shifting the phase 
+	of the first one by 'mods' times 'feedback' times the average of its last 
+	2 values ('state' are the values before the first sample), and the state 
+	at the end
+
+	Every sample depends on the previous ones, so the samples are computed 
+	one by one, on Python floats (several times faster than on numpy scalars)
+	"""
+
+	sin = math.sin
+	last, before = state
+	feedbacks = np.multiply(0.5*feedback, mods).tolist()
+
+	if len(phases) == 1:
+		#a single wave modulating itself
+		output = []
+		for phase, shift, amp in zip(
+			phases[0].tolist(), feedbacks, amps[0].tolist()
+		):
+			before, last = last, amp*sin(phase + shift*(last + before))
+			output.append(last)
+
+		return np.array([output]), (last, before)
+
+	phases = [row.tolist() for row in phases]
+	amps = [row.tolist() for row in amps]
+	mods = mods.tolist()
+	outputs = [[] for row in phases]
+
+	for n in range(len(mods)):
+		shift = feedbacks[n]*(last + before)
+		for j in range(len(phases)):
+			value = amps[j][n]*sin(phases[j][n] + shift)
+			outputs[j].append(value)
+			shift = mods[n]*value
+
+		before, last = last, value
+
+	return np.array(outputs), (last, before)
+
+def get_feedback_states(owner, shape, stream=None):
+	"""
+	Returns the states of the feedback loops of 'owner' (see 'feedback_loop') 
+	at the beginning of the current block of 'stream', one for every voice if 
+	the loops' outputs are 2D (of given 'shape')
+	"""
+
+	count = shape[0] if len(shape) == 2 else 1
+	if stream is None:
+		return [(0.0, 0.0)]*count
+	elif len(shape) == 2:
+		return stream.get_voice_states(owner, count, (0.0, 0.0))
+	else:
+		return [stream.get_state(owner, (0.0, 0.0))]
+
+def set_feedback_states(owner, shape, states, stream=None):
+	"""
+	Sets the states of the feedback loops of 'owner' at the end of the current 
+	block of 'stream' (see 'get_feedback_states')
+	"""
+
+	if stream is None:
+		return
+	elif len(shape) == 2:
+		stream.set_voice_states(owner, shape[0], states)
+	else:
+		stream.set_state(owner, states[0])
+
+def run_feedback(owner, phases, key_mod, envs, levels, feedback, stream=None):
+	"""
+	Returns the outputs of a chain of sine operators with feedback (see 
+	'feedback_loop'), rows of 'phases' (in cycles, modulated by operators 
+	outside the chain), 'envs' and 'levels', the phase shift of a modulation 
+	is 'key_mod' times its value
+
+	Voices of a polyphonic keyboard (the second axis) are looped one by one, 
+	the states of the loops are kept by 'owner' in 'stream'
+	"""
+
+	shape = np.broadcast_shapes(
+		np.shape(phases)[1:], np.shape(key_mod), np.shape(envs)[1:]
+	)
+	count = len(phases)
+
+	#the values of the waves in radians
+	amps = np.reshape(levels, (count,) + (1,)*len(shape))*envs
+	amps = np.broadcast_to(amps, (count,) + shape)
+	phases = np.broadcast_to(2*np.pi*phases, (count,) + shape)
+	mods = np.broadcast_to(2*np.pi*key_mod, shape)
+
+	states = get_feedback_states(owner, shape, stream)
+	outputs = np.zeros((count,) + shape)
+
+	for i in range(len(states)):
+		voice = (slice(None),) if len(shape) == 1 else (slice(None), i)
+
+		#a silent loop isn't evaluated, the values fed back are 0 then
+		if not amps[voice].any():
+			states[i] = (0.0, 0.0)
+			continue
+
+		outputs[voice], states[i] = feedback_loop(
+			phases[voice], mods[voice[1:]], amps[voice], feedback, states[i]
+		)
+
+	set_feedback_states(owner, shape, states, stream)
+	return outputs
 
 class LinearFMGenerator(Oscillator):
 	"""A class to represent a sound generator with Linear FM"""
 
+	#the integral of scalar times is carried from call to call
+	transient = Oscillator.transient + ('integrator', 'integral', 'stamp')
+
 	def __init__(
 		self, freq=440.0, level=1.0, phase=0.0, type='sine', mod=None, 
-		key_in=None
+		key_in=None, table=None
 	):
 		#initialize essential parameters
 		Oscillator.__init__(self, key_in)
@@ -26,20 +145,41 @@ class LinearFMGenerator(Oscillator):
 		
 		self.mod = mod				#modulator
 
+		#integral of the modulator's output for scalar times
+		self.integrator = mf.Integrator(1.0 / const.fs)
+		self.integral = 0.0			#its value at the last integrated sample
+		self.stamp = None			#stamp of the integrated modulator
+
 		#initialize operators carrier generator
 		if type == 'sine':
-			self.carrier = SineOscillator(freq, level, phase, key_in)
+			#a sine carrier can look its wave up in a wavetable
+			self.carrier = SineOscillator(freq, level, phase, key_in, table)
 		elif type == 'square':
 			self.carrier = SquareOscillator(freq, level, phase, key_in)
+		elif type == 'table':
+			self.carrier = WavetableOscillator(
+				table, freq, level, phase, key_in
+			)
 		#there will be other types in the future
 
 	def set_modulator(self, mod):
 		"""Adds a modulator"""
 		self.mod = mod
+		self.integrator.set_state()
+		self.touch()
 
 	def set_key_in(self, key_in):
 		self.key_in = key_in
 		self.carrier.set_key_in(key_in)
+		self.touch()
+
+	def get_inputs(self, ignore_mod=False):
+		"""Returns a list of modules whose outputs are read"""
+
+		if self.mod is None:
+			return [self.carrier]
+		else:
+			return [self.mod, self.carrier]
 
 	def mod_int(self, t, **kwargs):
 		"""
@@ -52,22 +192,171 @@ class LinearFMGenerator(Oscillator):
 			return 0.0
 		else:
 			if type(t) == np.ndarray:
-				return mf.integrate(self.mod.output(t, **kwargs), 1.0 / const.fs)
+				#the modulator is evaluated only if it isn't silent
+				values = output_audible(self.mod, t, out=self.get_buffer(
+					t, 'mod', stream=kwargs.get('stream')
+				), **kwargs)
+
+				return self.integrate_mod(values, kwargs.get('stream'))
+
 			else:
-				if t == 0:
-					return 0.0
-				else:
-					return ((
-							self.mod.output(t, **kwargs) + 
-							self.mod.output(t - 1.0 / const.fs, **kwargs)
-						) / 2*const.fs + 
-						self.mod_int(t - (1.0 / const.fs), **kwargs)
-					)
-
-	def output(self, t, **kwargs):
+				return self.mod_int_at(int(round(t*const.fs)), **kwargs)
+
+	def integrate_mod(self, values, stream=None):
+		"""
+		Returns the integral of the modulator's outputs 'values' (sampled at 
+		'const.fs'), continuing the integral of the previous blocks of 
+		'stream'
+		"""
+
+		if stream is None:
+			return mf.integrate(values, 1.0 / const.fs)
+
+		if np.ndim(values) == 2:
+			return self.voice_mod_int(values, stream)
+
+		#continue the integral of the previous blocks
+		integrator = mf.Integrator(1.0 / const.fs, stream.get_state(self))
+		integral = integrator.integrate(values)
+		stream.set_state(self, integrator.get_state())
+
+		return integral
+
+	def voice_mod_int(self, values, stream):
+		"""
+		Returns the integrals of the modulator's outputs 'values' of the voices 
+		of a polyphonic keyboard (rows), continuing the integrals of the 
+		previous blocks
+		"""
+
+		states = stream.get_voice_states(self, len(values), (0.0, None, 0))
+
+		"""
+		a voice that didn't sound in the previous blocks had the modulator's 
+		output 0 there, unless the blocks begin with it
+		"""
+		first = values[:, 0] if stream.start == 0 else np.zeros(len(values))
+
+		integrator = mf.Integrator(1.0 / const.fs, (
+			np.array([state[0] for state in states]),
+			np.array([
+				first[i] if state[1] is None else state[1] 
+				for i, state in enumerate(states)
+			]),
+			np.array([state[2] for state in states])
+		))
+		integral = integrator.integrate(values)
+
+		total, first, count = integrator.get_state()
+		stream.set_voice_states(
+			self, len(values), list(zip(total, first, count))
+		)
+
+		return integral
+
+	def mod_int_at(self, n, **kwargs):
+		"""
+		Returns the integral of the modulator's output from the first sample 
+		to the n-th one
+
+		The integral is carried from the previous call, so that when the 
+		samples are requested in ascending order, every sample of the 
+		modulator is evaluated only once (until the modulator changes, see 
+		'get_stamp')
+		"""
+
+		if n < 0:
+			return 0.0
+
+		#index of the last integrated sample
+		last = self.integrator.count - 1
+
+		#a changed modulator (or its modulators) is integrated again
+		stamp = get_stamp(self.mod)
+		if stamp != self.stamp:
+			self.stamp = stamp
+			self.integrator.set_state()
+			last = -1
+
+		if n < last:
+			#integrate from the beginning
+			self.integrator.set_state()
+			last = -1
+
+		if n == last + 1:
+			self.integral = self.integrator.step(
+				self.mod.output(n / np.float64(const.fs), **kwargs)
+			)
+		elif n > last:
+			self.integral = self.integrator.integrate(self.mod.output(
+				sample_times(last + 1, n + 1), **kwargs
+			))[-1]
+
+		return self.integral
+
+	def is_pointwise(self, stream=None):
+		"""Returns 'True' if the output can be evaluated for any samples"""
+
+		#the modulator is integrated sample by sample
+		return False
+
+	def seek(self, start, stream):
+		"""
+		Sets the state of the module in 'stream' as if the samples before 
+		'start' were rendered (see 'Generator.seek')
+		"""
+
+		if self.mod is None or start == 0:
+			return True
+
+		"""
+		the integral is continued from the sum of the modulator's outputs 
+		before 'start', they are rendered (the carrier is not) and added in 
+		the same order as in a render from the first sample, any other sum 
+		would differ in the last bits
+		"""
+		integrator = mf.Integrator(1.0 / const.fs)
+		for values in Stream(stream.block_size).render_samples(
+			self.mod, 0, start
+		):
+			#the integrals of the voices depend on which of them sounded
+			if np.ndim(values) == 2:
+				return False
+
+			integrator.integrate(values)
+
+		stream.set_state(self, integrator.get_state())
+		return True
+
+	@output_method
+	def output(self, t, out=None, **kwargs):
 		"""Returns the value of operators signal in time t"""
 		
-		return self.carrier.output(t + self.mod_int(t, **kwargs), **kwargs)
+		return self.carrier.output(
+			t, shift=self.mod_int(t, **kwargs), out=out, **kwargs
+		)
+
+	def output_active(self, t, active, density=DENSITY, out=None, **kwargs):
+		"""
+		Returns the value of operators signal in time t, given that it is 
+		needed only where 'active' is 'True' (it is 0 elsewhere)
+
+		The modulator is integrated over all samples, the carrier is evaluated 
+		only for the active ones (see 'Generator.output_active')
+		"""
+
+		if (
+			type(t) != np.ndarray or active is None or 
+			any(arg not in ('stream', 'ignore_mod') for arg in kwargs) or 
+			kwargs.get('stream') is None or not is_sparse(active, density) or 
+			not kwargs['stream'].is_pointwise(self.carrier)
+		):
+			return self.output(t, out=out, **kwargs)
+
+		return evaluate_active(
+			self.carrier.output, t, active, 
+			{'shift': self.mod_int(t, **kwargs)}, out, **kwargs
+		)
 
 class DXGenerator(LinearFMGenerator):
 	"""
@@ -75,21 +364,112 @@ class DXGenerator(LinearFMGenerator):
 	synthesizer series
 	"""
 
-	def output(self, t, **kwargs):
-		"""Returns the value of operators signal in time t"""
-		
-		return self.carrier.output(
-			t + self.mod.output(t, **kwargs) / self.freq, 
-			**kwargs
+	def __init__(
+		self, freq=440.0, level=1.0, phase=0.0, type='sine', mod=None, 
+		key_in=None, table=None, feedback=0.0
+	):
+		LinearFMGenerator.__init__(
+			self, freq, level, phase, type, mod, key_in, table
 		)
 
+		self.feedback = 0.0			#amount of modulation by its own output
+		self.set_feedback(feedback)
+
+	def set_feedback(self, feedback):
+		"""
+		Sets the amount by which the generator modulates itself (the average 
+		of its last 2 output samples is fed back, as on the DX7)
+		"""
+
+		if feedback != 0.0 and type(self.carrier) != SineOscillator:
+			raise ValueError('feedback needs a sine carrier')
+
+		self.feedback = feedback
+
+		self.touch()
+
+	def is_pointwise(self, stream=None):
+		"""Returns 'True' if the output can be evaluated for any samples"""
+
+		#feedback is computed sample by sample
+		if self.feedback != 0.0:
+			return False
+
+		return Oscillator.is_pointwise(self, stream)
+
+	def seek(self, start, stream):
+		"""
+		Sets the state of the module in 'stream' as if the samples before 
+		'start' were rendered (see 'Generator.seek')
+		"""
+
+		#the values fed back depend on all the previous samples
+		if self.feedback != 0.0 and start > 0:
+			return False
+
+		#the modulator is not integrated
+		return Oscillator.seek(self, start, stream)
+
+	def output_active(self, t, active, density=DENSITY, out=None, **kwargs):
+		"""
+		Returns the value of operators signal in time t, given that it is 
+		needed only where 'active' is 'True' (it is 0 elsewhere)
+		"""
+		return Oscillator.output_active(
+			self, t, active, density, out, **kwargs
+		)
+
+	@output_method
+	def output(self, t, out=None, **kwargs):
+		"""Returns the value of operators signal in time t"""
+
+		if self.feedback != 0.0:
+			return self.feedback_output(t, self.feedback, **kwargs)
+
+		#the modulator is evaluated only if it isn't silent
+		buffer = self.get_buffer(t, 'mod', stream=kwargs.get('stream'))
+		mod_out = output_audible(self.mod, t, out=buffer, **kwargs)
+		shift = np.divide(mod_out, self.freq, out=fit(buffer, mod_out))
+
+		return self.carrier.output(t, shift=shift, out=out, **kwargs)
+
+	def feedback_output(self, t, feedback, env=1.0, owner=None, **kwargs):
+		"""
+		Returns the value of operators signal in time t multiplied by 'env', 
+		modulated by itself 'feedback' times (see 'set_feedback'), the state of 
+		the feedback is kept by 'owner' (the generator by default)
+		"""
+
+		if type(t) != np.ndarray:
+			return self.feedback_output(
+				np.array([t], dtype=np.float64), feedback, env, owner, 
+				**kwargs
+			)[..., 0]
+
+		if owner is None:
+			owner = self
+
+		#the phase without the modulation, shifted by the modulator
+		phase = self.carrier.get_phase(t, **kwargs)
+		key_mod = self.carrier.get_key_mod(t, **kwargs)
+		if self.mod is not None:
+			mod_out = output_audible(self.mod, t, **kwargs)
+			phase = phase + key_mod*mod_out
+
+		phase = phase + self.carrier.phase / (2*np.pi)
+
+		return run_feedback(
+			owner, np.expand_dims(phase, 0), key_mod, np.expand_dims(env, 0), 
+			[self.carrier.amp], feedback, kwargs.get('stream')
+		)[0]
+
 
 class FMOperator(Oscillator):
 	"""A class to represent an FM operator"""
 
 	def __init__(
 		self, freq=440.0, level=1.0, phase=0.0, feedback=0, wave_type='sine', 
-		fm_type='DX', gate=Gate([0.0]), key_in=None
+		fm_type='DX', gate=Gate([0.0]), key_in=None, table=None
 	):
 		Oscillator.__init__(self, key_in)
 
@@ -100,11 +480,11 @@ class FMOperator(Oscillator):
 		#sound generator
 		if fm_type == 'LinearFM':			
 			self.generator = LinearFMGenerator(
-				freq, level, phase, wave_type, self.mixer, key_in
+				freq, level, phase, wave_type, self.mixer, key_in, table
 			)
 		elif fm_type == 'DX':
 			self.generator = DXGenerator(
-				freq, level, phase, wave_type, self.mixer, key_in
+				freq, level, phase, wave_type, self.mixer, key_in, table
 			)
 
 		self.eg = ADSR(input=gate)		#envelope generator
@@ -112,31 +492,118 @@ class FMOperator(Oscillator):
 		#amplifier
 		self.amp = Amplifier(input=self.generator, mod=self.eg)
 
+		self.feedback = 0.0				#amount of modulation by its output
+		self.set_feedback(feedback)
+
 	def add_modulator(self, mod, level=1.0):
 		"""Adds a modulator"""
 		self.mixer.add_input(mod, level)
+		self.touch()
 
 	def set_key_in(self, key_in):
 		"""Sets key input"""
 		self.key_in = key_in
 		self.generator.set_key_in(key_in)
+		self.touch()
+
+	def set_feedback(self, feedback):
+		"""
+		Sets the amount by which the operator modulates itself (the average of 
+		its last 2 output samples, after the envelope, is fed back as on the 
+		DX7), only operators of 'DX' type with a sine carrier have feedback
+		"""
+
+		if feedback != 0.0 and (
+			type(self.generator) != DXGenerator or 
+			type(self.generator.carrier) != SineOscillator
+		):
+			raise ValueError(
+				"feedback needs an operator of 'DX' type with a sine carrier"
+			)
+
+		self.feedback = feedback
+
+		self.touch()
+
+	def set_table(self, table):
+		"""Sets a wavetable looked up by the carrier instead of 'np.sin'"""
+		self.generator.carrier.set_table(table)
+		self.touch()
 
 	def set_eg_params(self, *args, **kwargs):
 		"""Sets parameters of the envelope"""
 		self.eg.set_params(*args, **kwargs)
+		self.touch()
 
 	def set_gate(self, gate):
 		"""Sets the gate input"""
 		self.eg.set_input(gate)
+		self.touch()
 
 	def set_keyboard(self, keyboard):
 		"""sets key and gate input from a keybord"""
 		self.set_key_in(keyboard.key)
 		self.set_gate(keyboard.gate)
+		self.touch()
+
+	def get_inputs(self, ignore_mod=False):
+		"""Returns a list of modules whose outputs are read"""
+		return [self.amp]
 
-	def output(self, t, **kwargs):
+	def is_pointwise(self, stream=None):
+		"""Returns 'True' if the output can be evaluated for any samples"""
+
+		#feedback is computed sample by sample
+		if self.feedback != 0.0:
+			return False
+
+		return Oscillator.is_pointwise(self, stream)
+
+	def seek(self, start, stream):
+		"""
+		Sets the state of the module in 'stream' as if the samples before 
+		'start' were rendered (see 'Generator.seek')
+		"""
+
+		if self.feedback == 0.0 or start == 0:
+			return True
+
+		"""
+		the values fed back are the last 2 outputs, they are 0 if the envelope 
+		is, otherwise they depend on all the previous samples
+		"""
+		if not self.eg.is_pointwise():
+			return False
+
+		env = self.eg.output(sample_times(max(start - 2, 0), start))
+		if np.ndim(env) == 2 or (self.amp.level*env).any():
+			return False
+
+		stream.set_state(self, (0.0, 0.0))
+		return True
+
+	def get_active(self, t, **kwargs):
+		"""
+		Returns a boolean array telling where in time t the output may be 
+		non-zero ('None' if it is not known)
+		"""
+		return find_active(self.amp, t, **kwargs)
+
+	@output_method
+	def output(self, t, out=None, ignore_mod=False, **kwargs):
 		"""Returns the value of operators signal in time t"""
-		return self.amp.output(t, **kwargs)
+
+		if self.feedback == 0.0:
+			return self.amp.output(t, out=out, ignore_mod=ignore_mod, **kwargs)
+
+		#the output after the envelope is fed back
+		env = self.amp.level
+		if not ignore_mod:
+			env = env*self.eg.output(t, **kwargs)
+
+		return self.generator.feedback_output(
+			t, self.feedback, env, self, ignore_mod=ignore_mod, **kwargs
+		)
 
 	def draw(self, ax, time=None, cycles=1, **kwargs):
 		"""
@@ -1,22 +1,340 @@
+import inspect
+import itertools
+
 import numpy as np
-import sounddevice as sd
+
+try:
+	import sounddevice as sd
+except (ImportError, OSError):
+	#no PortAudio (eg. on a headless machine), only simulated sinks will work
+	sd = None
 
 import constants as const
+from stream import Stream, sample_count, sample_times, to_buffer, fit
+
+def output_method(output):
+	"""
+	Decorates the 'output' method of a generator class
+
+	When 't' is an array, the output is evaluated within a render context (a 
+	'Stream' passed as the 'stream' keyword argument), so that every module 
+	is evaluated at most once for a given time buffer. If no context is passed, 
+	a new one is created.
+
+	The output is written to the 'out' buffer, if it is given and has the 
+	shape of the output (it is returned then), otherwise a new array is 
+	returned. Methods that take the 'out' argument write to it themselves, 
+	the output of other ones is copied.
+	"""
+
+	if 'out' in inspect.signature(output).parameters:
+		def write(self, t, out=None, **kwargs):
+			return to_buffer(output(self, t, out=out, **kwargs), out)
+	else:
+		def write(self, t, out=None, **kwargs):
+			return to_buffer(output(self, t, **kwargs), out)
+
+	def wrapper(self, t, out=None, **kwargs):
+		if type(t) != np.ndarray:
+			return output(self, t, **kwargs)
+
+		stream = kwargs.get('stream')
+		if stream is None:
+			return Stream().output(self, t, out, **kwargs)
+		else:
+			return stream.evaluate(self, write, t, out, **kwargs)
+
+	wrapper.__name__ = output.__name__
+	wrapper.__doc__ = output.__doc__
+	return wrapper
+
+#numbers of changes of modules, in order (see 'Generator.touch')
+VERSIONS = itertools.count(1)
+
+def get_stamp(module, stamps=None):
+	"""
+	Returns the number of the last change of 'module' or any module its 
+	output depends on ('stamps' keeps the stamps found so far)
+	"""
+
+	if stamps is None:
+		stamps = {}
+
+	try:
+		return stamps[module]
+	except KeyError:
+		pass
+
+	#a cycle of modules doesn't stop the search
+	stamps[module] = module.version
+	stamps[module] = max(
+		[module.version] + 
+		[get_stamp(source, stamps) for source in module.get_sources()]
+	)
+
+	return stamps[module]
+
+"""
+the largest fraction of active samples for which only the active ones are 
+evaluated
+"""
+DENSITY = 0.75
+
+def find_active(module, t, **kwargs):
+	"""
+	Returns 'module.get_active(t, **kwargs)', it is found once per block of 
+	the stream passed in 'kwargs'
+	"""
+
+	stream = kwargs.get('stream')
+	if stream is None:
+		return module.get_active(t, **kwargs)
+	else:
+		return stream.get_active(module, t, **kwargs)
+
+def output_audible(module, t, out=None, **kwargs):
+	"""
+	Returns 'module.output(t, **kwargs)', a pointwise module (see 
+	'Generator.is_pointwise') that is silent in the whole time t isn't 
+	evaluated at all
+
+	(picking the active samples is left to the module, eg. the amplifier of 
+	an operator, picking them at every level costs more than it saves)
+	"""
+
+	stream = kwargs.get('stream')
+	if (
+		type(t) == np.ndarray and stream is not None and 
+		stream.is_pointwise(module)
+	):
+		active = find_active(module, t, **kwargs)
+		if active is not None and not active.any():
+			return zeros(t, out)
+
+	return module.output(t, out=out, **kwargs)
+
+def is_sparse(active, density=DENSITY):
+	"""
+	Returns 'True' if at most 'density' of the samples are active, otherwise 
+	picking the active samples costs more than evaluating the inactive ones
+	"""
+	return np.count_nonzero(active) <= density*len(active)
+
+def zeros(t, out=None):
+	"""Returns zeros for every moment of t (written to 'out', if given)"""
+
+	if out is None:
+		return np.zeros(t.shape)
+
+	out.fill(0.0)
+	return out
+
+def evaluate_active(output, t, active, sampled=None, out=None, **kwargs):
+	"""
+	Returns 'output(t, **sampled, **kwargs)' evaluated only where 'active' is 
+	'True' (0 elsewhere), 'output' has to be pointwise, 'sampled' are keyword 
+	arguments given for every sample of 't'
+	"""
+
+	indices = np.flatnonzero(active)
+
+	#a silent output is not evaluated at all (its 0 is broadcast to voices)
+	if len(indices) == 0:
+		return zeros(t, out)
+
+	#the arguments are picked into a new dictionary, the given one is kept
+	picked = {}
+	for arg, value in (sampled or {}).items():
+		if type(value) == np.ndarray:
+			value = value[..., indices]
+		picked[arg] = value
+	sampled = picked
+
+	value = output(t[indices], **sampled, **kwargs)
+
+	#voices of a polyphonic keyboard are the first axis of the output
+	shape = np.shape(value)[:-1] + t.shape
+	if out is None or out.shape != shape:
+		out = np.empty(shape)
+
+	out.fill(0.0)
+	out[..., indices] = value
+
+	return out
 
 class Generator():
 	"""A class to represent a signal generator of any kind"""
 
-	def output(self, t, **kwargs):
+	#the number of the last change of the module (see 'touch')
+	version = 0
+
+	#attributes that don't affect the output (see 'fingerprint' in 'cache.py')
+	transient = ('version',)
+
+	def touch(self):
+		"""
+		Marks the module as changed, so that the outputs depending on it kept 
+		by a 'RenderCache' (see 'cache.py') are computed again
+
+		Setters call it, it has to be called after changing an attribute 
+		directly
+		"""
+		self.version = next(VERSIONS)
+
+	def get_inputs(self, ignore_mod=False):
+		"""
+		Returns a list of modules whose outputs are read (for the same time) 
+		by the 'output' method
+		"""
+		return []
+
+	def get_sources(self):
+		"""
+		Returns a list of all modules the output depends on (the inputs, as 
+		well as modules read otherwise, like gates)
+		"""
+		return self.get_inputs()
+
+	def is_pointwise(self, stream=None):
+		"""
+		Returns 'True' if the output at every sample depends only on the time 
+		of that sample (and not on other samples or previous blocks), so that 
+		the output can be evaluated for any subset of samples ('stream' keeps 
+		the answers for the current block)
+		"""
+
+		if stream is None:
+			return all(input.is_pointwise() for input in self.get_inputs())
+		else:
+			return all(stream.is_pointwise(input) for input in self.get_inputs())
+
+	def seek(self, start, stream):
+		"""
+		Sets the state of the module in 'stream' (see 'Stream.get_state') as 
+		if the samples before 'start' were rendered, returns 'False' if it 
+		can't be found without rendering them
+
+		Modules keeping no state between blocks have nothing to set
+		"""
+		return True
+
+	def get_active(self, t, **kwargs):
+		"""
+		Returns a boolean array telling where in time t the output may be 
+		non-zero ('None' if it is not known)
+		"""
+		return None
+
+	def get_buffer(self, t, name, dtype=np.float64, stream=None, shape=None):
+		"""
+		Returns a scratch buffer named 'name' for values in time t (of given 
+		'shape', the shape of t by default), within a block of 'stream' it is 
+		the same buffer every block ('None' if t is not an array)
+		"""
+
+		if type(t) != np.ndarray:
+			return None
+
+		if shape is None:
+			shape = t.shape
+
+		if stream is None or t is not stream.t:
+			return np.empty(shape, dtype)
+		else:
+			return stream.get_buffer((self, name), shape, dtype)
+
+	@output_method
+	def output(self, t, out=None, **kwargs):
 		"""Returns the value of generators signal in time t"""
 		if type(t) == np.ndarray:
-			return np.full(t.shape, 0.0)
+			return zeros(t, out)
 		else:
 			return 0.0
 
-	def play(self, time=1.0, blocking=False):
-		"""Plays the generated sound for given time (in seconds)"""
-		ts = np.linspace(0, time, time*const.fs)
-		sd.play(self.output(ts), const.fs, blocking=blocking)
+	def output_active(self, t, active, density=DENSITY, out=None, **kwargs):
+		"""
+		Returns the value of generators signal in time t, given that it is 
+		needed only where 'active' is 'True' (it is 0 elsewhere)
+
+		The output of a pointwise generator (see 'is_pointwise') is evaluated 
+		only for the active samples (unless more than 'density' of them are 
+		active), otherwise it is evaluated for all of them
+		"""
+
+		if (
+			type(t) != np.ndarray or active is None or 
+			any(arg not in ('stream', 'ignore_mod') for arg in kwargs) or 
+			kwargs.get('stream') is None or not is_sparse(active, density) or 
+			not kwargs['stream'].is_pointwise(self)
+		):
+			return self.output(t, out=out, **kwargs)
+
+		return evaluate_active(self.output, t, active, out=out, **kwargs)
+
+	def play(
+		self, time=1.0, blocking=False, block_size=None, lookahead=4, 
+		sink=None, cache=None
+	):
+		"""
+		Plays the generated sound for given time (in seconds)
+
+		If 'block_size' or 'sink' is given, the sound is rendered block by 
+		block while it is played ('lookahead' blocks ahead), and the 'Player' 
+		is returned ('sink' defaults to the sound device, see 'playback.py'). 
+		If 'cache' (a 'DiskCache' from 'cache.py') is given, a sound rendered 
+		before is taken from it.
+		"""
+
+		if block_size is None and sink is None:
+			if sd is None:
+				raise RuntimeError(
+					'sounddevice (or PortAudio) is not available, pass a '
+					"'sink' (see 'playback.py') to play the sound"
+				)
+
+			if cache is None:
+				signal = self.output(sample_times(0, sample_count(time)))
+			else:
+				signal = cache.render(self, time)
+
+			sd.play(signal, const.fs, blocking=blocking)
+			return
+
+		from playback import Player
+
+		if block_size is None:
+			block_size = 1024
+
+		player = Player(self, time, block_size, lookahead, sink, cache)
+		player.start()
+		if blocking:
+			player.wait()
+
+		return player
+
+	def render(
+		self, path, time=1.0, block_size=4096, format='int16', 
+		normalize=False, peak=1.0, cache=None
+	):
+		"""
+		Renders the generated sound for given time (in seconds) to a WAV file 
+		('int16', 'int24' or 'float32' samples), returns the render speed as a 
+		multiple of real time (see 'wavfile.py'), a sound rendered before is 
+		taken from 'cache' (a 'DiskCache' from 'cache.py'), if given
+		"""
+
+		from wavfile import render
+		return render(
+			path, self, time, block_size, format, normalize, peak, 
+			cache=cache
+		)
+
+	def blocks(self, time=1.0, block_size=1024, out=None):
+		"""
+		Yields the generated signal for given time (in seconds) in blocks of 
+		'block_size' samples (written to 'out', if given, see 'Stream.render')
+		"""
+		return Stream(block_size).render(self, time, out)
 
 	def draw(self, ax, time=1.0, density=100, alpha=1.0, scale=1.0):
 		"""Draws the output signal"""
@@ -28,7 +346,9 @@ class Generator():
 		inputs etc.
 		"""
 		ys = scale*self.output(ts, ignore_mod=True)
-		ax.plot(ts, ys, alpha=alpha)
+
+		#voices of a polyphonic keyboard are drawn one by one
+		ax.plot(ts, np.transpose(ys), alpha=alpha)
 
 class Const(Generator):
 	"""A class to represent a constant signal generator"""
@@ -36,12 +356,16 @@ class Const(Generator):
 	def __init__(self, value=0.0):
 		self.value = np.float64(value)	#the output value
 
-	def output(self, t, **kwargs):
+	@output_method
+	def output(self, t, out=None, **kwargs):
 		"""Returns the value of generators signal in time t"""
-		if type(t) == np.ndarray:
+		if type(t) != np.ndarray:
+			return self.value
+		elif out is None:
 			return np.full(t.shape, self.value)
 		else:
-			return self.value
+			out.fill(self.value)
+			return out
 
 class Ramp(Generator):
 	"""A class to represent a linearly increasing signal generator"""
@@ -50,9 +374,11 @@ class Ramp(Generator):
 		self.slope = np.float64(slope)	#increase rate
 		self.start = np.float64(start)	#initial output value
 
-	def output(self, t, **kwargs):
+	@output_method
+	def output(self, t, out=None, **kwargs):
 		"""Returns the value of generators signal in time t"""
-		return self.start + self.slope*t
+		output = np.multiply(self.slope, t, out=fit(out, t))
+		return np.add(self.start, output, out=fit(out, output))
 
 class Gate(Generator):
 	"""A class to represent a gate generator"""
@@ -73,21 +399,30 @@ class Gate(Generator):
 			self.releases[:-1] = np.array(ts[1::2])
 			self.releases[-1] = const.inf
 
+		"""
+		sorted moments of openings and closings, a closing earlier than its 
+		opening is moved to the opening, so that the gate is opened 0 times 
+		between them
+		"""
+		self.sorted_presses = np.sort(self.presses)
+		self.sorted_releases = np.sort(
+			np.maximum(self.releases, self.presses)
+		)
+
+		self.touch()
+
+	@output_method
 	def output(self, t, **kwargs):
 		"""Returns the value of generators signal in time t"""
 
+		"""
+		the output is the number of openings of the gate that are not closed 
+		yet (overlapping openings add up)
+		"""
+		opened = np.searchsorted(self.sorted_presses, t, side='right')
+		closed = np.searchsorted(self.sorted_releases, t, side='right')
 
-		if len(self.presses) == 0:
-			if type(t) == np.ndarray:
-				return np.full(t.shape, 0.0)
-			else:
-				return 0.0
-		else:
-			return np.sum(
-				np.float64(np.logical_and(
-					self.presses[i] <= t, t < self.releases[i]
-				)) for i in range(len(self.presses))
-			)
+		return np.float64(opened - closed)
 
 
 
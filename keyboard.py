@@ -1,9 +1,9 @@
 import numpy as np
-import mido
 
 import constants as const
 
-from generators import Generator, Gate
+from generators import Generator, Gate, output_method
+from midifile import read_index, MidiIndex, PITCH_BEND
 
 class MonoKey(Generator):
 	"""
@@ -18,7 +18,7 @@ class MonoKey(Generator):
 	def set_attributes(self, steps, pitches):
 		"""Sets pitches and the points in time when pitches are changed"""
 
-		#'steps' are time points when pitches are changed
+		#'steps' are time points when pitches are changed (in ascending order)
 		#'pitches' is a sequence of pitches mientioned above
 
 		#'pitches' shouldn't be longer than 'steps'
@@ -39,19 +39,177 @@ class MonoKey(Generator):
 		self.pitches[0] = 0.0
 		self.pitches[1:] = pitches
 
-	def output(self, t, **kwargs):
-		"""Returns the value of generators signal in time t"""
+		"""
+		'values[i + 1]' is the output between 'steps[i]' and 'steps[i + 1]', 
+		'values[0]' is the output before the first step, the output is 0 
+		after the last pitch
+		"""
+		self.values = np.full((len(self.steps) + 1), 0, dtype=np.int32)
+		self.values[1:len(self.pitches) + 1] = self.pitches
 
-		return np.sum(
-			self.pitches[i]*np.int32(
-				np.logical_and(self.steps[i] <= t, t < self.steps[i + 1])
-			) for i in range(len(self.pitches))
-		)
+		"""
+		frequency ratios corresponding to 'values' and their integral from 0 
+		to the beginning of each value ('starts')
+		"""
+		self.mods = 2**(self.values / 12)
+		self.starts = np.full(self.values.shape, 0.0)
+		self.starts[1:] = self.steps
+		self.integrals = np.full(self.values.shape, 0.0)
+		self.integrals[2:] = np.cumsum(self.mods[1:-1]*np.diff(self.steps))
+
+		self.touch()
+
+	def get_segments(self, t):
+		"""
+		Yields the indices of the values of the output in time t ('t' is 
+		expected to be in ascending order) and the slices of 't' where they 
+		are given
+		"""
+
+		#indices of the values at the first and the last moment
+		first, last = np.searchsorted(self.steps, (t[0], t[-1]), side='right')
+
+		#samples where the values begin
+		bounds = np.searchsorted(t, self.steps[first:last])
+
+		a = 0
+		for i in range(first, last):
+			b = bounds[i - first]
+			if a < b:
+				yield i, slice(a, b)
+			a = b
+
+		yield last, slice(a, len(t))
+
+	@output_method
+	def output(self, t, out=None, **kwargs):
+		"""
+		Returns the value of generators signal in time t (if 'out' is given, 
+		't' is expected to be in ascending order)
+		"""
+
+		if out is None or np.ndim(t) != 1 or len(t) == 0:
+			#the index of the last step not later than 't'
+			i = np.searchsorted(self.steps, t, side='right') - 1
+
+			return self.values[i + 1]
+
+		for i, samples in self.get_segments(t):
+			out[samples] = self.values[i]
+
+		return out
+
+	def key_mod_integral(self, t, out=None, **kwargs):
+		"""
+		Returns the integral of the frequency ratio (2**(output / 12)) from 0 
+		to t, that is the phase (in cycles) of a 1 Hz oscillator with this key 
+		input (if 'out' is given, 't' is expected to be in ascending order)
+		"""
+
+		if out is None or np.ndim(t) != 1 or len(t) == 0:
+			#the index of the value at 't'
+			i = np.searchsorted(self.steps, t, side='right')
+
+			return self.integrals[i] + self.mods[i]*(t - self.starts[i])
+
+		#the same operations for every sample, value by value
+		for i, samples in self.get_segments(t):
+			np.subtract(t[samples], self.starts[i], out=out[samples])
+			np.multiply(self.mods[i], out[samples], out=out[samples])
+			np.add(self.integrals[i], out[samples], out=out[samples])
+
+		return out
+
+class Control(Generator):
+	"""
+	A class to represent a part of a keyboard that sends a control signal 
+	(eg. the velocity, the pitch bend or a controller), set to given values 
+	at given points in time
+	"""
+
+	def __init__(self, steps=[], values=[], default=0.0, ramp=0.0):
+
+		#time (in seconds) of the glide to a new value, 0 means steps
+		self.ramp = ramp
+
+		self.set_attributes(steps, values, default)
+
+	def set_attributes(self, steps, values, default=0.0):
+		"""
+		Sets the values and the points in time when they are set ('steps', in 
+		ascending order), 'default' is the output before the first step
+		"""
+
+		steps = np.asarray(steps, dtype=np.float64)
+		values = np.asarray(values, dtype=np.float64)
+		count = min(len(steps), len(values))
+		steps, values = steps[:count], values[:count]
+
+		#of the values set at the same moment the last one is kept
+		last = np.full(count, True)
+		last[:-1] = steps[1:] != steps[:-1]
+
+		self.default = default
+		self.steps = steps[last]
+
+		#'values[i + 1]' is the output from 'steps[i]' on
+		self.values = np.concatenate(([default], values[last]))
+
+		self.set_ramp(self.ramp)
+
+	def set_ramp(self, ramp):
+		"""
+		Sets the time (in seconds) of the glide from a value to the next one, 
+		the glide ends when the value is set (it starts after the previous 
+		one, if they are closer), 0 means steps
+		"""
+
+		self.ramp = ramp
+
+		#the moments and the values the output is linearly interpolated
+		#between, a glide from every value to the next one
+		starts = self.steps - ramp
+		starts[1:] = np.maximum(starts[1:], self.steps[:-1])
+		self.times = np.column_stack((starts, self.steps)).ravel()
+		self.points = np.column_stack(
+			(self.values[:-1], self.values[1:])
+		).ravel()
+
+		self.touch()
+
+	@output_method
+	def output(self, t, out=None, **kwargs):
+		"""
+		Returns the value of generators signal in time t (the value set last 
+		or a point of a glide)
+		"""
+
+		if self.ramp > 0.0 and len(self.steps) > 0:
+			return np.interp(t, self.times, self.points)
+
+		#the index of the value set last, up to 't'
+		i = np.searchsorted(self.steps, t, side='right')
+
+		if out is None or np.shape(t) != out.shape:
+			return self.values[i]
+		else:
+			return np.take(self.values, i, out=out)
 
 class MonoKeyboard():
-	"""A class to represent a monophonic keyboard"""
+	"""
+	A class to represent a monophonic keyboard
 
-	def __init__(self, gate=Gate([]), pitches=[], steps=None):
+	Besides the key and gate outputs the keyboard has outputs of the 
+	velocity of the played note, the pitch bend and the controllers (see 
+	'get_control'), set by 'read_midi', they can be connected to any input 
+	(eg. an amplifier's modulator, a mixer's level or an oscillator's key 
+	input, through a mixer adding the key output)
+	"""
+
+	def __init__(self, gate=None, pitches=[], steps=None, bend_range=2.0):
+
+		if gate is None:
+			gate = Gate([])
 
 		self.gate = gate						#gate output
 		if steps is None:
@@ -59,6 +217,39 @@ class MonoKeyboard():
 
 		self.key = MonoKey(steps, pitches)		#key output
 
+		self.velocity = Control()		#velocity of the played note (0 to 1)
+		self.pitch_bend = Control()		#pitch bend (in semitones)
+		self.mod_wheel = Control()		#modulation wheel (0 to 1)
+
+		#the pitch bend at either end of the wheel (in semitones)
+		self.bend_range = bend_range
+
+		#outputs of the controllers (by their control change numbers)
+		self.controls = {1: self.mod_wheel}
+
+		#the notes and the controller events read by 'read_midi'
+		self.index = MidiIndex()
+
+	def get_control(self, number, default=0.0):
+		"""
+		Returns the output of the controller 'number' (of control changes, 
+		from 0 to 127), its value is from 0 to 1, 'default' is the value 
+		before the first change
+		"""
+
+		if number not in self.controls:
+			self.controls[number] = Control(default=default)
+			self.set_control(number)
+
+		return self.controls[number]
+
+	def set_control(self, number):
+		"""Sets the output of the controller 'number' from 'self.index'"""
+
+		control = self.controls[number]
+		times, values = self.index.get_controls(number)
+		control.set_attributes(times, values / 127.0, control.default)
+
 	def key_out(self, t, **kwargs):
 		"""Returns the key output of the keyboard"""
 		return self.key.output(t, **kwargs)
@@ -67,80 +258,288 @@ class MonoKeyboard():
 		"""Returns the gate output of the keyboard"""
 		return self.gate.output(t, **kwargs)
 
-	def read_midi(self, filename, track=0):
-		"""Reads a midi file and converts it to key and gate outputs"""
+	def read_midi(self, filename, track=0, channel=None):
+		"""
+		Reads a midi file and converts it to key and gate outputs, the notes 
+		of given track and channel are played ('None' means all of them, see 
+		'MidiIndex.select')
+		"""
 
-		tempo = 500000		#default tempo
+		self.set_index(read_index(filename).select(track, channel))
 
-		#read the file
-		mid = mido.MidiFile(filename)
+	def set_index(self, index):
+		"""
+		Sets the outputs of the keyboard up from a 'MidiIndex' (eg. read from 
+		a file or received from an input port, see 'live.py')
+		"""
 
-		ts = []				#gate openings and closings
+		self.index = index
 
-		#we will need those to set up key output
-		steps = []
-		pitches = []
+		#set up gate and key outputs
+		self.gate.set_triggers(self.index.get_gate())
+		steps, notes = self.index.get_played()
+		self.key.set_attributes(steps, self.index.get_pitches()[notes])
 
-		pressed = []		#list of pressed keys
+		#and the outputs of the velocity and the controllers
+		self.velocity.set_attributes(
+			steps, self.index.velocities[notes] / 127.0
+		)
+		times, values = self.index.get_controls(PITCH_BEND)
+		self.pitch_bend.set_attributes(
+			times, values*(self.bend_range / 8192.0)
+		)
+		for number in self.controls:
+			self.set_control(number)
 
-		time = 0.0			#this will hold the current time
+class PolyKey(Generator):
+	"""
+	A class to represent the key output of a polyphonic keyboard
 
-		for msg in mid.tracks[0]:
+	The output is a 2D array (voices x samples), a row for each voice 
+	sounding in the current block (see 'Stream.voices'), every voice is a 
+	'MonoKey'
+	"""
 
-			#make 'time' the current time
-			#('msg.time' is the time that passed since previous event)
-			time += mido.tick2second(msg.time, mid.ticks_per_beat, tempo)
+	def __init__(self, keys=[]):
+		self.keys = keys		#key outputs of the voices ('MonoKey' objects)
 
-			#change tempo
-			if msg.type == 'set_tempo':
-				tempo = msg.tempo
-				continue
+	def get_sources(self):
+		"""Returns a list of all modules the output depends on"""
+		return list(self.keys)
 
-			#ignore anything that doesn' interest you
-			elif msg.type != 'note_on':
-				continue
+	def get_keys(self, stream=None):
+		"""Returns the key outputs of the voices sounding in the block"""
 
+		if stream is None:
+			return self.keys
+		else:
+			return [self.keys[i] for i in stream.get_voices(len(self.keys))]
 
-			if msg.velocity > 0:
-				#'msg.velocity' > 0 means a key was pressed,
-				if pressed == []:
-					
-					"""
-					no key is pressed, therefore gate is closed, 
-					therefore open the gate
-					"""
-					ts.append(time)
+	@output_method
+	def output(self, t, stream=None, **kwargs):
+		"""Returns the value of generators signal in time t"""
 
-				#add the key to 'pressed' if it's not there
-				if msg.note not in pressed:
-					
-					pressed.append(msg.note)
-				
-				#change the pitch
-				steps.append(time)
-				pitches.append(msg.note - 69)
+		output = np.zeros((len(self.get_keys(stream)),) + np.shape(t))
+		for i, key in enumerate(self.get_keys(stream)):
+			output[i] = key.output(t)
 
-			else:
-				#'msg.velocity' = 0 means a key was released
-				if msg.note in pressed:
+		return output
 
-					#remove the key from 'pressed'
-					pressed.remove(msg.note)
+	def key_mod_integral(self, t, stream=None, **kwargs):
+		"""
+		Returns the integrals of the frequency ratios of the voices from 0 to 
+		t (see 'MonoKey.key_mod_integral')
+		"""
 
-					if pressed == []:
+		output = np.zeros((len(self.get_keys(stream)),) + np.shape(t))
+		for i, key in enumerate(self.get_keys(stream)):
+			output[i] = key.key_mod_integral(t)
 
-						#no key is pressed, therefore close the gate
-						ts.append(time)
-					else:
+		return output
 
-						#change the pitch
-						steps.append(time)
-						pitches.append(msg.note - 69)
+class PolyGate(Generator):
+	"""
+	A class to represent the gate output of a polyphonic keyboard
 
-		#set up gate and key outputs
-		self.gate.set_triggers(ts)
-		self.key.set_attributes(steps, pitches)
+	The output is a 2D array (voices x samples), a row for each voice 
+	sounding in the current block, every voice is a 'Gate'
+	"""
+
+	def __init__(self, gates=[]):
+		self.gates = gates		#gate outputs of the voices ('Gate' objects)
+
+	def get_sources(self):
+		"""Returns a list of all modules the output depends on"""
+		return list(self.gates)
+
+	def get_gates(self, stream=None):
+		"""Returns the gate outputs of the voices sounding in the block"""
+
+		if stream is None:
+			return self.gates
+		else:
+			return [self.gates[i] for i in stream.get_voices(len(self.gates))]
+
+	@output_method
+	def output(self, t, stream=None, **kwargs):
+		"""Returns the value of generators signal in time t"""
+
+		output = np.zeros((len(self.get_gates(stream)),) + np.shape(t))
+		for i, gate in enumerate(self.get_gates(stream)):
+			output[i] = gate.output(t)
+
+		return output
+
+class PolyKeyboard():
+	"""
+	A class to represent a polyphonic keyboard
+
+	Every note is assigned to one of 'polyphony' voices, when all voices 
+	are held a note steals a voice - the one playing the oldest note 
+	('steal="oldest"') or the quietest one ('steal="quietest"', the loudness 
+	is estimated with 'envelope' if given, otherwise it's the velocity).
+	The voices are rendered together, as rows of 2D arrays, by modules 
+	connected to the 'key' and 'gate' outputs, a 'VoiceMixer' sums them up 
+	and skips the voices that are silent.
+	"""
+
+	def __init__(self, polyphony=8, steal='oldest', envelope=None):
+
+		if steal not in ('oldest', 'quietest'):
+			raise ValueError(
+				"'steal' should be 'oldest' or 'quietest', not %r" % (steal,)
+			)
+
+		self.polyphony = polyphony		#number of voices
+		self.steal = steal				#voice stealing policy
+		self.envelope = envelope		#envelope estimating the loudness
+
+		self.key = PolyKey([MonoKey() for i in range(polyphony)])
+		self.gate = PolyGate([Gate([]) for i in range(polyphony)])
+
+		self.set_notes([])
+
+	def key_out(self, t, **kwargs):
+		"""Returns the key output of the keyboard"""
+		return self.key.output(t, **kwargs)
+
+	def gate_out(self, t, **kwargs):
+		"""Returns the gate output of the keyboard"""
+		return self.gate.output(t, **kwargs)
+
+	def loudness(self, note, time):
+		"""Returns the estimated loudness of the 'note'-th note at 'time'"""
+
+		level = self.velocities[note] / 127.0
+		if self.envelope is not None:
+			level *= self.envelope.before_release(time - self.presses[note])
+
+		return level
+
+	def allocate(self, press):
+		"""
+		Returns the voice for a note pressed at time 'press' and the note 
+		that is stolen from it ('None' if the voice is free)
+		"""
+
+		#the notes played by the voices
+		notes = [
+			voice[-1] if voice != [] else None for voice in self.voice_notes
+		]
+
+		#the free voice released the earliest (its release is the quietest)
+		free = [
+			(self.releases[note] if note is not None else -const.inf, voice)
+			for voice, note in enumerate(notes)
+			if note is None or self.releases[note] <= press
+		]
+		if free != []:
+			return min(free)[1], None
+
+		if self.steal == 'oldest':
+			voice = min(
+				range(self.polyphony), key=lambda v: self.presses[notes[v]]
+			)
+		else:
+			voice = min(
+				range(self.polyphony), 
+				key=lambda v: self.loudness(notes[v], press)
+			)
+
+		return voice, notes[voice]
+
+	def set_notes(self, notes, keep=0):
+		"""
+		Assigns the notes to the voices, 'notes' is a list of tuples 
+		(press, release, pitch, velocity) in the order of presses
+
+		The first 'keep' notes are the notes assigned before, whose releases 
+		may have changed (eg. notes played live), they keep their voices and 
+		only the later notes are assigned
+		"""
+
+		self.presses = np.array([note[0] for note in notes], dtype=np.float64)
+		self.releases = np.array([note[1] for note in notes], dtype=np.float64)
+		self.pitches = np.array([note[2] for note in notes], dtype=np.int32)
+		self.velocities = np.array(
+			[note[3] for note in notes], dtype=np.float64
+		)
+
+		if keep == 0:
+			self.voices = np.zeros(len(notes), dtype=np.int32)	#notes' voices
+			self.voice_notes = [[] for i in range(self.polyphony)]
+			self.stealers = {}		#the notes that stole the notes' voices
+		else:
+			self.voices = np.concatenate((
+				self.voices[:keep], np.zeros(len(notes) - keep, dtype=np.int32)
+			))
+			self.voice_notes = [
+				[note for note in voice if note < keep]
+				for voice in self.voice_notes
+			]
+			self.stealers = {
+				stolen: stealer for stolen, stealer in self.stealers.items()
+				if stealer < keep
+			}
+
+			#the notes stolen before are released when they were stolen
+			for stolen, stealer in self.stealers.items():
+				self.releases[stolen] = self.presses[stealer]
+
+		for note in range(keep, len(notes)):
+			voice, stolen = self.allocate(self.presses[note])
+
+			#a stolen note is released when the new one is pressed
+			if stolen is not None:
+				self.releases[stolen] = self.presses[note]
+				self.stealers[stolen] = note
+
+			self.voices[note] = voice
+			self.voice_notes[voice].append(note)
+
+		#set up the voices' gate and key outputs
+		for voice, indices in enumerate(self.voice_notes):
+			presses = self.presses[indices]
+			releases = self.releases[indices]
+
+			self.gate.gates[voice].set_triggers(
+				list(np.column_stack((presses, releases)).ravel())
+			)
+			self.key.keys[voice].set_attributes(
+				presses, self.pitches[indices]
+			)
+
+	def get_voices(self, start, stop, tail=0.0):
+		"""
+		Returns the indices of the voices that sound between 'start' and 
+		'stop', given that a voice sounds for 'tail' seconds after a release
+		"""
+
+		sounding = np.logical_and(
+			self.presses <= stop, self.releases + tail >= start
+		)
+
+		return np.unique(self.voices[sounding])
+
+	def read_midi(self, filename, track=0, channel=None):
+		"""
+		Reads a midi file and assigns its notes to the voices, the notes of 
+		given track and channel are played ('None' means all of them, see 
+		'MidiIndex.select')
+		"""
+
+		self.set_index(read_index(filename).select(track, channel))
+
+	def set_index(self, index, keep=0):
+		"""
+		Assigns the notes of a 'MidiIndex' to the voices (see 'set_notes' for 
+		'keep')
+		"""
 
+		self.set_notes(list(zip(
+			index.get_presses(), index.get_releases(), index.get_pitches(), 
+			index.velocities
+		)), keep)
 
 if __name__ == '__main__':
 
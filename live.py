@@ -0,0 +1,448 @@
+import asyncio
+import concurrent.futures
+import queue
+import threading
+import time as clock
+
+import numpy as np
+
+import constants as const
+from keyboard import PolyKeyboard
+from midifile import MidiIndex, COLUMNS, HELD, PITCH_BEND
+from playback import Player
+from stream import Stream, sample_count
+
+class ScriptedPort():
+	"""
+	A class to represent a stand-in for a MIDI input port, it sends given 
+	messages at given times, like a mido input port it is iterated over (the 
+	iteration waits for the messages)
+	"""
+
+	def __init__(self, script):
+
+		#pairs (time, message), the times are in seconds from the first read
+		self.script = sorted(script, key=lambda item: item[0])
+
+		self.closed = False
+
+	def __iter__(self):
+		start = clock.perf_counter()
+		for time, message in self.script:
+			delay = start + time - clock.perf_counter()
+			if delay > 0:
+				clock.sleep(delay)
+
+			if self.closed:
+				return
+
+			yield message
+
+	def close(self):
+		"""Stops sending the messages"""
+		self.closed = True
+
+class LiveNotes():
+	"""
+	A class to represent the notes and the controller events received from an 
+	input port, collected as the columns of a 'MidiIndex'
+	"""
+
+	def __init__(self):
+		self.columns = {name: [] for name, dtype in COLUMNS}
+
+		#indices of the held notes of every key (a note on a channel), in
+		#the order of presses
+		self.held = {}
+
+	def __len__(self):
+		return len(self.columns['onsets'])
+
+	def add(self, message, sample):
+		"""
+		Adds a message received at 'sample', returns 'True' if it changes the 
+		index (releases when no note is held are ignored, as in a file)
+		"""
+
+		columns = self.columns
+		if message.type == 'note_on' and message.velocity > 0:
+			key = (message.channel, message.note)
+			self.held.setdefault(key, []).append(len(self))
+
+			for name, value in [
+				('onsets', sample), ('offsets', HELD),
+				('notes', message.note), ('velocities', message.velocity),
+				('channels', message.channel), ('tracks', 0)
+			]:
+				columns[name].append(value)
+
+		elif message.type == 'note_on' or message.type == 'note_off':
+			held = self.held.get((message.channel, message.note))
+			if not held:
+				return False
+
+			#the earliest held note of the key is released
+			columns['offsets'][held.pop(0)] = sample
+
+		elif message.type == 'control_change' or message.type == 'pitchwheel':
+			if message.type == 'control_change':
+				controller, value = message.control, message.value
+			else:
+				controller, value = PITCH_BEND, message.pitch
+
+			for name, value in [
+				('control_times', sample), ('controllers', controller),
+				('control_values', value),
+				('control_channels', message.channel), ('control_tracks', 0)
+			]:
+				columns[name].append(value)
+
+		else:
+			return False
+
+		return True
+
+	def get_index(self):
+		"""Returns the 'MidiIndex' of the received notes and events"""
+		return MidiIndex(**self.columns)
+
+class LivePlayer(Player):
+	"""
+	A class to represent a live playback of a patch played by a keyboard 
+	(monophonic or polyphonic), fed with MIDI messages from an input port (a 
+	mido input port or a 'ScriptedPort')
+
+	The messages are read in a separate thread and put to an asyncio queue, 
+	with the moments they arrive. The blocks are scheduled by a coroutine: 
+	when the sink pulls a block, the messages that arrived since the 
+	previous pull are given to the keyboard and the block 'lookahead' blocks 
+	later is rendered, in a dedicated render thread.
+
+	The messages are quantized to the beginning of the block 
+	('quantize="block"', a latency of 'lookahead' to 'lookahead + 1' blocks) 
+	or to the offsets within the block at which they arrived after the 
+	previous pull ('quantize="sample"', a constant latency of 'lookahead + 1' 
+	blocks, without the jitter). The latencies from the arrival of a message 
+	to the pull of its sample are measured (see 'get_latencies').
+	"""
+
+	def __init__(
+		self, generator, keyboard, port=None, time=None, block_size=256,
+		lookahead=1, quantize='block', channel=None, sink=None
+	):
+		if quantize not in ('block', 'sample'):
+			raise ValueError(
+				"'quantize' should be 'block' or 'sample', not %r" % (quantize,)
+			)
+
+		Player.__init__(self, generator, time, block_size, lookahead, sink)
+
+		self.keyboard = keyboard	#keyboard playing the patch
+		self.port = port			#input port ('None' opens the default one)
+		self.quantize = quantize	#quantization of the messages
+		self.channel = channel		#played channel ('None' means all of them)
+
+		self.notes = LiveNotes()	#received notes and controller events
+		self.stream = Stream(block_size)
+		self.running = False
+		self.sink_started = False
+
+		#statistics, the moments the played blocks were pulled by the sink,
+		#the blocks of the received messages, their offsets and arrivals
+		self.pulls = []
+		self.events = []
+
+	def read(self, port, loop, messages):
+		"""Puts the messages from 'port' to the queue 'messages' of 'loop'"""
+
+		for message in port:
+			arrival = clock.perf_counter()
+			if not self.running:
+				break
+
+			try:
+				loop.call_soon_threadsafe(
+					messages.put_nowait, (message, arrival)
+				)
+			except RuntimeError:
+				#the loop is closed
+				break
+
+	def next_block(self, out, wait=False):
+		"""
+		Fills 'out' with the next block, returns the number of filled samples 
+		(see 'Player.next_block')
+		"""
+
+		blocks = self.blocks
+		length = Player.next_block(self, out, wait)
+
+		#the pull lets the next block be rendered
+		if self.blocks > blocks:
+			self.pulls.append(clock.perf_counter())
+			try:
+				self.loop.call_soon_threadsafe(
+					self.pulled.put_nowait, self.pulls[-1]
+				)
+			except RuntimeError:
+				pass
+
+		return length
+
+	def receive(self, messages, block, previous):
+		"""
+		Gives the messages that arrived since 'previous' (a moment) to the 
+		keyboard, they are played in 'block'
+		"""
+
+		kept = len(self.notes)
+		changed = False
+		start = block*self.block_size
+
+		while not messages.empty():
+			message, arrival = messages.get_nowait()
+			if (
+				self.channel is not None and 
+				getattr(message, 'channel', self.channel) != self.channel
+			):
+				continue
+
+			offset = 0
+			if self.quantize == 'sample':
+				offset = int(round((arrival - previous)*const.fs))
+				offset = min(max(offset, 0), self.block_size - 1)
+
+			if self.notes.add(message, start + offset):
+				changed = True
+				self.events.append((block, offset, arrival))
+
+		if not changed:
+			return
+
+		if isinstance(self.keyboard, PolyKeyboard):
+			#the notes received before keep their voices
+			self.keyboard.set_index(self.notes.get_index(), kept)
+		else:
+			self.keyboard.set_index(self.notes.get_index())
+
+	def render_block(self, length):
+		"""Renders the next block of the stream"""
+
+		start = clock.perf_counter()
+		block = self.stream.output(
+			self.generator, self.stream.next_block(length)
+		)
+		self.render_times.append(clock.perf_counter() - start)
+
+		return block
+
+	async def run(self):
+		"""Plays the patch until 'time' passes or 'stop' is called"""
+
+		self.loop = asyncio.get_running_loop()
+		self.pulled = asyncio.Queue()	#moments of the pulls
+		messages = asyncio.Queue()		#received messages and their arrivals
+
+		port = self.port
+		if port is None:
+			import mido
+			port = mido.open_input()
+
+		#the keyboard plays only the received notes (not the ones it was
+		#given before)
+		self.keyboard.set_index(self.notes.get_index())
+
+		self.running = True
+		reader = threading.Thread(
+			target=self.read, args=(port, self.loop, messages), daemon=True
+		)
+		reader.start()
+
+		renderer = concurrent.futures.ThreadPoolExecutor(1)
+		try:
+			await self.schedule(messages, renderer)
+		except Exception as error:
+			self.error = error
+		finally:
+			self.running = False
+			renderer.shutdown()
+			if self.port is None:
+				port.close()
+
+		#a signal shorter than the lookahead is played now
+		if not self.sink_started:
+			self.sink.start(self)
+
+		await self.loop.run_in_executor(None, self.end)
+		await self.loop.run_in_executor(None, self.wait)
+
+	def end(self):
+		"""Marks the end of the signal, once there is room for it"""
+
+		while not self.finished.is_set():
+			try:
+				self.queue.put(None, timeout=0.01)
+				return
+			except queue.Full:
+				pass
+
+	async def schedule(self, messages, renderer):
+		"""Renders the blocks as they are pulled by the sink"""
+
+		if self.time is None:
+			length = np.iinfo(np.int64).max
+		else:
+			length = sample_count(self.time)
+
+		previous = clock.perf_counter()
+		block = 0
+
+		while self.running and self.stream.stop < length:
+
+			#the first blocks are rendered before the playback
+			if block < self.lookahead:
+				pull = clock.perf_counter()
+			else:
+				if not self.sink_started:
+					self.sink.start(self)
+					self.sink_started = True
+
+				pull = await self.pulled.get()
+				if pull is None:
+					break
+
+			self.receive(messages, block, previous)
+			previous = pull
+
+			output = await self.loop.run_in_executor(
+				renderer, self.render_block, length
+			)
+			self.queue.put_nowait(output)
+			block += 1
+
+	def play(self):
+		"""Plays the patch (see 'run'), returns when the playback ends"""
+		asyncio.run(self.run())
+
+	def stop(self):
+		"""Stops the playback"""
+
+		self.running = False
+		try:
+			self.loop.call_soon_threadsafe(self.pulled.put_nowait, None)
+		except (AttributeError, RuntimeError):
+			pass
+
+		Player.stop(self)
+
+	def get_latencies(self):
+		"""
+		Returns the latencies (in seconds) of the received messages, from 
+		their arrivals to the pulls of their samples by the sink, for the 
+		messages played so far
+		"""
+
+		pulls = list(self.pulls)
+		return np.array([
+			pulls[block] + offset / np.float64(const.fs) - arrival
+			for block, offset, arrival in self.events if block < len(pulls)
+		])
+
+	def report(self):
+		"""Returns a summary of the playback and the latency statistics"""
+
+		latencies = 1000.0*self.get_latencies()
+		if len(latencies) == 0:
+			return Player.report(self)
+
+		p50, p90, p99 = np.percentile(latencies, [50, 90, 99])
+		return Player.report(self) + (
+			'\n%d messages, latency: p50 %.2f ms, p90 %.2f ms, p99 %.2f ms, '
+			'max %.2f ms, jitter %.2f ms' % (
+				len(latencies), p50, p90, p99, np.max(latencies),
+				np.ptp(latencies)
+			)
+		)
+
+
+if __name__ == '__main__':
+
+	#tests
+	import sys
+
+	import mido
+
+	from keyboard import MonoKeyboard
+	from mixer import Mixer, VoiceMixer
+	from amplifier import Amplifier
+	from oscillators import SineOscillator
+	from triggerables import ADSR
+	from playback import NullSink
+
+	def patch(kbd):
+		eg = ADSR(0.01, 0.1, 0.5, 0.1, input=kbd.gate)
+		amp = Amplifier(input=SineOscillator(220.0, key_in=kbd.key), mod=eg)
+		if isinstance(kbd, PolyKeyboard):
+			return VoiceMixer(kbd, amp)
+
+		mixer = Mixer()
+		mixer.add_input(amp, kbd.velocity)
+		return mixer
+
+	#notes at random moments, a chord and a pitch bend
+	random = np.random.default_rng(1)
+	script = []
+	for time in np.sort(random.uniform(0.05, 1.3, 24)):
+		note = int(random.integers(48, 72))
+		script.append((time, mido.Message('note_on', note=note, velocity=90)))
+		script.append((time + 0.04, mido.Message('note_off', note=note)))
+	for note in [60, 64, 67]:
+		script.append((1.35, mido.Message('note_on', note=note, velocity=80)))
+	script.append((1.4, mido.Message('pitchwheel', pitch=4096)))
+
+	class Recorder(LivePlayer):
+		"""A live player keeping the played blocks"""
+
+		def next_block(self, out, wait=False):
+			blocks = self.blocks
+			length = LivePlayer.next_block(self, out, wait)
+			if self.blocks > blocks:
+				self.recorded.append(np.copy(out[:length]))
+
+			return length
+
+	block_size = 512
+	for kbd in [MonoKeyboard(), PolyKeyboard(4)]:
+		for quantize in ['block', 'sample']:
+			player = Recorder(
+				patch(kbd), kbd, ScriptedPort(script), 1.5, block_size,
+				quantize=quantize, sink=NullSink()
+			)
+			player.recorded = []
+			player.play()
+			print(type(kbd).__name__, quantize)
+			print(player.report())
+
+			#the live signal is the signal of the received notes
+			offline = Stream(block_size).render(patch(kbd), 1.5)
+			equal = np.array_equal(
+				np.concatenate(player.recorded),
+				np.concatenate(list(offline))
+			)
+			counts = len(player.get_latencies()) == len(script)
+
+			#the messages are quantized to the blocks or within them
+			offsets = [offset for block, offset, arrival in player.events]
+			if quantize == 'block':
+				quantized = all(offset == 0 for offset in offsets)
+			else:
+				quantized = all(0 <= offset < block_size for offset in offsets)
+
+			"""
+			the latencies depend on the scheduling of the threads, so they are 
+			only reported (the ones of the sample quantization should be about 
+			'lookahead + 1' blocks, with less jitter)
+			"""
+			print(equal, counts, quantized)
+			if not (equal and counts and quantized):
+				sys.exit(1)
@@ -1,15 +1,142 @@
 import numpy as np
 
 def integrate(values, interval):
-	return (np.cumsum(values) - ((values[0] + values) / 2))*interval
+	"""
+	Returns the trapezoidal integral of 'values' (along the last axis) up to 
+	each of them
+	"""
+	return (
+		np.cumsum(values, axis=-1) - ((values[..., :1] + values) / 2)
+	)*interval
+
+class Integrator():
+	"""
+	A class to represent a running (trapezoidal) integral of a signal sampled 
+	every 'interval'
+
+	Values can be integrated block by block ('integrate') or one by one 
+	('step'), the result is the same as of 'integrate' applied to all values. 
+	Several signals (eg. voices) can be integrated at once, the state is then 
+	made of arrays and the values are integrated along the last axis
+	"""
+
+	def __init__(self, interval, state=None):
+		self.interval = interval
+		self.set_state(state)
+
+	def get_state(self):
+		"""Returns the state needed to continue the integral"""
+		return (self.total, self.first, self.count)
+
+	def set_state(self, state=None):
+		"""Sets the state of the integral ('None' means no values yet)"""
+
+		if state is None:
+			state = (0.0, None, 0)
+
+		self.total = state[0]	#sum of all integrated values
+		self.first = state[1]	#the first integrated value
+		self.count = state[2]	#number of integrated values
+
+	def integrate(self, values):
+		"""
+		Integrates 'values' following the previously integrated values, 
+		returns the integral up to each of them
+		"""
+
+		#the first value is copied, as 'values' may be overwritten later
+		if self.first is None:
+			self.first = np.copy(values[..., 0])
+
+		#'np.cumsum' adds sequentially, so the sums are the same as in 'integrate'
+		sums = np.cumsum(np.concatenate(
+			(np.expand_dims(self.total*np.ones(values.shape[:-1]), -1), values), 
+			axis=-1
+		), axis=-1)[..., 1:]
+
+		self.total = sums[..., -1]
+		self.count += values.shape[-1]
+
+		return (
+			sums - ((np.expand_dims(self.first, -1) + values) / 2)
+		)*self.interval
+
+	def step(self, value):
+		"""
+		Integrates one value following the previously integrated values, 
+		returns the integral up to it
+		"""
+
+		if self.first is None:
+			self.first = value
+
+		self.total += value
+		self.count += 1
+
+		return (self.total - ((self.first + value) / 2))*self.interval
+
+def polyblep(phase, dt):
+	"""
+	Returns the polynomial residual of a band-limited step from -1 to 1 at 
+	phase 0, 'dt' is the phase increment per sample (all phases in cycles)
+
+	Adding the residual to a naive wave shape smooths its step over the two 
+	samples around it
+	"""
+
+	phase, dt = np.broadcast_arrays(phase, dt)
+	output = np.zeros(phase.shape)
+
+	#the sample after the step
+	after = phase < dt
+	x = phase[after] / dt[after]
+	output[after] = 2*x - x*x - 1
+
+	#the sample before the step
+	before = phase > 1 - dt
+	x = (phase[before] - 1) / dt[before]
+	output[before] = x*x + 2*x + 1
+
+	return output
+
+def polyblamp(phase, dt):
+	"""
+	Returns the polynomial residual of a band-limited corner at phase 0, where 
+	the slope of the signal grows by 1 per sample ('dt' is the phase increment 
+	per sample, all phases in cycles)
+	"""
+
+	phase, dt = np.broadcast_arrays(phase, dt)
+	output = np.zeros(phase.shape)
+
+	#the sample after the corner
+	after = phase < dt
+	x = phase[after] / dt[after] - 1
+	output[after] = -x*x*x / 6
+
+	#the sample before the corner
+	before = phase > 1 - dt
+	x = (phase[before] - 1) / dt[before] + 1
+	output[before] = x*x*x / 6
+
+	return output
+
+def line(A, B, x, out=None):
+	"""
+	Returns the values of the line through points A and B at x (written to 
+	'out', if given)
+	"""
 
-def line(A, B, x):
 	if A[0] == B[0]:
-		return (A[1] + B[1]) / 2
+		if out is None:
+			return (A[1] + B[1]) / 2
+
+		out[...] = (A[1] + B[1]) / 2
+		return out
 	else:
 		a = (A[1] - B[1]) / (A[0] - B[0])
 		b = A[1] - a*A[0]
-		return a*x + b
+		return np.add(np.multiply(a, x, out=out), b, out=out)
 
 
 if __name__ == '__main__':
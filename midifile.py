@@ -0,0 +1,533 @@
+import os
+
+import numpy as np
+import mido
+
+import constants as const
+
+#the version of the format of the cached indices (see 'read_index')
+FORMAT = 2
+
+#the offset of a note that is never released
+HELD = -1
+
+#the number of pitch bend among the controllers (0 to 127 are control changes)
+PITCH_BEND = 128
+
+#columns of a 'MidiIndex' and their types, the notes
+NOTE_COLUMNS = [
+	('onsets', np.int64),		#samples where the notes are pressed
+	('offsets', np.int64),		#samples where they are released ('HELD')
+	('notes', np.int16),		#MIDI note numbers
+	('velocities', np.int16),	#velocities of the presses
+	('channels', np.int16),		#MIDI channels
+	('tracks', np.int16),		#numbers of the tracks
+]
+
+#and the controller events (control changes and pitch bends)
+CONTROL_COLUMNS = [
+	('control_times', np.int64),	#samples where the values are set
+	('controllers', np.int16),		#controller numbers (or 'PITCH_BEND')
+	('control_values', np.int16),	#0 to 127 (-8192 to 8191 for a bend)
+	('control_channels', np.int16),
+	('control_tracks', np.int16),
+]
+
+COLUMNS = NOTE_COLUMNS + CONTROL_COLUMNS
+
+class MidiIndex():
+	"""
+	A class to represent the notes and the controller events of a MIDI file 
+	as columns (arrays with an item per note, in the order of onsets, and 
+	arrays with an item per event, see 'COLUMNS')
+
+	The notes of all tracks are merged, the times are sample numbers at 
+	'const.fs', converted from ticks with the tempo map of the whole file. 
+	A note is released by the first 'note_off' (or 'note_on' with velocity 
+	0) of its key and channel after it is pressed, a key pressed again before 
+	it is released sounds twice.
+	"""
+
+	def __init__(self, **columns):
+		for name, dtype in COLUMNS:
+			setattr(self, name, np.asarray(columns.get(name, []), dtype=dtype))
+
+	def __len__(self):
+		return len(self.onsets)
+
+	def select(self, track=None, channel=None):
+		"""
+		Returns the index of the notes and the controller events of given 
+		track and channel (a number, a list of numbers or 'None' for all of 
+		them)
+		"""
+
+		notes = np.full(len(self), True)
+		controls = np.full(len(self.control_times), True)
+		for selected, tracks, channels in [
+			(notes, self.tracks, self.channels),
+			(controls, self.control_tracks, self.control_channels)
+		]:
+			if track is not None:
+				selected &= np.isin(tracks, track)
+			if channel is not None:
+				selected &= np.isin(channels, channel)
+
+		columns = {
+			name: getattr(self, name)[notes] for name, dtype in NOTE_COLUMNS
+		}
+		columns.update({
+			name: getattr(self, name)[controls]
+			for name, dtype in CONTROL_COLUMNS
+		})
+
+		return MidiIndex(**columns)
+
+	def get_presses(self):
+		"""Returns the moments (in seconds) when the notes are pressed"""
+		return self.onsets / np.float64(const.fs)
+
+	def get_releases(self):
+		"""
+		Returns the moments (in seconds) when the notes are released 
+		('const.inf' if never)
+		"""
+
+		releases = self.offsets / np.float64(const.fs)
+		releases[self.offsets == HELD] = const.inf
+		return releases
+
+	def get_pitches(self):
+		"""Returns the pitches of the notes (in semitones from A4)"""
+		return self.notes.astype(np.int32) - 69
+
+	def get_gate(self):
+		"""
+		Returns the moments when the gate of a monophonic keyboard playing 
+		the notes is opened and closed (as taken by 'Gate.set_triggers'), it 
+		is open while any note is held
+		"""
+
+		presses = self.get_presses()
+		releases = self.get_releases()
+		if len(presses) == 0:
+			return presses
+
+		#a note pressed after all the previous ones are released opens it
+		ends = np.maximum.accumulate(releases)
+		opening = np.full(len(presses), True)
+		opening[1:] = presses[1:] >= ends[:-1]
+
+		#the gate is closed at the end of the notes held since the opening
+		closing = np.full(len(presses), True)
+		closing[:-1] = opening[1:]
+
+		ts = np.column_stack((presses[opening], ends[closing])).ravel()
+		if ts[-1] == const.inf:
+			ts = ts[:-1]
+
+		return ts
+
+	def get_played(self):
+		"""
+		Returns the moments when a monophonic keyboard playing the notes 
+		starts playing a note and the indices of the notes, it plays the last 
+		pressed of the held notes (and the last played one when none is held)
+		"""
+
+		presses = self.get_presses()
+		releases = self.get_releases()
+
+		#the notes played just before and just after every release
+		changes = releases[releases < const.inf]
+		before = find_held(presses, releases, changes, False)
+		after = find_held(presses, releases, changes, True)
+		changed = np.logical_and(after != -1, after != before)
+
+		steps = np.concatenate((presses, changes[changed]))
+		notes = np.concatenate((np.arange(len(presses)), after[changed]))
+
+		#the presses go first at the same moment
+		order = np.argsort(steps, kind='stable')
+		return steps[order], notes[order]
+
+	def get_key(self):
+		"""
+		Returns the moments when the key output of a monophonic keyboard 
+		playing the notes changes and its new pitches (as taken by 
+		'MonoKey.set_attributes'), the key goes back to a held note when a 
+		later one is released (see 'get_played')
+		"""
+
+		steps, notes = self.get_played()
+		return steps, self.get_pitches()[notes]
+
+	def get_controls(self, controller):
+		"""
+		Returns the moments (in seconds) when the value of a controller (a 
+		control change number or 'PITCH_BEND') is set and the values
+		"""
+
+		events = self.controllers == controller
+		return (
+			self.control_times[events] / np.float64(const.fs),
+			self.control_values[events]
+		)
+
+	def save(self, path):
+		"""Writes the index to an '.npz' file"""
+
+		columns = {name: getattr(self, name) for name, dtype in COLUMNS}
+		with open(path, 'wb') as file:
+			np.savez(file, format=FORMAT, fs=const.fs, **columns)
+
+def to_samples(ticks, tempos, ticks_per_beat):
+	"""
+	Returns the numbers of the samples at 'ticks' of a MIDI file, 'tempos' is 
+	its tempo map (a list of ticks of tempo changes and the tempos)
+	"""
+
+	#a tempo lasts until the next change
+	tempo_ticks, tempo_values = [np.array(column) for column in zip(*tempos)]
+	order = np.argsort(tempo_ticks, kind='stable')
+	tempo_ticks, tempo_values = tempo_ticks[order], tempo_values[order]
+	rates = tempo_values / (1e6*ticks_per_beat)		#seconds per tick
+	starts = np.zeros(len(rates))
+	starts[1:] = np.cumsum(np.diff(tempo_ticks)*rates[:-1])
+
+	tempo = np.searchsorted(tempo_ticks, ticks, side='right') - 1
+	seconds = starts[tempo] + (ticks - tempo_ticks[tempo])*rates[tempo]
+	return np.rint(seconds*const.fs).astype(np.int64)
+
+def parse(filename):
+	"""
+	Returns the 'MidiIndex' of the notes and the controller events of a 
+	MIDI file
+	"""
+
+	mid = mido.MidiFile(filename)
+
+	#note events: ticks, presses (or releases) and the columns of the notes
+	events = []
+	controls = []				#ticks and the columns of controller events
+	tempos = [(0, 500000)]		#ticks of tempo changes and the tempos
+
+	for track, messages in enumerate(mid.tracks):
+		tick = 0
+		for msg in messages:
+			tick += msg.time
+
+			if msg.type == 'set_tempo':
+				tempos.append((tick, msg.tempo))
+			elif msg.type == 'note_on' or msg.type == 'note_off':
+				press = msg.type == 'note_on' and msg.velocity > 0
+				events.append(
+					(tick, press, msg.note, msg.velocity, msg.channel, track)
+				)
+			elif msg.type == 'control_change':
+				controls.append(
+					(tick, msg.control, msg.value, msg.channel, track)
+				)
+			elif msg.type == 'pitchwheel':
+				controls.append(
+					(tick, PITCH_BEND, msg.pitch, msg.channel, track)
+				)
+
+	#events at the same tick are in the order of tracks (as merged by mido)
+	columns = {}
+	if controls != []:
+		controls = np.array(controls, dtype=np.int64)
+		controls = controls[np.argsort(controls[:, 0], kind='stable')]
+		columns['control_times'] = to_samples(
+			controls[:, 0], tempos, mid.ticks_per_beat
+		)
+		for i, (name, dtype) in enumerate(CONTROL_COLUMNS[1:]):
+			columns[name] = controls[:, i + 1]
+
+	if events == []:
+		return MidiIndex(**columns)
+
+	ticks, presses, notes, velocities, channels, tracks = [
+		np.array(column) for column in zip(*events)
+	]
+
+	order = np.argsort(ticks, kind='stable')
+	ticks, presses, notes, velocities, channels, tracks = [
+		column[order]
+		for column in (ticks, presses, notes, velocities, channels, tracks)
+	]
+	samples = to_samples(ticks, tempos, mid.ticks_per_beat)
+
+	"""
+	the events of every key (a note on a channel) are grouped in order, a 
+	release releases the earliest held note of the key, releases when no 
+	note is held are ignored
+	"""
+	keys = channels.astype(np.int64)*128 + notes
+	order = np.lexsort((np.arange(len(keys)), keys))
+	group_keys = keys[order]
+	pressing = presses[order]
+
+	first = np.full(len(keys), True)
+	first[1:] = group_keys[1:] != group_keys[:-1]
+	group = np.cumsum(first) - 1
+	group_starts = np.flatnonzero(first)
+
+	"""
+	the numbers of held notes after every event, the sum of presses (1) and 
+	releases (-1) within a key reflected at 0, so that ignored releases 
+	don't make it negative (the groups are shifted down, so that the 
+	running minimum doesn't reach back to the previous ones)
+	"""
+	shift = group*(2*len(keys) + 1)
+	sums = np.cumsum(np.where(pressing, 1, -1))
+	sums -= np.repeat(
+		sums[group_starts] - np.where(pressing[group_starts], 1, -1),
+		np.diff(np.append(group_starts, len(keys)))
+	)
+	lowest = np.minimum.accumulate(sums - shift) + shift
+	held = sums - np.minimum(lowest, 0)
+
+	#a release is effective if a note was held before it
+	previous = np.zeros(len(keys), dtype=held.dtype)
+	previous[1:] = held[:-1]
+	previous[first] = 0
+	effective = np.logical_and(np.logical_not(pressing), previous > 0)
+
+	#the n-th effective release of a key releases its n-th press
+	size = len(keys)
+	press_numbers = group*size + ranks(pressing, group, group_starts)
+	release_numbers = group*size + ranks(effective, group, group_starts)
+	press_numbers = press_numbers[pressing]
+	release_numbers = release_numbers[effective]
+
+	released = np.isin(press_numbers, release_numbers)
+	grouped_offsets = np.full(np.count_nonzero(pressing), HELD, dtype=np.int64)
+	grouped_offsets[released] = samples[order][effective][
+		np.searchsorted(release_numbers, press_numbers[released])
+	]
+
+	#the offsets in the order of events
+	offsets = np.full(len(keys), HELD, dtype=np.int64)
+	offsets[order[pressing]] = grouped_offsets
+
+	#the notes in the order of presses
+	return MidiIndex(
+		onsets=samples[presses], offsets=offsets[presses],
+		notes=notes[presses], velocities=velocities[presses],
+		channels=channels[presses], tracks=tracks[presses], **columns
+	)
+
+def ranks(selected, group, group_starts):
+	"""
+	Returns the number of selected items before every item within its group 
+	(items are grouped by consecutive 'group' numbers)
+	"""
+
+	counts = np.cumsum(selected) - selected
+	return counts - counts[group_starts][group]
+
+def find_held(presses, releases, times, strict=True):
+	"""
+	Returns the index of the last pressed of the notes held at every moment 
+	of 'times' ('-1' if none), a note released at the moment is held unless 
+	'strict' is 'True'
+	"""
+
+	#'latest[k][i]' is the latest release of the notes from i to i + 2**k - 1
+	latest = [releases]
+	while 2**len(latest) <= len(releases):
+		size = 2**(len(latest) - 1)
+		latest.append(np.maximum(latest[-1][:-size], latest[-1][size:]))
+
+	"""
+	the search starts from the last note pressed up to every moment and 
+	moves back over blocks of notes (of 2**k notes, from the longest) 
+	released before the moment, for all moments at once
+	"""
+	held = np.searchsorted(presses, times, side='right') - 1
+	for k in reversed(range(len(latest))):
+		starts = held - 2**k + 1
+		skipped = starts >= 0
+
+		ends = latest[k][starts[skipped]]
+		if strict:
+			skipped[skipped] = ends <= times[skipped]
+		else:
+			skipped[skipped] = ends < times[skipped]
+
+		held[skipped] -= 2**k
+
+	return held
+
+def get_index_path(filename):
+	"""Returns the path of the cached index of a MIDI file"""
+	return filename + '.npz'
+
+def read_index(filename):
+	"""
+	Returns the 'MidiIndex' of a MIDI file, the index is parsed once and 
+	cached next to the file (see 'get_index_path'), it is parsed again when 
+	the file is newer
+	"""
+
+	path = get_index_path(filename)
+	try:
+		if os.path.getmtime(path) >= os.path.getmtime(filename):
+			with np.load(path) as data:
+				if data['format'] == FORMAT and data['fs'] == const.fs:
+					return MidiIndex(**{
+						name: data[name] for name, dtype in COLUMNS
+					})
+	except (OSError, KeyError, ValueError):
+		pass
+
+	index = parse(filename)
+
+	#a file in a read-only directory is parsed every time
+	try:
+		index.save(path)
+	except OSError:
+		pass
+
+	return index
+
+
+if __name__ == '__main__':
+
+	#tests
+	import sys
+	import tempfile
+
+	directory = tempfile.mkdtemp()
+	filename = os.path.join(directory, 'test.mid')
+
+	#2 tracks of notes and a tempo change in the first track
+	mid = mido.MidiFile(ticks_per_beat=480)
+	mid.tracks.append(mido.MidiTrack([
+		mido.MetaMessage('set_tempo', tempo=500000, time=0),
+		mido.MetaMessage('set_tempo', tempo=250000, time=960),
+	]))
+	mid.tracks.append(mido.MidiTrack([
+		mido.Message('note_on', note=60, velocity=100, time=0),
+		mido.Message('note_off', note=60, time=480),
+		mido.Message('note_on', note=64, velocity=90, time=480),
+		mido.Message('note_on', note=64, velocity=80, time=240),
+		mido.Message('note_on', note=64, velocity=0, time=240),
+		mido.Message('note_off', note=64, time=480),
+		mido.Message('note_off', note=67, time=0),
+	]))
+	mid.tracks.append(mido.MidiTrack([
+		mido.Message('note_on', note=62, velocity=70, channel=1, time=480),
+	]))
+
+	#and a track of controller events
+	mid.tracks.append(mido.MidiTrack([
+		mido.Message('control_change', control=1, value=64, time=0),
+		mido.Message('pitchwheel', pitch=4096, time=480),
+		mido.Message('control_change', control=7, value=100, time=480),
+		mido.Message('pitchwheel', pitch=-8192, time=240),
+	]))
+	mid.save(filename)
+
+	def samples(seconds):
+		return np.rint(np.array(seconds)*const.fs).astype(np.int64)
+
+	expected = MidiIndex(
+		onsets=samples([0.0, 0.5, 1.0, 1.125]),
+		offsets=np.where(
+			[True, False, True, True], samples([0.5, 0.0, 1.25, 1.5]), HELD
+		),
+		notes=[60, 62, 64, 64], velocities=[100, 70, 90, 80],
+		channels=[0, 1, 0, 0], tracks=[1, 2, 1, 1],
+		control_times=samples([0.0, 0.5, 1.0, 1.125]),
+		controllers=[1, PITCH_BEND, 7, PITCH_BEND],
+		control_values=[64, 4096, 100, -8192],
+		control_channels=[0, 0, 0, 0], control_tracks=[3, 3, 3, 3]
+	)
+
+	for name in ['parsed', 'cached']:
+		index = read_index(filename)
+		equal = all(
+			np.array_equal(getattr(index, column), getattr(expected, column))
+			for column, dtype in COLUMNS
+		)
+		print(name, os.path.exists(get_index_path(filename)), equal)
+		if not equal:
+			sys.exit(1)
+
+	#a monophonic keyboard playing the notes of the first channel
+	index = index.select(channel=0)
+	gate = index.get_gate()
+	steps, pitches = index.get_key()
+	print('gate', gate, 'key', steps, pitches)
+	if not (
+		np.array_equal(gate, samples([0.0, 0.5, 1.0, 1.5]) / const.fs) and 
+		np.array_equal(steps, samples([0.0, 1.0, 1.125]) / const.fs) and 
+		np.array_equal(pitches, [-9, -5, -5])
+	):
+		sys.exit(1)
+
+	#the key goes back to a held note when a later one is released
+	index = MidiIndex(
+		onsets=samples([0.0, 1.0]), offsets=samples([2.0, 1.5]),
+		notes=[69, 81]
+	)
+	steps, pitches = index.get_key()
+	print('legato', steps, pitches)
+	if not (
+		np.array_equal(steps, samples([0.0, 1.0, 1.5]) / const.fs) and 
+		np.array_equal(pitches, [0, 12, 0])
+	):
+		sys.exit(1)
+
+	#the outputs of a keyboard's velocity and controllers
+	from keyboard import MonoKeyboard
+	from mixer import Mixer
+	from oscillators import SineOscillator
+	from compiler import compile
+	from stream import Stream, sample_times
+
+	kbd = MonoKeyboard()
+	kbd.read_midi(filename, track=None, channel=0)
+	volume = kbd.get_control(7, default=1.0)
+
+	t = samples([0.25, 0.75, 1.0, 1.2]) / const.fs
+	outputs = [
+		kbd.velocity.output(t), kbd.pitch_bend.output(t), 
+		kbd.mod_wheel.output(t), volume.output(t)
+	]
+	print('controls', outputs)
+	if not all(np.array_equal(output, values) for output, values in zip(
+		outputs, [
+			np.array([100, 100, 90, 80]) / 127.0, [0.0, 1.0, 1.0, -2.0], 
+			np.full(4, 64 / 127.0), [1.0, 1.0, 100 / 127.0, 100 / 127.0]
+		]
+	)):
+		sys.exit(1)
+
+	#a linear glide to every value, ending when it is set
+	kbd.pitch_bend.set_ramp(0.25)
+	bend = kbd.pitch_bend.output(np.array([0.25, 0.375, 0.5, 0.75, 1.125]))
+	print('glide', bend)
+	if not np.allclose(bend, [0.0, 0.5, 1.0, 1.0, -2.0]):
+		sys.exit(1)
+
+	#a controller as the level of a mixer, interpreted and compiled
+	osc = SineOscillator(220.0)
+	mixer = Mixer()
+	mixer.add_input(osc, kbd.velocity)
+	mixer.add_input(SineOscillator(330.0), 0.5)
+
+	t = sample_times(0, samples(1.5))
+	expected = kbd.velocity.output(t)*osc.output(t) + 0.5*np.sin(
+		2*np.pi*330.0*t
+	)
+	outputs = [
+		np.concatenate(list(Stream(1024).render(generator, 1.5)))
+		for generator in [mixer, compile(mixer)]
+	]
+	equal = [np.allclose(output, expected) for output in outputs]
+	print('mixer level', equal)
+	if not all(equal):
+		sys.exit(1)
@@ -1,9 +1,18 @@
 import numpy as np
 
-from generators import Generator
+import constants as const
+from generators import Generator, output_method, find_active, output_audible
+from generators import zeros
+from stream import count_readers, fit
+from triggerables import Triggerable
 
 class Mixer(Generator):
-	"""A class to represent a mixer"""
+	"""
+	A class to represent a mixer
+
+	A level is a number or a generator (eg. a controller of a keyboard), 
+	whose output multiplies the input
+	"""
 
 	def __init__(self):
 		self.inputs = []	#list of inputs
@@ -15,30 +24,83 @@ class Mixer(Generator):
 		self.inputs.append(input)
 		self.levels.append(level)
 
+		self.touch()
+
 	def set_level(self, i, level):
 		"""Changes the level corresponding to the i-th input"""
 		self.levels[i] = level
+		self.touch()
 
 	def increase_level(self, i, level=0.01):
 		"""Increases the level corresponding to the i-th input"""
 		self.levels[i] += level
+		self.touch()
 
 	def decrease_level(self, i, level=0.01):
 		"""Decreases the level corresponding to the i-th input"""
 		self.increase_level(i, -level)
 
-	def output(self, t, **kwargs):
+	def get_inputs(self, ignore_mod=False):
+		"""Returns a list of modules whose outputs are read"""
+		return list(self.inputs) + [
+			level for level in self.levels if isinstance(level, Generator)
+		]
+
+	def get_active(self, t, **kwargs):
+		"""
+		Returns a boolean array telling where in time t the output may be 
+		non-zero ('None' if it is not known)
+		"""
+
+		if type(t) != np.ndarray:
+			return None
+
+		active = self.get_buffer(t, 'active', bool, kwargs.get('stream'))
+		active.fill(False)
+		for input in self.inputs:
+			input_active = find_active(input, t, **kwargs)
+			if input_active is None:
+				return None
+
+			active |= input_active
+
+		return active
+
+	@output_method
+	def output(self, t, out=None, **kwargs):
 		"""Returns the sum of the values of all inputs at time t"""
 		if self.inputs == []:
 			if type(t) == np.ndarray:
-				return np.full(t.shape, 0.0)
+				return zeros(t, out)
 			else:
 				return 0.0
-		else:
-			return np.sum(
-				self.levels[i]*self.inputs[i].output(t, **kwargs) 
-				for i in range(len(self.inputs))
-			)
+
+		#inputs are written to 'out' and a scratch buffer
+		buffer = self.get_buffer(t, 'input', stream=kwargs.get('stream'))
+
+		#the inputs may differ in shape (eg. voices of a keyboard)
+		#inputs silent in the whole block aren't evaluated
+		value = output_audible(self.inputs[0], t, out=out, **kwargs)
+		level = self.get_level(0, t, **kwargs)
+		output = np.multiply(level, value, out=fit(out, level, value))
+
+		for i in range(1, len(self.inputs)):
+			value = output_audible(self.inputs[i], t, out=buffer, **kwargs)
+			level = self.get_level(i, t, **kwargs)
+			value = np.multiply(level, value, out=fit(buffer, level, value))
+			output = np.add(output, value, out=fit(out, output, value))
+
+		return output
+
+	def get_level(self, i, t, **kwargs):
+		"""Returns the level of the i-th input at time t"""
+
+		level = self.levels[i]
+		if not isinstance(level, Generator):
+			return level
+
+		buffer = self.get_buffer(t, 'level', stream=kwargs.get('stream'))
+		return level.output(t, out=buffer, **kwargs)
 
 	def draw(self, ax, time=1.0, **kwargs):
 		"""
@@ -55,13 +117,98 @@ class Mixer(Generator):
 			except KeyError:
 				kwargs['alpha'] = 0.5
 
+			#only constant levels scale the input
+			level = self.levels[i]
+			if isinstance(level, Generator):
+				level = 1.0
+
 			try:
-				kwargs['scale'] *= self.levels[i]
+				kwargs['scale'] *= level
 			except KeyError:
-				kwargs['scale'] = self.levels[i]
+				kwargs['scale'] = level
 			
 			self.inputs[i].draw(ax, time, **kwargs)
 
+
+class VoiceMixer(Generator):
+	"""
+	A class to represent a mixer summing up the voices of a polyphonic 
+	keyboard ('PolyKeyboard')
+
+	The input is rendered only for the voices that sound in the current 
+	block, that is the voices with a note pressed or released no longer than 
+	the longest release of the envelopes triggered by the keyboard
+	"""
+
+	def __init__(self, keyboard, input=None, level=1.0):
+		self.keyboard = keyboard	#polyphonic keyboard
+		self.input = input			#patch rendering the voices
+		self.level = level			#loudness level
+
+	def set_input(self, input):
+		"""Sets the input of the mixer"""
+		self.input = input
+		self.touch()
+
+	def get_inputs(self, ignore_mod=False):
+		"""Returns a list of modules whose outputs are read"""
+		return [self.input]
+
+	def get_sources(self):
+		"""Returns a list of all modules the output depends on"""
+
+		#the notes are allocated to the voices by the keyboard
+		return [self.input, self.keyboard.key, self.keyboard.gate]
+
+	def is_pointwise(self, stream=None):
+		"""Returns 'True' if the output can be evaluated for any samples"""
+
+		#the sounding voices are chosen for the whole block
+		return False
+
+	def get_tail(self):
+		"""
+		Returns how long (in seconds) a voice sounds after a release, that is 
+		the longest release of the envelopes triggered by the keyboard
+		"""
+
+		tails = [
+			module.release_time() for module in count_readers(self.input)
+			if isinstance(module, Triggerable) and 
+			module.input is self.keyboard.gate
+		]
+
+		if tails == []:
+			#without envelopes the voices never stop sounding
+			return const.inf
+		else:
+			return max(tails)
+
+	@output_method
+	def output(self, t, stream=None, **kwargs):
+		"""Returns the sum of the voices at time t"""
+
+		if stream is None:
+			output = self.input.output(t, stream=stream, **kwargs)
+		else:
+			#the voices of another keyboard (or mixer) are set back after
+			voices = stream.voices
+			stream.voices = self.keyboard.get_voices(
+				t[0], t[-1], self.get_tail()
+			)
+			try:
+				output = self.input.output(t, stream=stream, **kwargs)
+			finally:
+				stream.voices = voices
+
+		#the output of modules that don't depend on the keyboard is not 
+		#split into voices
+		if np.ndim(output) == np.ndim(t) + 1:
+			output = np.sum(output, axis=0)
+
+		return self.level*output
+
+
 if __name__ == '__main__':
 
 	#tests
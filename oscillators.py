@@ -1,19 +1,78 @@
+from fractions import Fraction
+
 import numpy as np
-import sounddevice as sd
 
-from generators import Generator
+import constants as const
+import math_func as mf
+
+from generators import Generator, output_method
+from stream import fit, first_sample, sample_indices, sample_times
+from keyboard import MonoKey, PolyKey
+
+#the longest period (in samples) of an output whose cycles are cached
+MAX_PERIOD = const.fs
+
+#the least number of samples of the cached cycles
+MIN_CYCLES = 4096
+
+#parameters whose change invalidates the cached cycles
+CYCLE_PARAMS = ('freq', 'amp', 'phase', 'pw', 'table')
 
 class Oscillator(Generator):
 	"""A class to represent a basic oscillator"""
 
+	transient = Generator.transient + ('cycles',)
+
 	def __init__(self, key_in=None):
 		self.freq = 440.0 		#generators frequency
 		self.key_in = key_in	#keyboard input
+		self.table = None		#wavetable replacing 'np.sin' (if given)
+		self.cycles = None		#cached cycles of the output (see 'get_cycles')
 
 	def set_key_in(self, key_in):
 		self.key_in = key_in
+		self.touch()
 
-	def get_key_mod(self, t, ignore_mod=False, **kwargs):
+	def set_table(self, table):
+		"""
+		Sets a wavetable ('Wavetable' object) that is looked up instead of 
+		computing the sine wave, 'None' brings 'np.sin' back
+		"""
+		self.table = table
+
+		self.touch()
+
+	def get_inputs(self, ignore_mod=False):
+		"""Returns a list of modules whose outputs are read"""
+
+		if ignore_mod or self.key_in is None:
+			return []
+		else:
+			return [self.key_in]
+
+	def is_pointwise(self, stream=None):
+		"""Returns 'True' if the output can be evaluated for any samples"""
+
+		#the phase of other key inputs is accumulated sample by sample
+		if self.key_in is None or type(self.key_in) in (MonoKey, PolyKey):
+			return Generator.is_pointwise(self, stream)
+		else:
+			return False
+
+	def seek(self, start, stream):
+		"""
+		Sets the state of the module in 'stream' as if the samples before 
+		'start' were rendered (see 'Generator.seek')
+		"""
+
+		#the phase accumulated from other key inputs is known only by summing
+		#it sample by sample
+		return (
+			self.key_in is None or type(self.key_in) in (MonoKey, PolyKey) or 
+			start == 0
+		)
+
+	def get_key_mod(self, t, ignore_mod=False, out=None, **kwargs):
 		"""
 		Returns the value by which the basic frequency of the oscillator has to 
 		be multiplied in time t, due to keyboard input
@@ -21,14 +80,216 @@ class Oscillator(Generator):
 
 		if ignore_mod or self.key_in is None:
 			return 1.0
+
+		key = self.key_in.output(t, out=out, **kwargs)
+		key = np.divide(key, 12, out=fit(out, key))
+		return np.power(2, key, out=fit(out, key))
+
+	def get_phase(self, t, shift=0.0, ignore_mod=False, out=None, **kwargs):
+		"""
+		Returns the phase (in cycles) of the oscillator in time t (written to 
+		'out', if given)
+
+		The phase is the integral of the instantaneous frequency, so it stays 
+		continuous when the key input changes the pitch. 'shift' is the time 
+		by which the signal is shifted (used for phase modulation)
+		"""
+
+		if ignore_mod or self.key_in is None:
+			phase = np.add(t, shift, out=fit(out, t, shift))
+			return np.multiply(self.freq, phase, out=fit(out, phase))
+
+		if type(self.key_in) in (MonoKey, PolyKey):
+
+			#the integral of a keyboard's key input is known exactly
+			phase = self.key_in.key_mod_integral(t, out=out, **kwargs)
+			phase = np.multiply(self.freq, phase, out=fit(out, phase))
+
+			if type(shift) != np.ndarray and shift == 0.0:
+				return phase
+
+			buffer = self.get_buffer(t, 'key', stream=kwargs.get('stream'))
+			key_mod = self.get_key_mod(t, out=buffer, **kwargs)
+
 		else:
-			return 2**(self.key_in.output(t, **kwargs) / 12)
+			buffer = None
+			key_mod = self.get_key_mod(t, **kwargs)
+			phase = self.accumulate(self.freq*key_mod, t, **kwargs)
 
-	def output(self, t, **kwargs):
-		"""Returns the value of generators signal in time t"""
+		#the phase shift is 'key_mod*self.freq*shift'
+		key_mod = np.multiply(key_mod, self.freq, out=fit(buffer, key_mod))
+		key_mod = np.multiply(key_mod, shift, out=fit(buffer, key_mod, shift))
+		return np.add(phase, key_mod, out=fit(out, phase, key_mod))
+
+	def accumulate(self, freqs, t, stream=None, **kwargs):
+		"""
+		Returns the integral of instantaneous frequencies 'freqs' at sample 
+		times 't' (along the last axis, the rows of a 2D array are voices), 
+		the phase is carried from the previous block of 'stream'
+		"""
+
+		if type(t) != np.ndarray:
+			return freqs*t
+
+		freqs = np.broadcast_to(freqs, np.broadcast(freqs, t).shape)
+		if np.ndim(freqs) == 1:
+			state = None if stream is None else stream.get_state(self)
+			phases, state = self.integrate(freqs, t, state)
+
+			if stream is not None:
+				stream.set_state(self, state)
+
+			return phases
+
+		#every voice carries its own phase (a voice sounding again after the 
+		#blocks it was skipped in starts its phase anew)
+		states = [None]*len(freqs)
+		if stream is not None:
+			states = stream.get_voice_states(self, len(freqs))
+
+		phases = np.empty(freqs.shape)
+		for i in range(len(freqs)):
+			phases[i], states[i] = self.integrate(freqs[i], t, states[i])
+
+		if stream is not None:
+			stream.set_voice_states(self, len(freqs), states)
+
+		return phases
+
+	def integrate(self, freqs, t, state=None):
+		"""
+		Returns the integral of instantaneous frequencies 'freqs' (a 1D array) 
+		at sample times 't' and the state at the last sample, 'state' is the 
+		state at the end of the previous block ('None' for the first one)
+
+		The phase is the phase at the first sample of the signal plus a 
+		running sum of the increments, both are carried unreduced, so the 
+		signal rendered block by block is the same as rendered at once
+		"""
+
+		sums = np.empty(t.shape)
+		if state is None:
+			start = freqs[0]*t[0]
+			sums[0] = 0.0
+		else:
+			start, total, freq, time = state
+			sums[0] = total + freq*(t[0] - time)
+
+		np.multiply(freqs[:-1], np.diff(t), out=sums[1:])
+		np.cumsum(sums, out=sums)
+		state = (start, sums[-1], freqs[-1], t[-1])
+
+		return np.add(start, sums, out=sums), state
+
+	def wave(self, phase, out=None):
+		"""
+		Returns the value of the wave shape at given phase (in cycles), 'out' 
+		is a buffer it may be written to
+		"""
+
+		if self.table is None:
+			return np.sin(2*np.pi*phase)
+		else:
+			return self.table.lookup(phase)
+
+	def get_period(self):
+		"""
+		Returns the number of samples after which the output without the key 
+		input repeats exactly (a whole number of cycles at 'const.fs'), 'None' 
+		if it is longer than 'MAX_PERIOD'
+		"""
+
+		period = (Fraction(self.freq) / const.fs).denominator
+		if period > MAX_PERIOD:
+			return None
+
+		return period
+
+	def get_cycles(self):
+		"""
+		Returns whole cycles of the output without the key input (from time 0, 
+		at least 'MIN_CYCLES' samples long) and the period in samples, or 
+		'None' if the period is too long, they are computed again when any 
+		of the 'CYCLE_PARAMS' changes
+		"""
+
+		params = tuple(getattr(self, name, None) for name in CYCLE_PARAMS)
+		if self.cycles is not None and self.cycles[0] == params:
+			return self.cycles[1]
+
+		period = self.get_period()
+		if period is None:
+			self.cycles = (params, None)
+			return None
+
+		#every cycle is a copy of the first one, so that the value of a sample
+		#doesn't depend on where in the cycles the copying starts
+		t = sample_times(0, period)
+		cycle = self.wave(self.get_phase(t, ignore_mod=True), np.empty(period))
+		values = np.tile(cycle, -(-MIN_CYCLES // period))
+
+		self.cycles = (params, (values, period))
+		return self.cycles[1]
+
+	def output_periodic(
+		self, t, ignore_mod=False, shift=0.0, out=None, **kwargs
+	):
+		"""
+		Returns the value of the output signal in time t tiled from its cached 
+		cycles (see 'get_cycles'), 'None' if the output is not periodic or 
+		't' are not the moments of samples
+		"""
+
+		if not (ignore_mod or self.key_in is None):
+			return None
+		if type(shift) == np.ndarray or shift != 0.0:
+			return None
+		if type(t) != np.ndarray:
+			return None
+
+		cycles = self.get_cycles()
+		if cycles is None:
+			return None
+		values, period = cycles
+
+		"""
+		samples picked from a block (eg. the active ones) are looked up one 
+		by one, so that every sample has the same value however it is 
+		evaluated
+		"""
+		start = first_sample(t)
+		if start is None:
+			indices = sample_indices(t)
+			if indices is None:
+				return None
+
+			indices %= period
+			return np.take(values, indices, out=fit(out, t))
+
+		#the cycles are copied from the position of the first sample on
+		output = np.empty(t.shape) if fit(out, t) is None else out
+		position = start % period
+		i = 0
+		while i < len(t):
+			count = min(len(t) - i, len(values) - position)
+			output[i:i + count] = values[position:position + count]
+			i += count
+			position = 0
+
+		return output
+
+	@output_method
+	def output(self, t, out=None, **kwargs):
+		"""
+		Returns the value of generators signal in time t, tiled from its 
+		cached cycles if it is periodic (see 'output_periodic')
+		"""
 
-		key_mod = self.get_key_mod(t, **kwargs)
-		return np.sin(key_mod*self.freq*2*np.pi*t)
+		output = self.output_periodic(t, out=out, **kwargs)
+		if output is not None:
+			return output
+
+		return self.wave(self.get_phase(t, out=out, **kwargs), out)
 
 	def draw(self, ax, time=None, cycles=1 ,**kwargs):
 		"""Draws the signals wave shape"""
@@ -47,7 +308,9 @@ class Oscillator(Generator):
 class SineOscillator(Oscillator):
 	"""A class to represent a sine wave oscillator"""
 
-	def __init__(self, freq=440.0, amp=1.0, phase=0.0, key_in=None):
+	def __init__(
+		self, freq=440.0, amp=1.0, phase=0.0, key_in=None, table=None
+	):
 
 		#initialize essential parameters
 		Oscillator.__init__(self, key_in)
@@ -55,18 +318,28 @@ class SineOscillator(Oscillator):
 		self.freq = freq		#frequency
 		self.amp = amp			#amplitude
 		self.phase = phase		#phase
-
-	def output(self, t, **kwargs):
-		"""Returns the value of oscillators signal in time t"""
-		
-		key_mod = self.get_key_mod(t, **kwargs)
-		return self.amp*np.sin(key_mod*self.freq*2*np.pi*t + self.phase)
+		self.table = table		#sine wavetable (if 'None' 'np.sin' is used)
+
+	def wave(self, phase, out=None):
+		"""Returns the value of the wave shape at given phase (in cycles)"""
+
+		if self.table is None:
+			#'self.amp*np.sin(2*np.pi*phase + self.phase)' written to 'out'
+			out = fit(out, phase)
+			value = np.multiply(phase, 2*np.pi, out=out)
+			value = np.add(value, self.phase, out=out)
+			value = np.sin(value, out=out)
+			return np.multiply(self.amp, value, out=out)
+		else:
+			return self.amp*self.table.lookup(
+				phase + (self.phase / (2*np.pi))
+			)
 
 class SquareOscillator(Oscillator):
 	"""A class to represent a square wave oscillator"""
 
 	def __init__(self, freq=440.0, amp=1.0, phase=0.0, pw=0.5, key_in=None):
-		
+
 		#initialize essential parameters
 		Oscillator.__init__(self, key_in)
 
@@ -75,11 +348,10 @@ class SquareOscillator(Oscillator):
 		self.phase = phase		#phase
 		self.pw = pw			#pulse width
 
-	def output(self, t, **kwargs):
-		"""Returns the value of oscillators signal in time t"""
+	def wave(self, phase, out=None):
+		"""Returns the value of the wave shape at given phase (in cycles)"""
 
-		key_mod = self.get_key_mod(t, **kwargs)
-		current_phase = (key_mod*self.freq*t + (self.phase / (2*np.pi))) % 1.0
+		current_phase = (phase + (self.phase / (2*np.pi))) % 1.0
 
 		return self.amp*(2*np.float64(current_phase < self.pw) - 1)
 
@@ -87,7 +359,7 @@ class SawOscillator(Oscillator):
 	"""A class to represent a saw wave oscillator"""
 
 	def __init__(self, freq=440.0, amp=1.0, phase=0.0, key_in=None):
-		
+
 		#initialize essential parameters
 		Oscillator.__init__(self, key_in)
 
@@ -95,44 +367,39 @@ class SawOscillator(Oscillator):
 		self.amp = amp			#amplitude
 		self.phase = phase		#phase
 
-	def output(self, t, **kwargs):
-		"""Returns the value of oscillators signal in time t"""
-		
-		key_mod = self.get_key_mod(t, **kwargs)
-		return self.amp*(
-			-2*((key_mod*self.freq*t + (self.phase / (2*np.pi))) % 1.0) + 1
-		)
+	def wave(self, phase, out=None):
+		"""Returns the value of the wave shape at given phase (in cycles)"""
+		return self.amp*(-2*((phase + (self.phase / (2*np.pi))) % 1.0) + 1)
 
 class RampOscillator(SawOscillator):
 	"""A class to represent a ramp (inverse saw) wave oscillator"""
 
-	def output(self, t, **kwargs):
-		"""Returns the value of oscillators signal in time t"""
-		return -SawOscillator.output(self, t, **kwargs)
+	def wave(self, phase, out=None):
+		"""Returns the value of the wave shape at given phase (in cycles)"""
+		return -SawOscillator.wave(self, phase)
 
 class TriangleOscillator(Oscillator):
 	"""A class to represent a saw wave oscillator"""
 
 	def __init__(self, freq=440.0, amp=1.0, phase=0.0, pw=0.5, key_in=None):
-		
+
 		#initialize essential parameters
 		Oscillator.__init__(self, key_in)
 
 		self.freq = freq		#frequency
 		self.amp = amp			#amplitude
 		self.phase = phase		#phase
-		
+
 		"""
 		'pw' here means in what phase of the wave's cycle the signal stops 
 		ascending and starts descending (0 - at the beginning, 1 - at the end)
 		"""
 		self.pw = pw
 
-	def output(self, t, **kwargs):
-		"""Returns the value of oscillators signal in time t"""
+	def wave(self, phase, out=None):
+		"""Returns the value of the wave shape at given phase (in cycles)"""
 
-		key_mod = self.get_key_mod(t, **kwargs)
-		current_phase = (key_mod*self.freq*t + (self.phase / (2*np.pi))) % 1.0
+		current_phase = (phase + (self.phase / (2*np.pi))) % 1.0
 		square = np.float64(current_phase < self.pw)
 
 		return self.amp*(
@@ -143,6 +410,175 @@ class TriangleOscillator(Oscillator):
 		)
 
 
+class WavetableOscillator(Oscillator):
+	"""
+	A class to represent an oscillator playing an arbitrary single cycle wave 
+	shape stored in a wavetable ('Wavetable' object)
+	"""
+
+	def __init__(self, table, freq=440.0, amp=1.0, phase=0.0, key_in=None):
+
+		#initialize essential parameters
+		Oscillator.__init__(self, key_in)
+
+		self.table = table		#wavetable
+		self.freq = freq		#frequency
+		self.amp = amp			#amplitude
+		self.phase = phase		#phase
+
+	def wave(self, phase, out=None):
+		"""Returns the value of the wave shape at given phase (in cycles)"""
+		return self.amp*self.table.lookup(phase + (self.phase / (2*np.pi)))
+
+class BandLimited():
+	"""
+	A mother class of band-limited oscillators
+
+	The steps and corners of naive wave shapes are smoothed with polynomial 
+	residuals (PolyBLEP), which removes most of the aliasing at 'const.fs' 
+	without oversampling
+	"""
+
+	def get_increment(self, phase, t, stream=None, state=None, **kwargs):
+		"""
+		Returns the phase increment (in cycles) per sample at 'const.fs' for 
+		phases 'phase' at times 't', 'state' is the last phase and time of the 
+		previous block (it is taken from 'stream' if given)
+		"""
+
+		if type(t) != np.ndarray:
+			return np.abs(self.freq) / np.float64(const.fs)
+
+		if np.ndim(phase) == 2:
+			#voices of a polyphonic keyboard are band-limited one by one
+			states = [None]*len(phase)
+			if stream is not None:
+				states = stream.get_voice_states(self, len(phase))
+
+			increment = np.empty(phase.shape)
+			for i in range(len(phase)):
+				increment[i] = self.get_increment(
+					phase[i], t, state=states[i]
+				)
+				states[i] = (phase[i, -1], t[-1])
+
+			if stream is not None:
+				stream.set_voice_states(self, len(phase), states)
+
+			return increment
+
+		increment = np.empty(t.shape)
+
+		#the increment of the first sample follows the previous block
+		if stream is not None:
+			state = stream.get_state((self, 'phase'))
+
+		if state is not None:
+			last_phase, last_t = state
+			increment[0] = (phase[0] - last_phase) / (t[0] - last_t)
+		elif len(t) > 1:
+			increment[0] = (phase[1] - phase[0]) / (t[1] - t[0])
+		else:
+			increment[0] = self.freq
+
+		increment[1:] = np.diff(phase) / np.diff(t)
+
+		if stream is not None:
+			stream.set_state((self, 'phase'), (phase[-1], t[-1]))
+
+		#frequencies above the Nyquist frequency can't be band-limited anyway
+		return np.clip(np.abs(increment) / const.fs, 1e-9, 0.5)
+
+	def residual(self, phase, increment):
+		"""Returns the correction of the naive wave shape"""
+		return 0.0
+
+	def is_pointwise(self, stream=None):
+		"""Returns 'True' if the output can be evaluated for any samples"""
+
+		#the increment is measured between samples
+		return False
+
+	def seek(self, start, stream):
+		"""
+		Sets the state of the module in 'stream' as if the samples before 
+		'start' were rendered (see 'Generator.seek')
+		"""
+
+		if not Oscillator.seek(self, start, stream):
+			return False
+		elif start == 0:
+			return True
+
+		#the states of the voices depend on which of them sounded
+		if type(self.key_in) == PolyKey:
+			return False
+
+		#the phase of the last sample is known exactly
+		t = sample_times(start - 1, start)
+		stream.set_state((self, 'phase'), (self.get_phase(t)[-1], t[-1]))
+		return True
+
+	@output_method
+	def output(self, t, **kwargs):
+		"""Returns the value of oscillators signal in time t"""
+
+		phase = self.get_phase(t, **kwargs)
+		increment = self.get_increment(phase, t, **kwargs)
+
+		return self.wave(phase) + self.residual(phase, increment)
+
+class BLSquareOscillator(BandLimited, SquareOscillator):
+	"""A class to represent a band-limited square wave oscillator"""
+
+	def residual(self, phase, increment):
+		"""Returns the correction of the naive wave shape"""
+
+		current_phase = (phase + (self.phase / (2*np.pi))) % 1.0
+
+		return self.amp*(
+			mf.polyblep(current_phase, increment) - 
+			mf.polyblep((current_phase - self.pw) % 1.0, increment)
+		)
+
+class BLSawOscillator(BandLimited, SawOscillator):
+	"""A class to represent a band-limited saw wave oscillator"""
+
+	def residual(self, phase, increment):
+		"""Returns the correction of the naive wave shape"""
+
+		current_phase = (phase + (self.phase / (2*np.pi))) % 1.0
+
+		return self.amp*mf.polyblep(current_phase, increment)
+
+class BLRampOscillator(BLSawOscillator):
+	"""A class to represent a band-limited ramp (inverse saw) wave oscillator"""
+
+	def wave(self, phase, out=None):
+		"""Returns the value of the wave shape at given phase (in cycles)"""
+		return -SawOscillator.wave(self, phase)
+
+	def residual(self, phase, increment):
+		"""Returns the correction of the naive wave shape"""
+		return -BLSawOscillator.residual(self, phase, increment)
+
+class BLTriangleOscillator(BandLimited, TriangleOscillator):
+	"""A class to represent a band-limited triangle wave oscillator"""
+
+	def residual(self, phase, increment):
+		"""Returns the correction of the naive wave shape"""
+
+		current_phase = (phase + (self.phase / (2*np.pi))) % 1.0
+
+		#the slope (per cycle) grows by 'corner' at phase 0 and falls by
+		#'corner' at phase 'pw'
+		corner = 2 / (self.pw*(1 - self.pw))
+
+		return self.amp*corner*increment*(
+			mf.polyblamp(current_phase, increment) - 
+			mf.polyblamp((current_phase - self.pw) % 1.0, increment)
+		)
+
 if __name__ == '__main__':
 
 	#tests
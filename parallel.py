@@ -0,0 +1,324 @@
+import multiprocessing
+import multiprocessing.pool
+import os
+from multiprocessing import resource_tracker, shared_memory
+
+import numpy as np
+
+from generators import output_method, output_audible
+from mixer import Mixer
+from stream import Stream, get_subgraph, sample_count
+
+def get_branches(mixer):
+	"""
+	Returns the inputs of 'mixer' grouped into independent branches (lists of 
+	indices of the inputs, in order), inputs sharing a module are in the same 
+	branch, unless the module is a leaf (like a key or a gate), which is 
+	cheap to evaluate in every branch
+	"""
+
+	#'groups[i]' is the index of a branch joined with the i-th one
+	groups = list(range(len(mixer.inputs)))
+
+	def find(i):
+		while groups[i] != i:
+			i = groups[i]
+		return i
+
+	owners = {}		#the first input reading every module
+	for i, input in enumerate(mixer.inputs):
+		for module in get_subgraph(input):
+			if module.get_sources() == []:
+				continue
+
+			if module in owners:
+				groups[find(i)] = find(owners[module])
+			else:
+				owners[module] = i
+
+	branches = {}
+	for i in range(len(mixer.inputs)):
+		branches.setdefault(find(i), []).append(i)
+
+	return sorted(branches.values())
+
+class Terms(Mixer):
+	"""
+	A class to represent the inputs of a mixer multiplied by their levels, 
+	the output is a 2D array (a row per input), so that the rows can be 
+	added up in the order of the inputs, as the mixer does
+	"""
+
+	@output_method
+	def output(self, t, out=None, **kwargs):
+		"""Returns the inputs' values multiplied by their levels in time t"""
+
+		output = np.empty((len(self.inputs),) + np.shape(t))
+		for i, input in enumerate(self.inputs):
+			value = output_audible(input, t, **kwargs)
+			np.multiply(self.get_level(i, t, **kwargs), value, out=output[i])
+
+		return output
+
+def render_task(task):
+	"""
+	Renders samples of a generator from 'start' to 'stop' in a worker of a 
+	'ParallelRenderer', the signal is written to a row of a shared memory 
+	block (or to a list of rows, one per row of a 2D signal, see 'Terms')
+	"""
+
+	generator, start, stop, block_size, name, shape, row = task
+
+	memory = shared_memory.SharedMemory(name=name)
+	try:
+		out = np.ndarray(shape, np.float64, memory.buf)
+
+		stream = Stream(block_size)
+		for block in stream.render_samples(generator, start, stop):
+			if np.ndim(block) != np.ndim(row) + 1:
+				raise ValueError('only 1D signals can be rendered in parallel')
+
+			out[row, stream.start:stream.stop] = block
+
+		del out
+	finally:
+		memory.close()
+
+	return row
+
+class ParallelRenderer():
+	"""
+	A class to represent a pool of worker processes (or threads) rendering 
+	independent signals at the same time
+
+	The workers render whole signals block by block and write them to shared 
+	memory, so no arrays are pickled. The patches are sent to the workers, so 
+	they have to be picklable.
+	"""
+
+	def __init__(self, processes=None, block_size=4096, threads=False):
+		if processes is None:
+			processes = os.cpu_count()
+
+		self.processes = processes		#number of workers
+		self.block_size = block_size	#number of samples in a block
+
+		"""
+		a worker attaching to a shared memory block registers it with the 
+		resource tracker of its process, which would report it as leaked (and 
+		fail to unlink it again) if the worker had its own tracker, so the 
+		workers inherit the tracker of this process, where the block is 
+		unlinked
+		"""
+		if not threads and os.name == 'posix':
+			resource_tracker.ensure_running()
+
+		if threads:
+			self.pool = multiprocessing.pool.ThreadPool(processes)
+		elif 'fork' in multiprocessing.get_all_start_methods():
+			#forked workers start without importing the modules again
+			self.pool = multiprocessing.get_context('fork').Pool(processes)
+		else:
+			self.pool = multiprocessing.Pool(processes)
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, *args):
+		self.close()
+
+	def close(self):
+		"""Stops the workers"""
+		self.pool.close()
+		self.pool.join()
+
+	def run(self, generators, time=1.0):
+		"""
+		Returns the signals of 'generators' for 'time' seconds (a row per 
+		generator), rendered by the workers
+		"""
+
+		length = sample_count(time)
+		parts = [
+			(generator, 0, length, row)
+			for row, generator in enumerate(generators)
+		]
+
+		return self.run_parts(parts, (len(generators), length))
+
+	def run_parts(self, parts, shape):
+		"""
+		Returns an array of given shape with the parts of signals rendered by 
+		the workers, a part '(generator, start, stop, row)' is the samples of 
+		'generator' from 'start' to 'stop', written to the row 'row' (or to 
+		the rows of a list, for a 2D signal)
+		"""
+
+		memory = shared_memory.SharedMemory(
+			create=True, size=max(1, 8*shape[0]*shape[1])
+		)
+
+		try:
+			tasks = [(
+				generator, start, stop, self.block_size, memory.name, shape,
+				row
+			) for generator, start, stop, row in parts]
+			self.pool.map(render_task, tasks, chunksize=1)
+
+			signals = np.ndarray(shape, np.float64, memory.buf)
+			output = np.copy(signals)
+			del signals
+		finally:
+			memory.close()
+			memory.unlink()
+
+		return output
+
+	def render(self, generator, time=1.0):
+		"""
+		Returns the signal of 'generator' for 'time' seconds, the independent 
+		branches of a mixer (see 'get_branches') are rendered in parallel
+
+		Every branch gives the mixer's inputs in it multiplied by their levels 
+		(see 'Terms'), they are added up in the order of the inputs, so the 
+		signal is the same as the mixer's output, even if the branches 
+		interleave.
+		"""
+
+		if type(generator) != Mixer or len(generator.inputs) < 2:
+			return self.run([generator], time)[0]
+
+		length = sample_count(time)
+		parts = []
+		for branch in get_branches(generator):
+			terms = Terms()
+			for i in branch:
+				terms.add_input(generator.inputs[i], generator.levels[i])
+			parts.append((terms, 0, length, branch))
+
+		signals = self.run_parts(parts, (len(generator.inputs), length))
+
+		output = signals[0]
+		for signal in signals[1:]:
+			output += signal
+
+		return output
+
+	def render_batch(self, generators, time=1.0):
+		"""
+		Returns a list of the signals of 'generators' (eg. patches playing 
+		different MIDI tracks or songs) for 'time' seconds, rendered in 
+		parallel
+		"""
+		return list(self.run(generators, time))
+
+	def render_chunks(self, generator, time=1.0, chunks=None):
+		"""
+		Returns the signal of 'generator' for 'time' seconds, split in time 
+		into 'chunks' parts (one per worker by default) rendered in parallel
+
+		Every worker starts its chunk from the states the modules find at its 
+		first sample (see 'Generator.seek'), eg. the phases of oscillators 
+		and the envelopes follow from the keyboard's notes, so the earlier 
+		chunks are not rendered again. The signal is the same as rendered 
+		from the beginning in one piece.
+		"""
+
+		if chunks is None:
+			chunks = self.processes
+
+		#the chunks begin at the beginnings of blocks
+		length = sample_count(time)
+		blocks = -(-length // self.block_size)
+		starts = [blocks*i // chunks * self.block_size for i in range(chunks)]
+		stops = starts[1:] + [length]
+
+		parts = [
+			(generator, start, stop, 0)
+			for start, stop in zip(starts, stops) if start < stop
+		]
+		return self.run_parts(parts, (1, length))[0]
+
+
+if __name__ == '__main__':
+
+	#tests
+	import sys
+
+	from benchmark import danger_zone, danger_zone_dx6, fm_voice, MIDI
+	from keyboard import MonoKeyboard
+	from oscillators import SineOscillator, SquareOscillator
+	from amplifier import Amplifier
+	from triggerables import ADSR
+	from stream import sample_times
+
+	mixer, kbd = danger_zone()
+	time = 13.0
+	whole = mixer.output(sample_times(0, sample_count(time)))
+
+	#the stacks of operators share only the key and the gate
+	print('branches', get_branches(mixer))
+	if get_branches(mixer) != [[0], [1]]:
+		sys.exit(1)
+
+	#an envelope triggered by an oscillator is shared by 3 inputs
+	eg = ADSR(0.1, 0.1, 0.5, 0.1, input=SquareOscillator(2.0))
+	shared = Mixer()
+	for i in range(3):
+		osc = SineOscillator(110.0*(i + 1))
+		shared.add_input(Amplifier(input=osc, mod=eg))
+	shared.add_input(SineOscillator(55.0))
+	print('shared branches', get_branches(shared))
+	if get_branches(shared) != [[0, 1, 2], [3]]:
+		sys.exit(1)
+
+	#branches interleaving in the order of the inputs
+	interleaved = Mixer()
+	interleaved.add_input(Amplifier(input=SineOscillator(110.0), mod=eg), 0.3)
+	interleaved.add_input(SineOscillator(55.0), 0.7)
+	interleaved.add_input(Amplifier(input=SineOscillator(330.0), mod=eg), 0.1)
+	print('interleaved branches', get_branches(interleaved))
+	if get_branches(interleaved) != [[0, 2], [1]]:
+		sys.exit(1)
+
+	for threads in [False, True]:
+		with ParallelRenderer(2, threads=threads) as renderer:
+			output = renderer.render(mixer, time)
+			mixed = renderer.render(interleaved, time)
+
+			#patches playing different MIDI files
+			voices = []
+			for name in ['wlazkoteknaplotek_mono.mid', 'dangerzonebass.mid']:
+				voice_kbd = MonoKeyboard()
+				voice_kbd.read_midi(os.path.join(MIDI, name))
+				voices.append(fm_voice(voice_kbd))
+			outputs = renderer.render_batch(voices, 8.0)
+
+		t = sample_times(0, sample_count(8.0))
+		equal = [
+			np.array_equal(output, whole), np.array_equal(
+				mixed, interleaved.output(sample_times(0, sample_count(time)))
+			)
+		] + [
+			np.array_equal(out, voice.output(t))
+			for out, voice in zip(outputs, voices)
+		]
+		print('threads' if threads else 'processes', equal)
+		if not all(equal):
+			sys.exit(1)
+
+	#the timeline split into chunks
+	patches = [
+		('DX', danger_zone()[0]), ('LinearFM', danger_zone('LinearFM')[0]),
+		('feedback', danger_zone(feedback=0.2)[0]),
+		('DX6Voice', danger_zone_dx6(feedback=0.2)[0])
+	]
+	with ParallelRenderer(2) as renderer:
+		for name, patch in patches:
+			serial = np.concatenate(list(Stream(4096).render(patch, time)))
+			equal = [np.array_equal(
+				renderer.render_chunks(patch, time, chunks), serial
+			) for chunks in [2, 5]]
+			print('chunks', name, equal)
+			if not all(equal):
+				sys.exit(1)
@@ -0,0 +1,301 @@
+import queue
+import threading
+import time as clock
+
+import numpy as np
+
+import constants as const
+from stream import Stream, sample_count
+from wavfile import WavFile
+
+class Player():
+	"""
+	A class to represent a real-time playback of a generator's signal
+
+	The signal is rendered block by block in a separate thread, at most
+	'lookahead' blocks ahead of the playback. The blocks are pulled by a sink
+	(a sound device or a simulated one), when the next block is not ready in
+	time, silence is played instead and an underrun is counted.
+	"""
+
+	def __init__(
+		self, generator, time=1.0, block_size=1024, lookahead=4, sink=None, 
+		cache=None
+	):
+		self.generator = generator		#played generator
+		self.cache = cache				#'DiskCache' of rendered signals
+		self.time = time				#playback length (in seconds)
+		self.block_size = block_size	#number of samples in a block
+		self.lookahead = lookahead		#number of blocks rendered ahead
+
+		if sink is None:
+			sink = DeviceSink()
+		self.sink = sink				#the sink pulling the blocks
+
+		self.queue = queue.Queue(lookahead)		#rendered blocks
+		self.finished = threading.Event()		#set at the end of playback
+		self.stopped = threading.Event()		#set when stopped by 'stop'
+		self.error = None				#exception raised while rendering
+
+		#statistics
+		self.blocks = 0				#number of played blocks
+		self.underruns = 0			#number of blocks that were not ready
+		self.render_times = []		#render times of blocks (in seconds)
+
+	def render(self):
+		"""Renders the blocks ahead of the playback"""
+
+		try:
+			if self.cache is None:
+				blocks = Stream(self.block_size).render(
+					self.generator, self.time
+				)
+			else:
+				blocks = self.cache.blocks(
+					self.generator, self.time, self.block_size
+				)
+			while True:
+				start = clock.perf_counter()
+				try:
+					block = next(blocks)
+				except StopIteration:
+					break
+				self.render_times.append(clock.perf_counter() - start)
+
+				if not self.put(block):
+					break
+
+		except Exception as error:
+			self.error = error
+
+		finally:
+			#mark the end of the signal
+			self.put(None)
+
+	def put(self, block):
+		"""
+		Puts 'block' to the queue once there is room for it, returns 'False' 
+		if the playback is stopped before (nobody reads the queue then)
+		"""
+
+		while not self.stopped.is_set():
+			try:
+				self.queue.put(block, timeout=0.01)
+				return True
+			except queue.Full:
+				pass
+
+		return False
+
+	def next_block(self, out, wait=False):
+		"""
+		Fills 'out' with the next block, returns the number of filled samples 
+		('None' when the signal has ended)
+
+		If 'wait' is 'False' and the block is not rendered yet, 'out' is
+		filled with silence
+		"""
+
+		try:
+			block = self.queue.get(wait)
+		except queue.Empty:
+			out[:] = 0.0
+			self.underruns += 1
+			return len(out)
+
+		if block is None:
+			out[:] = 0.0
+			self.finished.set()
+			return None
+
+		out[:len(block)] = block
+		out[len(block):] = 0.0
+		self.blocks += 1
+
+		return len(block)
+
+	def start(self):
+		"""Starts the playback"""
+
+		self.renderer = threading.Thread(target=self.render, daemon=True)
+		self.renderer.start()
+
+		#wait until the lookahead is filled (or the signal is short)
+		length = sample_count(self.time)
+		blocks = -(-length // self.block_size)
+		while self.queue.qsize() < min(self.lookahead, blocks):
+			if not self.renderer.is_alive():
+				break
+			clock.sleep(0.001)
+
+		self.sink.start(self)
+
+	def wait(self):
+		"""Waits until the playback ends"""
+
+		self.finished.wait()
+		self.sink.stop()
+
+		if self.error is not None:
+			raise self.error
+
+	def stop(self):
+		"""Stops the playback (and the rendering)"""
+
+		self.stopped.set()
+		self.sink.stop()
+		self.finished.set()
+
+	def report(self):
+		"""Returns a summary of the playback statistics"""
+
+		duration = 1000.0*self.block_size / const.fs
+		if self.render_times == []:
+			render = 0.0
+			worst = 0.0
+		else:
+			render = 1000.0*np.mean(self.render_times)
+			worst = 1000.0*np.max(self.render_times)
+
+		return (
+			'%d blocks played, %d underruns, block render time: '
+			'mean %.2f ms, max %.2f ms (block length %.2f ms)' % (
+				self.blocks, self.underruns, render, worst, duration
+			)
+		)
+
+class DeviceSink():
+	"""A class to represent a sound device pulling blocks from a player"""
+
+	def start(self, player):
+		"""Starts pulling blocks from 'player'"""
+
+		import sounddevice as sd
+
+		def callback(outdata, frames, time, status):
+			if player.next_block(outdata[:, 0]) is None:
+				raise sd.CallbackStop
+
+		self.stream = sd.OutputStream(
+			samplerate=const.fs, blocksize=player.block_size, channels=1,
+			dtype='float32', callback=callback,
+			finished_callback=player.finished.set
+		)
+		self.stream.start()
+
+	def stop(self):
+		"""Stops pulling blocks"""
+		self.stream.stop()
+
+class NullSink():
+	"""
+	A class to represent a simulated sound device, it pulls blocks from a
+	player at the times a sound device would, but discards them
+
+	'speed' is the pace of the simulated clock as a multiple of real time, if
+	it is 'None' the sink waits for every block (so there are no underruns)
+	"""
+
+	def __init__(self, speed=1.0):
+		self.speed = speed
+		self.running = False
+
+	def start(self, player):
+		"""Starts pulling blocks from 'player'"""
+
+		self.running = True
+		self.thread = threading.Thread(
+			target=self.run, args=(player,), daemon=True
+		)
+		self.thread.start()
+
+	def run(self, player):
+		"""Pulls blocks from 'player' until the signal ends"""
+
+		out = np.zeros(player.block_size)
+		start = clock.perf_counter()
+		block = 0
+
+		while self.running:
+			if self.speed is not None:
+
+				#wait for the moment the block would be needed
+				deadline = start + (
+					block*player.block_size / np.float64(const.fs) / self.speed
+				)
+				delay = deadline - clock.perf_counter()
+				if delay > 0:
+					clock.sleep(delay)
+
+			length = player.next_block(out, wait=self.speed is None)
+			if length is None:
+				break
+
+			self.write(out[:length])
+			block += 1
+
+		self.running = False
+
+	def write(self, block):
+		"""Consumes a played block"""
+		pass
+
+	def stop(self):
+		"""Stops pulling blocks"""
+
+		self.running = False
+		if self.thread is not threading.current_thread():
+			self.thread.join()
+
+class FileSink(NullSink):
+	"""
+	A class to represent a simulated sound device that writes the played
+	blocks to a 16-bit WAV file
+	"""
+
+	def __init__(self, path, speed=None):
+		NullSink.__init__(self, speed)
+		self.path = path
+
+	def run(self, player):
+		"""Pulls blocks from 'player' until the signal ends"""
+
+		self.file = WavFile(self.path)
+
+		try:
+			NullSink.run(self, player)
+		finally:
+			self.file.close()
+
+	def write(self, block):
+		"""Writes a played block to the file"""
+
+		self.file.write(block)
+
+
+if __name__ == '__main__':
+
+	#tests
+	from oscillators import SineOscillator
+	from amplifier import Amplifier
+
+	osc = SineOscillator(440.0)
+	lfo = SineOscillator(0.5)
+	amp = Amplifier(0.5, osc, lfo)
+
+	player = Player(amp, 2.0, block_size=512, sink=NullSink())
+	player.start()
+	player.wait()
+	print(player.report())
+
+	#a stopped playback stops the rendering, though the queue is full
+	import sys
+
+	player = Player(amp, 60.0, block_size=512, sink=NullSink(speed=0.01))
+	player.start()
+	player.stop()
+	player.renderer.join(1.0)
+
+	print('stopped', not player.renderer.is_alive())
+	if player.renderer.is_alive():
+		sys.exit(1)
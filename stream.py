@@ -0,0 +1,571 @@
+import numpy as np
+
+import constants as const
+
+def sample_count(time):
+	"""Returns the number of samples in 'time' seconds"""
+	return int(time*const.fs)
+
+def sample_times(start, stop):
+	"""Returns the moments (in seconds) of samples from 'start' to 'stop'"""
+	return np.arange(start, stop) / np.float64(const.fs)
+
+def first_sample(t):
+	"""
+	Returns the number of the first sample if 't' are the moments of 
+	consecutive samples (as given by 'sample_times'), otherwise 'None'
+	"""
+
+	if type(t) != np.ndarray or np.ndim(t) != 1 or len(t) == 0:
+		return None
+
+	first = t[0]*const.fs
+	last = t[-1]*const.fs
+	start = int(round(first))
+	if abs(first - start) > 1e-6 or abs(last - (start + len(t) - 1)) > 1e-6:
+		return None
+
+	return start
+
+def sample_indices(t):
+	"""
+	Returns the numbers of the samples if 't' are moments of samples (not 
+	necessarily consecutive), otherwise 'None'
+	"""
+
+	if type(t) != np.ndarray or np.ndim(t) != 1:
+		return None
+
+	samples = t*const.fs
+	indices = np.rint(samples)
+	if np.any(np.abs(samples - indices) > 1e-6):
+		return None
+
+	return indices.astype(np.int64)
+
+def to_buffer(value, out=None):
+	"""
+	Returns 'value' written to the buffer 'out', if it is given and has the 
+	same shape, otherwise returns 'value'
+	"""
+
+	if out is None or value is out or np.shape(value) != out.shape:
+		return value
+
+	np.copyto(out, value)
+	return out
+
+def fit(out, *values):
+	"""
+	Returns 'out' if the result of an elementwise operation on 'values' 
+	(arrays or scalars) can be written to it, otherwise 'None'
+	"""
+
+	if out is None:
+		return None
+
+	for value in values:
+		if type(value) == np.ndarray and value.shape != out.shape:
+			return None
+
+	return out
+
+def count_readers(generator, ignore_mod=False):
+	"""
+	Returns a dictionary that maps modules of the graph rooted at 'generator' 
+	to the number of modules that read their output
+	"""
+
+	readers = {generator: 1}	#'generator' is read by the stream itself
+	visited = set()
+	stack = [generator]
+
+	while stack != []:
+		module = stack.pop()
+		if module in visited:
+			continue
+		visited.add(module)
+
+		for input in module.get_inputs(ignore_mod):
+			readers[input] = readers.get(input, 0) + 1
+			stack.append(input)
+
+	return readers
+
+def get_subgraph(generator, modules=None):
+	"""
+	Returns the set of modules the output of 'generator' depends on, 
+	including the generator itself
+	"""
+
+	if modules is None:
+		modules = set()
+
+	if generator not in modules:
+		modules.add(generator)
+		for source in generator.get_sources():
+			get_subgraph(source, modules)
+
+	return modules
+
+class Stream():
+	"""
+	A class to represent a block by block render of a signal
+
+	Modules whose output depends on the past (eg. integrators) keep their
+	state in the stream, so that it is carried from one block to the next one.
+	The stream is passed to the modules as the 'stream' keyword argument of
+	the 'output' method.
+
+	The stream is also a render context - within one block every module is 
+	evaluated at most once, its output is kept until the last module reading 
+	it gets it.
+
+	Modules take their scratch buffers from the stream ('get_buffer'), the 
+	same buffers are used in every block, so once the patch is rendered for a 
+	few blocks, rendering a block into a given buffer ('out') allocates no 
+	arrays of the block's size.
+	"""
+
+	def __init__(self, block_size=1024):
+		self.block_size = block_size	#number of samples in a block
+
+		self.block = -1		#index of the current block
+		self.start = 0		#index of the first sample of the current block
+		self.stop = 0		#index of the sample after the current block
+
+		"""
+		'states[module]' is a list [block, start, end], where 'start' is the
+		state of 'module' at the beginning of 'block' and 'end' - at its end
+		"""
+		self.states = {}
+
+		self.t = None			#time buffer of the current block
+		self.cache = {}			#outputs of modules evaluated in the block
+		self.readers = {}		#numbers of modules reading modules' outputs
+		self.evaluating = set()	#modules being evaluated
+
+		"""
+		indices of the voices of a polyphonic keyboard sounding in the 
+		current block (rows of 2D signals), 'None' means all voices
+		"""
+		self.voices = None
+
+		self.pointwise = {}		#modules known to be pointwise or not
+		self.active = {}		#active samples of modules (see 'get_active')
+
+		self.buffers = {}		#scratch buffers, kept from block to block
+
+		#outputs kept between renders (a 'RenderCache' from 'cache.py')
+		self.store = None
+
+		"""
+		sample indices within a block (as floats, so that no casting buffer 
+		is needed to divide them) and the buffer of sample times
+		"""
+		self.offsets = np.arange(block_size, dtype=np.float64)
+		self.times = np.empty(block_size)
+
+	def get_state(self, module, default=None):
+		"""
+		Returns the state of 'module' at the beginning of the current block
+		('default' if the module was not rendered before)
+		"""
+
+		try:
+			block, start, end = self.states[module]
+		except KeyError:
+			self.states[module] = [self.block, default, default]
+			return default
+
+		if block == self.block:
+			#the module is rendered again in the same block
+			return start
+		else:
+			self.states[module] = [self.block, end, end]
+			return end
+
+	def get_end_state(self, module, default=None):
+		"""
+		Returns the state of 'module' at the end of the last block it was 
+		rendered in ('default' if it was not rendered)
+		"""
+
+		try:
+			return self.states[module][2]
+		except KeyError:
+			return default
+
+	def set_state(self, module, state):
+		"""Sets the state of 'module' at the end of the current block"""
+		try:
+			self.states[module][2] = state
+		except KeyError:
+			self.states[module] = [self.block, None, state]
+
+	def get_buffer(self, key, shape, dtype=np.float64):
+		"""
+		Returns a scratch buffer of given shape and type for 'key' (eg. a 
+		module and a name), the same buffer is returned in every block
+		"""
+
+		try:
+			return self.buffers[key, shape, dtype]
+		except KeyError:
+			self.buffers[key, shape, dtype] = np.empty(shape, dtype)
+			return self.buffers[key, shape, dtype]
+
+	def is_pointwise(self, module):
+		"""
+		Returns 'True' if the output of 'module' can be evaluated for any 
+		subset of samples (see 'Generator.is_pointwise')
+		"""
+
+		try:
+			return self.pointwise[module]
+		except KeyError:
+			self.pointwise[module] = module.is_pointwise(self)
+			return self.pointwise[module]
+
+	def get_active(self, module, t, **kwargs):
+		"""
+		Returns 'module.get_active(t, **kwargs)', finding it only once for the 
+		time buffer of the block
+		"""
+
+		if t is not self.t:
+			return module.get_active(t, **kwargs)
+
+		key = (module, kwargs.get('ignore_mod', False))
+		try:
+			return self.active[key]
+		except KeyError:
+			self.active[key] = module.get_active(t, **kwargs)
+			return self.active[key]
+
+	def get_voices(self, count):
+		"""
+		Returns the indices of the voices sounding in the current block, 
+		'count' is the number of all voices
+		"""
+
+		if self.voices is None:
+			return np.arange(count)
+		else:
+			return self.voices
+
+	def get_voice_states(self, module, count, default=None):
+		"""
+		Returns a list of the states of 'module' for the voices sounding in 
+		the current block (rows of its 2D output), 'count' is the number of 
+		all voices
+		"""
+
+		states = self.get_state((module, 'voices'), {})
+		return [states.get(voice, default) for voice in self.get_voices(count)]
+
+	def set_voice_states(self, module, count, states):
+		"""
+		Sets the states of 'module' for the voices sounding in the current 
+		block at its end, the states of other voices are kept
+		"""
+
+		end = dict(self.get_state((module, 'voices'), {}))
+		end.update(zip(self.get_voices(count), states))
+		self.set_state((module, 'voices'), end)
+
+	def reset(self):
+		"""Forgets the states of all modules and rewinds the stream"""
+
+		self.block = -1
+		self.start = 0
+		self.stop = 0
+		self.states = {}
+
+	def seek(self, generator, start):
+		"""
+		Rewinds the stream to the sample 'start', the modules 'generator' 
+		depends on set their states as if the samples before it were rendered 
+		(see 'Generator.seek'), returns 'False' if some of them can't
+		"""
+
+		self.reset()
+		self.stop = start
+
+		if start == 0:
+			return True
+
+		return all(module.seek(start, self) for module in get_subgraph(generator))
+
+	def evaluate(self, module, output, t, out=None, **kwargs):
+		"""
+		Returns the value of 'output(module, t, out, **kwargs)' ('output' 
+		being the 'output' method of the module's class), evaluating it only 
+		once per block
+		"""
+
+		key = (module, kwargs.get('ignore_mod', False))
+
+		#only the outputs for the time buffer of the block are cached
+		if (
+			t is not self.t or key in self.evaluating or 
+			any(arg not in ('stream', 'ignore_mod') for arg in kwargs)
+		):
+			return output(module, t, out, **kwargs)
+
+		try:
+			value, readers = self.cache[key]
+
+		except KeyError:
+			readers = self.readers.get(module, 1)
+
+			"""
+			an output read by many modules is written to a buffer of the 
+			stream, as modules may overwrite the buffers they are given
+			"""
+			buffer = out
+			if readers > 1 and out is not None:
+				buffer = self.get_buffer(key, t.shape)
+
+			value = None
+			if self.store is not None:
+				value = self.store.load(key, self, buffer)
+
+			if value is None:
+				self.evaluating.add(key)
+				try:
+					value = output(module, t, buffer, **kwargs)
+				finally:
+					self.evaluating.discard(key)
+
+				if self.store is not None:
+					self.store.save(key, self, value)
+
+		#free the output once the last module reading it gets it
+		readers -= 1
+		if readers > 0:
+			self.cache[key] = (value, readers)
+		else:
+			self.cache.pop(key, None)
+
+		return to_buffer(value, out)
+
+	def output(self, generator, t, out=None, **kwargs):
+		"""
+		Returns the output of 'generator' for the time buffer 't' as the 
+		current block (written to 'out', if given)
+		"""
+
+		self.t = t
+		self.cache = {}
+		self.voices = None
+		self.pointwise = {}
+		self.active = {}
+		self.readers = count_readers(
+			generator, kwargs.get('ignore_mod', False)
+		)
+
+		return generator.output(t, stream=self, out=out, **kwargs)
+
+	def next_block(self, length, reuse=False):
+		"""
+		Moves to the next block and returns its sample times, 'length' is the
+		total number of samples to render
+
+		If 'reuse' is 'True', the times are written to the same buffer every 
+		block
+		"""
+
+		self.block += 1
+		self.start = self.stop
+		self.stop = min(self.start + self.block_size, length)
+
+		if not reuse:
+			return sample_times(self.start, self.stop)
+
+		#the same values as given by 'sample_times'
+		count = self.stop - self.start
+		times = np.add(
+			self.offsets[:count], np.float64(self.start), out=self.times[:count]
+		)
+		return np.divide(times, np.float64(const.fs), out=times)
+
+	def render(self, generator, time=1.0, out=None, **kwargs):
+		"""
+		Yields the output of 'generator' block by block for 'time' seconds
+
+		If 'out' (a buffer at least 'block_size' long) is given, every block 
+		is written to it, so a block is valid only until the next one is 
+		rendered
+		"""
+		return self.render_samples(
+			generator, 0, sample_count(time), out, **kwargs
+		)
+
+	def render_samples(self, generator, start, stop, out=None, **kwargs):
+		"""
+		Yields the output of 'generator' block by block for samples from 
+		'start' to 'stop' (see 'render'), the output is the same as the part 
+		of a render from the first sample
+
+		The modules find their states at 'start' (see 'seek'), if some of them 
+		can't, the samples before 'start' are rendered (and dropped) first
+		"""
+
+		if not self.seek(generator, start):
+			self.reset()
+			while self.stop < start:
+				self.output(generator, self.next_block(start, True), **kwargs)
+
+		while self.stop < stop:
+			t = self.next_block(stop, out is not None)
+			if out is None:
+				yield self.output(generator, t, **kwargs)
+			else:
+				yield self.output(generator, t, out[:len(t)], **kwargs)
+
+if __name__ == '__main__':
+
+	#tests
+	import sys
+
+	from fm import FMOperator
+	from mixer import Mixer
+	from triggerables import ADSR
+	from oscillators import SquareOscillator
+	from keyboard import MonoKeyboard
+	from generators import Gate
+
+	kbd = MonoKeyboard(
+		gate=Gate([0.25, 0.5, 0.75, 1.0, 1.5]),
+		steps=[0.25, 0.75, 1.5], pitches=[0, 7, 12]
+	)
+
+	op1 = FMOperator(220.0, 0.75, fm_type='LinearFM')
+	op2 = FMOperator(440.0, 0.5, fm_type='DX')
+	op1.add_modulator(op2)
+
+	op1.set_eg_params(0.01, 0.25, 0.5, 0.5)
+	op2.set_eg_params(0.0675, 0.25, 0.5, 0.5)
+	op1.set_keyboard(kbd)
+	op2.set_keyboard(kbd)
+
+	#an envelope triggered by a signal that is not a 'Gate'
+	eg = ADSR(0.1, 0.1, 0.5, 0.1, input=SquareOscillator(3.0))
+
+	mixer = Mixer()
+	mixer.add_input(op1)
+	mixer.add_input(eg, 0.25)
+
+	time = 2.0
+	whole = mixer.output(sample_times(0, sample_count(time)))
+
+	for block_size in [256, 1000, 4096]:
+		blocks = np.concatenate(list(Stream(block_size).render(mixer, time)))
+		print(block_size, np.array_equal(whole, blocks))
+		if not np.array_equal(whole, blocks):
+			sys.exit(1)
+
+		#blocks written to a buffer
+		out = np.empty(block_size)
+		blocks = np.concatenate([
+			np.copy(block) for block in Stream(block_size).render(
+				mixer, time, out
+			)
+		])
+		print(block_size, 'out', np.array_equal(whole, blocks))
+		if not np.array_equal(whole, blocks):
+			sys.exit(1)
+
+	#the phase of an oscillator accumulated from a key input other than a key
+	#(a vibrato added to the key), and from the keys of the voices
+	from oscillators import SineOscillator
+	from keyboard import PolyKey, MonoKey
+
+	key = Mixer()
+	key.add_input(MonoKey([0.0, 0.3, 1.1], [0, 7, -5]))
+	key.add_input(SineOscillator(5.0), 0.5)
+	osc = SineOscillator(220.0, key_in=key)
+
+	whole = osc.output(sample_times(0, sample_count(time)))
+	for block_size in [256, 1000, 4096]:
+		blocks = np.concatenate(list(Stream(block_size).render(osc, time)))
+		print(block_size, 'vibrato', np.array_equal(whole, blocks))
+		if not np.array_equal(whole, blocks):
+			sys.exit(1)
+
+	keys = [MonoKey([0.0, 0.5], [0, 12]), MonoKey([0.25, 1.0], [3, -2])]
+	voices = Mixer()
+	voices.add_input(PolyKey(keys))
+	osc = SineOscillator(220.0, key_in=voices)
+
+	t = sample_times(0, sample_count(time))
+	rows = []
+	for voice in keys:
+		key = Mixer()
+		key.add_input(voice)
+		rows.append(SineOscillator(220.0, key_in=key).output(t))
+
+	whole = osc.output(t)
+	blocks = np.concatenate(list(Stream(1000).render(osc, time)), axis=-1)
+	equal = [np.array_equal(whole, rows), np.array_equal(blocks, rows)]
+	print('voices', equal)
+	if not all(equal):
+		sys.exit(1)
+
+	#voice mixers of two keyboards set the sounding voices back
+	from benchmark import fm_voice, MIDI
+	from keyboard import PolyKeyboard
+	from mixer import VoiceMixer
+	import os
+
+	mixer = Mixer()
+	voices = []
+	for polyphony, name in [(3, 'chords'), (5, 'overlap')]:
+		kbd = PolyKeyboard(polyphony)
+		kbd.read_midi(os.path.join(MIDI, 'wlazkoteknaplotek_%s.mid' % name))
+		voices.append(VoiceMixer(kbd, fm_voice(kbd)))
+		mixer.add_input(voices[-1])
+
+	stream = Stream(4096)
+	blocks = np.concatenate(list(stream.render(mixer, 5.0)))
+	separate = sum(
+		np.concatenate(list(Stream(4096).render(voice, 5.0)))
+		for voice in voices
+	)
+	print('voice mixers', stream.voices is None, np.allclose(blocks, separate))
+	if not (stream.voices is None and np.allclose(blocks, separate)):
+		sys.exit(1)
+
+	#no arrays of a block's size are allocated once the blocks are warmed up
+	import tracemalloc
+	from benchmark import danger_zone
+
+	mixer, kbd = danger_zone()
+	kbd.gate.set_triggers([0.0, 100.0])
+	kbd.key.set_attributes([0.0], [0])
+
+	block_size = 16384
+	out = np.empty(block_size)
+	blocks = Stream(block_size).render(mixer, 10.0, out)
+	for i in range(4):
+		next(blocks)
+
+	tracemalloc.start()
+	peak = 0
+	while True:
+		tracemalloc.reset_peak()
+		start = tracemalloc.get_traced_memory()[0]
+		block = next(blocks, None)
+		if block is None:
+			break
+
+		#the last, shorter block needs buffers of its own
+		if len(block) == block_size:
+			peak = max(peak, tracemalloc.get_traced_memory()[1] - start)
+	tracemalloc.stop()
+
+	#the peak memory of a block (in bytes) is less than one array of samples
+	print('peak', peak, peak < out.nbytes)
+	if peak >= out.nbytes:
+		sys.exit(1)
@@ -2,7 +2,9 @@ import numpy as np
 
 import constants as const
 import math_func as mf
-from generators import Generator, Gate
+from generators import Generator, Gate, output_method, zeros
+from stream import Stream, fit
+from keyboard import PolyGate
 
 class Triggerable(Generator):
 	"""A mother class to represent all triggerable modules"""
@@ -17,123 +19,264 @@ class Triggerable(Generator):
 	def set_input(self, input):
 		"""Sets an input of the generator"""
 		self.input = input
+		self.touch()
 
-	def get_presses(self, ts):
-		"""Returns an array of times when gate was opened (key was pressed)"""
-		
-		if type(self.input) == Gate:
-			return self.input.presses
+	def get_inputs(self, ignore_mod=False):
+		"""Returns a list of modules whose outputs are read"""
 
+		if type(self.input) in (Gate, PolyGate):
+			return []
 		else:
-			output = self.input.output(ts)
-			offset = np.full(output.shape, 0.0)
-			offset[1:] = output[:-1]
+			return [self.input]
 
-			indices = np.logical_and(
-				output > self.threshold, offset <= self.threshold
-			)
-			return ts[indices]
+	def get_sources(self):
+		"""Returns a list of all modules the output depends on"""
+		return [self.input]
 
-	def get_releases(self, ts):
-		"""Returns an array of times when gate was closed (key was released)"""
+	def is_pointwise(self, stream=None):
+		"""Returns 'True' if the output can be evaluated for any samples"""
 
+		#presses of an input other than a gate are found in its output
+		return type(self.input) in (Gate, PolyGate)
 
-		if type(self.input) == Gate:
-			return self.input.releases
+	def seek(self, start, stream):
+		"""
+		Sets the state of the module in 'stream' as if the samples before 
+		'start' were rendered (see 'Generator.seek')
+		"""
+
+		if type(self.input) in (Gate, PolyGate) or start == 0:
+			return True
+
+		#the last press and release are found in the input's output before
+		#'start' (the module itself is not rendered)
+		blocks = Stream(stream.block_size)
+		while blocks.stop < start:
+			self.get_triggers(blocks.next_block(start), stream=blocks)
 
+		stream.set_state(self, blocks.get_end_state(self))
+		return True
+
+	def get_active(self, t, **kwargs):
+		"""
+		Returns a boolean array telling where in time t the output may be 
+		non-zero ('None' if it is not known)
+		"""
+
+		if type(t) != np.ndarray:
+			return None
+
+		if type(self.input) == Gate:
+			gates = [self.input]
+		elif type(self.input) == PolyGate:
+			gates = self.input.get_gates(kwargs.get('stream'))
 		else:
-			output = self.input.output(ts)
-			offset = np.full(output.shape, 0.0)
-			offset[1:] = output[:-1]
+			return None
+
+		active = self.get_buffer(t, 'active', bool, kwargs.get('stream'))
+		active.fill(False)
+
+		for gate in gates:
+			presses = gate.presses
+
+			"""
+			the sample after the end is active as well, because of the 
+			rounding of the times relative to the press and the release
+			"""
+			ends = self.get_ends(presses, gate.releases) + 1.0 / const.fs
+
+			#only the presses sounding within 't' are marked
+			sounding = np.logical_and(presses <= t[-1], ends >= t[0])
+			starts = np.searchsorted(t, presses[sounding])
+			stops = np.searchsorted(t, ends[sounding], side='right')
+
+			for start, stop in zip(starts, stops):
+				active[start:stop] = True
+
+		return active
+
+	def get_ends(self, presses, releases):
+		"""
+		Returns the moments after which the output triggered by 'presses' and 
+		stopped by 'releases' is 0
+		"""
+		return np.maximum(releases, presses) + self.release_time()
+
+	def get_triggers(self, ts, **kwargs):
+		"""
+		Returns arrays of times when gate was opened (key was pressed) and 
+		closed (key was released)
+		"""
+		
+		if type(self.input) == Gate:
+			return self.input.presses, self.input.releases
+
+		output = self.input.output(ts, **kwargs)
+		offset = np.full(output.shape, 0.0)
+		offset[1:] = output[:-1]
+
+		stream = kwargs.get('stream')
+		if stream is not None:
+
+			#the last input value, press and release of the previous blocks
+			last, press, release = stream.get_state(self, (0.0, None, None))
+			offset[0] = last
+
+		presses = ts[np.logical_and(
+			output > self.threshold, offset <= self.threshold
+		)]
+		releases = ts[np.logical_and(
+			output < self.threshold, offset >= self.threshold
+		)]
+
+		if stream is not None:
+
+			#remember the state at the end of the block
+			stream.set_state(self, (
+				output[-1],
+				presses[-1] if len(presses) > 0 else press,
+				releases[-1] if len(releases) > 0 else release
+			))
+
+			#the module can still be triggered by the previous blocks' press
+			if press is not None:
+				presses = np.concatenate(([press], presses))
+
+				if release is not None and release >= press:
+					releases = np.concatenate(([release], releases))
+
+		return presses, releases
+
+	def get_presses(self, ts, **kwargs):
+		"""Returns an array of times when gate was opened (key was pressed)"""
+		return self.get_triggers(ts, **kwargs)[0]
+
+	def get_releases(self, ts, **kwargs):
+		"""Returns an array of times when gate was closed (key was released)"""
+		return self.get_triggers(ts, **kwargs)[1]
 
-			indices = np.logical_and(
-				output < self.threshold, offset >= self.threshold
-			)
-			return ts[indices]	
+	def release_time(self):
+		"""Returns how long (in seconds) the output lasts after a release"""
+		return 0.0
 
-	def before_release(self, t):
+	def before_release(self, t, out=None):
 		"""
 		Returns the output signal given that the gate is opened at time 0, and 
-		never closed
+		never closed (written to 'out', if given)
 		"""
 
-		if type(t) == np.ndarray:
+		if type(t) != np.ndarray:
+			return 1.0
+		elif out is None:
 			return np.ones(t.shape, dtype=np.float64)
 		else:
-			return 1.0
+			out.fill(1.0)
+			return out
 
 
-	def after_release(self, t):
+	def after_release(self, t, out=None):
 		"""
 		Returns the output signal given that the gate is opened and immediately 
-		closed at time 0
+		closed at time 0 (written to 'out', if given)
 		"""
 
-		if type(t) == np.ndarray:
+		if type(t) != np.ndarray:
+			return 0.0
+		elif out is None:
 			return np.zeros(t.shape, dtype=np.float64)
 		else:
-			return 0.0
+			out.fill(0.0)
+			return out
 
-	def output(self, t, **kwargs):
+	@output_method
+	def output(self, t, out=None, **kwargs):
+		"""
+		Returns the value of the output signal in time t
+
+		't' is expected to be in ascending order (as sample times are), every 
+		press and release touches only the samples between it and the next 
+		press or release
+		"""
 		
-		if type(t) == np.ndarray:
-			
-			#moments where the module is triggered
-			presses = self.get_presses(t)
-
-			#moments where the module is stopped
-			releases = self.get_releases(t)
-
-			if len(presses) == 0:
-				return np.full(t.shape, 0.0)
-
-			#the output will be stored here
-			output = np.zeros(t.shape)
-
-			i = 0					#iterator
-			press = presses[i]		#the next (here first) press/trigger moment
-
-			while True:
-				
-				#let 'release' be the next release/stop moment
-				try:
-					release = releases[i]
-				except IndexError:
-					release = const.inf
-				
-				#trigger the module
-				output += (
-					self.before_release(t - press)
-					*np.float64(np.logical_and(press <= t, t < release))
-				)
+		if type(t) != np.ndarray:
+			return self.output(
+				np.array([t], dtype=np.float64), **kwargs
+			)[..., 0]
+
+		if type(self.input) == PolyGate:
+
+			#every voice of a polyphonic keyboard is triggered by its gate
+			gates = self.input.get_gates(kwargs.get('stream'))
 
-				#the previous press/trigger moment
-				prev_press = press
-				
-				#let 'press' be the next press/trigger moment
-				try:
-					press = presses[i + 1]
-				except IndexError:
-					press = const.inf
-
-				#stop the module
-				output += (
-					self.before_release(release - prev_press)
-					*self.after_release(t - release)
-					*np.float64(np.logical_and(release <= t, t < press))
+			output = np.zeros((len(gates),) + t.shape)
+			for i, gate in enumerate(gates):
+				self.trigger(
+					t, gate.presses, gate.releases, output[i], 
+					kwargs.get('stream')
 				)
 
-				#stop when there is no more presses/triggers
-				if press >= const.inf:
-					break
+			return output
+
+		#moments where the module is triggered and stopped
+		presses, releases = self.get_triggers(t, **kwargs)
+
+		return self.trigger(
+			t, presses, releases, fit(out, t), kwargs.get('stream')
+		)
+
+	def trigger(self, t, presses, releases, out=None, stream=None):
+		"""
+		Returns the output signal in time t given the moments when the gate 
+		was opened ('presses') and closed ('releases'), written to 'out' (if 
+		given)
+		"""
 
-				i += 1
+		#the output will be stored here
+		output = zeros(t, out)
 
+		n = len(presses)
+		if n == 0:
 			return output
-		
-		else:
-			#This will be implemented in the future, I hope
-			return 0.0
+
+		#the signal of a press or a release is computed here
+		buffer = self.get_buffer(t, 'trigger', stream=stream)
+
+		#the i-th press lasts until 'ends[i]', its release until 'nexts[i]'
+		ends = np.full(n, const.inf)
+		ends[:min(n, len(releases))] = releases[:n]
+		nexts = np.full(n, const.inf)
+		nexts[:-1] = presses[1:]
+
+		#indices of samples where the presses and releases begin and end
+		press_starts = np.searchsorted(t, presses)
+		release_starts = np.searchsorted(t, ends)
+		release_stops = np.searchsorted(t, nexts)
+
+		#only presses sounding within 't' are rendered
+		sounding = np.nonzero(np.logical_or(
+			press_starts < release_starts, release_starts < release_stops
+		))[0]
+
+		for i in sounding:
+			press = presses[i]
+			release = ends[i]
+
+			#trigger the module
+			a, b = press_starts[i], release_starts[i]
+			if a < b:
+				value = np.subtract(t[a:b], press, out=buffer[a:b])
+				output[a:b] += self.before_release(value, value)
+
+			#stop the module
+			a, b = release_starts[i], release_stops[i]
+			if a < b:
+				value = np.subtract(t[a:b], release, out=buffer[a:b])
+				value = self.after_release(value, value)
+				output[a:b] += np.multiply(
+					self.before_release(release - press), value, out=value
+				)
+
+		return output
 
 class ADSR(Triggerable):
 	"""A class to represent an envelope generator of ADSR type"""
@@ -153,36 +296,75 @@ class ADSR(Triggerable):
 		self.sustain = sustain		#sustain height
 		self.release = release		#release length
 
-	def before_release(self, t):
+		self.touch()
+
+	def release_time(self):
+		"""Returns how long (in seconds) the output lasts after a release"""
+		return self.release
+
+	def get_ends(self, presses, releases):
+		"""
+		Returns the moments after which the output triggered by 'presses' and 
+		stopped by 'releases' is 0
+		"""
+
+		ends = Triggerable.get_ends(self, presses, releases)
+
+		#without sustain the output ends with the decay, unless the release 
+		#comes first
+		if self.sustain == 0.0:
+			decayed = releases - presses >= self.attack + self.decay
+			ends[decayed] = (presses + self.attack + self.decay)[decayed]
+
+		return ends
+
+	def before_release(self, t, out=None):
 		"""
 		Returns the output signal given that the gate is opened at time 0, and 
-		never closed
+		never closed ('t' is expected to be in ascending order), written to 
+		'out' (if given, it may be 't' itself)
 		"""
 
-		attack = (
-			mf.line((0, 0), (self.attack, 1.0), t)
-			*np.float64(np.logical_and(t >= 0, t < self.attack))
+		if type(t) != np.ndarray:
+			return self.before_release(np.array([t], dtype=np.float64))[0]
+
+		#indices of samples where attack, decay and sustain begin
+		attack = np.searchsorted(t, 0.0)
+		decay = np.searchsorted(t, self.attack)
+		sustain = np.searchsorted(t, self.attack + self.decay)
+
+		output = np.empty(t.shape) if out is None else out
+		output[:attack] = 0.0
+		mf.line(
+			(0, 0), (self.attack, 1.0), t[attack:decay], 
+			output[attack:decay]
 		)
-		decay = (
-			mf.line(
-				(self.attack, 1.0), (self.attack + self.decay, self.sustain), t
-			)
-			*np.float64(
-				np.logical_and(t >= self.attack, t < self.attack + self.decay)
-			)
+		mf.line(
+			(self.attack, 1.0), (self.attack + self.decay, self.sustain), 
+			t[decay:sustain], output[decay:sustain]
 		)
-		sustain = self.sustain*np.float64(t >= self.attack + self.decay)
-		
-		return attack + decay + sustain
+		output[sustain:] = self.sustain
+
+		return output
 
-	def after_release(self, t):
+	def after_release(self, t, out=None):
 		"""
 		Returns the output signal given that the gate is opened and immediately 
-		closed at time 0
+		closed at time 0 ('t' is expected to be in ascending order), written 
+		to 'out' (if given, it may be 't' itself)
 		"""
-		return (
-			mf.line((0, 1), (self.release, 0), t)*np.float64(t < self.release)
-		)
+
+		if type(t) != np.ndarray:
+			return self.after_release(np.array([t], dtype=np.float64))[0]
+
+		#index of the sample where the release ends
+		end = np.searchsorted(t, self.release)
+
+		output = np.empty(t.shape) if out is None else out
+		mf.line((0, 1), (self.release, 0), t[:end], output[:end])
+		output[end:] = 0.0
+
+		return output
 
 if __name__ == '__main__':
 
@@ -0,0 +1,90 @@
+import numpy as np
+
+class Wavetable():
+	"""
+	A class to represent a single cycle of a wave shape stored in a table,
+	the wave is looked up with linear interpolation
+	"""
+
+	def __init__(self, values, size=None):
+
+		values = np.array(values, dtype=np.float64)
+
+		#resample the cycle if it doesn't have the desired size
+		if size is not None and size != len(values):
+			values = np.interp(
+				np.arange(size) / np.float64(size),
+				np.arange(len(values)) / np.float64(len(values)),
+				values, period=1.0
+			)
+
+		self.size = len(values)		#number of samples in the cycle
+
+		#the first sample is repeated at the end, so that every sample has
+		#a successor
+		self.values = np.append(values, values[0])
+		self.slopes = np.diff(self.values)
+
+		#sizes that are powers of 2 are wrapped with a bit mask
+		if self.size & (self.size - 1) == 0:
+			self.mask = self.size - 1
+		else:
+			self.mask = None
+
+		"""
+		the largest error of the interpolation, estimated from the second
+		differences of the cycle (it is exact for a sine)
+		"""
+		self.error = np.max(np.abs(np.diff(self.values, 2, append=values[1]))) / 8
+
+	def lookup(self, phase):
+		"""Returns the values of the wave at given phases (in cycles)"""
+
+		x = phase*self.size
+		index = np.floor(x)
+		x -= index			#fractional part of the index
+
+		if self.mask is None:
+			index = index.astype(np.int64) % self.size
+		else:
+			index = index.astype(np.int64) & self.mask
+
+		return self.values[index] + x*self.slopes[index]
+
+def table_size(error=1e-6):
+	"""
+	Returns the smallest power of 2 that is a size of a sine table accurate
+	to 'error'
+	"""
+
+	#the error of linear interpolation of a sine is (2*pi / size)**2 / 8
+	size = 2*np.pi / np.sqrt(8*error)
+	return int(2**np.ceil(np.log2(size)))
+
+def sine_table(size=None, error=1e-6):
+	"""
+	Returns a sine wavetable, if 'size' is not given, the table is as small as
+	possible with the interpolation error not exceeding 'error'
+	"""
+
+	if size is None:
+		size = table_size(error)
+
+	return Wavetable(np.sin(2*np.pi*np.arange(size) / np.float64(size)))
+
+
+if __name__ == '__main__':
+
+	#tests
+	import matplotlib.pyplot as plt
+
+	phases = np.linspace(-1.0, 2.0, 10000)
+
+	for error in [1e-3, 1e-6, 1e-9]:
+		table = sine_table(error=error)
+		measured = np.max(np.abs(table.lookup(phases) - np.sin(2*np.pi*phases)))
+		print(table.size, table.error, measured)
+
+	table = Wavetable([0.0, 1.0, 0.5, -0.5, -1.0], size=64)
+	plt.plot(phases, table.lookup(phases))
+	plt.show()
@@ -0,0 +1,356 @@
+import struct
+import tempfile
+import time as clock
+
+import numpy as np
+
+import constants as const
+from stream import Stream, sample_count
+
+"""
+sample formats of the WAV files: the number of bytes per sample, the format
+tag of the 'fmt ' chunk and the largest value of an integer sample
+"""
+FORMATS = {
+	'int16': (2, 1, 32767),
+	'int24': (3, 1, 8388607),
+	'float32': (4, 3, None),
+}
+
+class WavFile():
+	"""
+	A class to represent a WAV file written block by block
+
+	If the 'length' (in samples) of the file is known, the file is pre-sized
+	and the samples are written to a memory-mapped data chunk, otherwise
+	blocks are appended to the file and the sizes in the header are filled in
+	when the file is closed. Either way only one block is held in memory.
+	"""
+
+	def __init__(self, path, channels=1, format='int16', length=None):
+
+		if format not in FORMATS:
+			raise ValueError(
+				'unknown sample format %r (expected one of %s)' % (
+					format, ', '.join(FORMATS)
+				)
+			)
+
+		self.path = path
+		self.channels = channels		#number of channels
+		self.format = format			#sample format
+		self.width, self.tag, self.scale = FORMATS[format]
+
+		self.length = 0					#number of written samples
+		self.clipped = 0				#number of clipped samples
+
+		self.file = open(path, 'wb+')
+		self.write_header(0 if length is None else length)
+		self.offset = self.file.tell()	#position of the data
+
+		if length is None:
+			self.data = None
+		else:
+			#pre-size the file and map its data chunk
+			size = length*self.channels*self.width
+			self.file.truncate(self.offset + size + size % 2)
+
+			if size > 0:
+				self.data = np.memmap(
+					self.file, dtype=np.uint8, mode='r+', offset=self.offset,
+					shape=(size,)
+				)
+			else:
+				#an empty file can't be mapped
+				self.data = np.zeros(0, dtype=np.uint8)
+			self.size = length
+
+	def write_header(self, length):
+		"""Writes the header of the file for 'length' samples"""
+
+		size = length*self.channels*self.width
+		block_align = self.channels*self.width
+
+		#a chunk of an odd size is followed by a pad byte, which is counted
+		#in the size of the RIFF chunk, but not in the size of the chunk
+		pad = size % 2
+
+		if self.tag == 1:
+			fmt = struct.pack(
+				'<HHIIHH', self.tag, self.channels, int(const.fs),
+				int(const.fs)*block_align, block_align, 8*self.width
+			)
+			fact = b''
+		else:
+			#non-PCM formats have an extension size and a 'fact' chunk
+			fmt = struct.pack(
+				'<HHIIHHH', self.tag, self.channels, int(const.fs),
+				int(const.fs)*block_align, block_align, 8*self.width, 0
+			)
+			fact = b'fact' + struct.pack('<II', 4, length)
+
+		self.file.seek(0)
+		self.file.write(b'RIFF')
+		self.file.write(
+			struct.pack('<I', 4 + 8 + len(fmt) + len(fact) + 8 + size + pad)
+		)
+		self.file.write(b'WAVE')
+		self.file.write(b'fmt ' + struct.pack('<I', len(fmt)) + fmt)
+		self.file.write(fact)
+		self.file.write(b'data' + struct.pack('<I', size))
+
+	def encode(self, block, gain=1.0):
+		"""Returns the bytes of samples 'block' (samples x channels)"""
+
+		if gain != 1.0:
+			block = gain*block
+
+		if self.scale is None:
+			return block.astype('<f4').tobytes()
+
+		#integer samples are clipped
+		self.clipped += np.count_nonzero(np.abs(block) > 1.0)
+		samples = np.rint(np.clip(block, -1.0, 1.0)*self.scale)
+
+		if self.width == 2:
+			return samples.astype('<i2').tobytes()
+
+		#24-bit samples are the lower 3 bytes of 32-bit ones
+		samples = samples.astype('<i4').reshape(-1, 1).view(np.uint8)
+		return samples[:, :3].tobytes()
+
+	def write(self, block, gain=1.0):
+		"""
+		Writes a block of samples (a 1D array for a single channel or a 2D
+		array of samples x channels), scaled by 'gain'
+		"""
+
+		block = np.asarray(block).reshape(len(block), -1)
+		data = self.encode(block, gain)
+
+		if self.data is None:
+			self.file.write(data)
+		else:
+			if self.length + len(block) > self.size:
+				raise ValueError('the file is longer than its pre-set length')
+
+			start = self.length*self.channels*self.width
+			self.data[start:start + len(data)] = np.frombuffer(data, np.uint8)
+
+		self.length += len(block)
+
+	def close(self):
+		"""Finishes writing and closes the file"""
+
+		if self.data is not None:
+			if isinstance(self.data, np.memmap):
+				self.data.flush()
+			self.data = None
+
+		#the header gets the actual length (shorter than pre-set one, if the
+		#file wasn't filled)
+		size = self.length*self.channels*self.width
+		self.file.truncate(self.offset + size)
+		self.file.seek(self.offset + size)
+		self.file.write(b'\0'*(size % 2))
+		self.write_header(self.length)
+		self.file.close()
+
+def render(
+	path, generators, time=1.0, block_size=4096, format='int16',
+	normalize=False, peak=1.0, memmap=True, cache=None
+):
+	"""
+	Renders 'generators' (a generator or a list of generators, one per
+	channel) for 'time' seconds to a WAV file block by block, returns the
+	render speed as a multiple of real time
+
+	Integer samples out of the range [-1, 1] are clipped. If 'normalize' is
+	'True', the signal is scaled so that its peak is 'peak', for that the
+	blocks are first rendered to a temporary file (as 32-bit floats), so
+	memory usage doesn't depend on 'time' either way. Signals rendered
+	before are taken from 'cache' (a 'DiskCache' from 'cache.py'), if given.
+	"""
+
+	if not isinstance(generators, (list, tuple)):
+		generators = [generators]
+
+	length = sample_count(time)
+	start = clock.perf_counter()
+
+	"""
+	every channel is rendered in its own stream, the streams advance
+	together block by block
+	"""
+	if cache is None:
+		streams = [
+			Stream(block_size).render(generator, time) 
+			for generator in generators
+		]
+	else:
+		streams = [
+			cache.blocks(generator, time, block_size) 
+			for generator in generators
+		]
+	blocks = (np.column_stack(channels) for channels in zip(*streams))
+
+	wav = WavFile(
+		path, len(generators), format, length if memmap else None
+	)
+
+	try:
+		if not normalize:
+			for block in blocks:
+				wav.write(block)
+
+		else:
+			with tempfile.TemporaryFile() as temp:
+				top = 0.0		#the peak of the signal
+				for block in blocks:
+					top = max(top, np.max(np.abs(block), initial=0.0))
+					temp.write(block.astype(np.float32).tobytes())
+
+				gain = 1.0 if top == 0.0 else peak / top
+
+				temp.seek(0)
+				chunk = block_size*len(generators)
+				while True:
+					data = np.frombuffer(temp.read(4*chunk), np.float32)
+					if len(data) == 0:
+						break
+					wav.write(data.reshape(-1, len(generators)), gain)
+
+	finally:
+		wav.close()
+
+	return time / (clock.perf_counter() - start)
+
+
+if __name__ == '__main__':
+
+	#tests
+	import os
+	import sys
+	import wave
+
+	from oscillators import SineOscillator
+	from amplifier import Amplifier
+
+	def read(path):
+		"""Returns the 'fmt ' fields, the samples and the size of a WAV file"""
+
+		with open(path, 'rb') as file:
+			data = file.read()
+
+		riff, size, wave_id = struct.unpack('<4sI4s', data[:12])
+		if riff != b'RIFF' or wave_id != b'WAVE' or size != len(data) - 8:
+			return None
+
+		chunks = {}
+		position = 12
+		while position < len(data):
+			name, length = struct.unpack('<4sI', data[position:position + 8])
+			chunks[name] = data[position + 8:position + 8 + length]
+			position += 8 + length + length % 2
+
+		tag, channels, fs, rate, align, bits = struct.unpack(
+			'<HHIIHH', chunks[b'fmt '][:16]
+		)
+		samples = chunks[b'data']
+		if bits == 16:
+			values = np.frombuffer(samples, '<i2') / 32767.0
+		elif bits == 24:
+			triples = np.frombuffer(samples, np.uint8).reshape(-1, 3)
+			padded = np.zeros((len(triples), 4), dtype=np.uint8)
+			padded[:, 1:] = triples
+			values = (padded.view('<i4')[:, 0] >> 8) / 8388607.0
+		else:
+			values = np.frombuffer(samples, '<f4').astype(np.float64)
+
+		fields = (tag, channels, fs, rate, align, bits)
+		return fields, values.reshape(-1, channels), len(samples)
+
+	osc = SineOscillator(440.0)
+	lfo = SineOscillator(0.5)
+	amp = Amplifier(0.5, osc, lfo)
+
+	folder = tempfile.mkdtemp()
+	time = 2.5
+	length = sample_count(time)
+
+	for generators in [[amp, osc], [amp]]:
+		signal = np.column_stack([
+			np.concatenate(list(Stream(1000).render(generator, time)))
+			for generator in generators
+		])
+		channels = len(generators)
+
+		for format in FORMATS:
+			width, tag, scale = FORMATS[format]
+
+			for normalize in [False, True]:
+				expected = signal
+				if normalize:
+					expected = 0.5*signal / np.max(np.abs(signal))
+
+				for memmap in [True, False]:
+					path = os.path.join(folder, 'test.wav')
+					speed = render(
+						path, generators, time, 1000, format, normalize, 0.5, 
+						memmap
+					)
+
+					print(
+						'%d channels, %s, normalize=%s, memmap=%s: %d bytes, '
+						'%.1fx real time' % (
+							channels, format, normalize, memmap, 
+							os.path.getsize(path), speed
+						)
+					)
+
+					#the header and the samples read back
+					fields, values, size = read(path)
+					header = fields == (
+						tag, channels, int(const.fs), 
+						int(const.fs)*channels*width, channels*width, 8*width
+					) and size == length*channels*width
+
+					#an integer sample is off by at most half of its step
+					if scale is None:
+						error = 1e-6
+					else:
+						error = 0.5 / scale + 1e-6
+					samples = values.shape == expected.shape and np.all(
+						np.abs(values - expected) <= error
+					)
+
+					#PCM files are read by the 'wave' module as well
+					if scale is not None:
+						with wave.open(path, 'rb') as file:
+							header = header and file.getparams()[:4] == (
+								channels, width, int(const.fs), length
+							)
+
+					print(header, samples)
+					if not (header and samples):
+						sys.exit(1)
+
+	#an odd number of 24-bit mono samples is followed by a pad byte
+	time = 1001.5 / const.fs
+	expected = np.concatenate(list(Stream(1000).render(amp, time)))
+	for memmap in [True, False]:
+		path = os.path.join(folder, 'odd.wav')
+		render(path, [amp], time, 1000, 'int24', memmap=memmap)
+
+		fields, values, size = read(path)
+		padded = size == 3*1001 and os.path.getsize(path) % 2 == 0
+		with wave.open(path, 'rb') as file:
+			padded = padded and file.getnframes() == 1001
+
+		samples = values.shape == (1001, 1) and np.all(
+			np.abs(values[:, 0] - expected) <= 0.5 / 8388607 + 1e-6
+		)
+
+		print('odd', memmap, padded, samples)
+		if not (padded and samples):
+			sys.exit(1)